@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+
+from nameko import config
+from nameko.extensions import DependencyProvider
+
+
+PRODUCT_CACHE_SIZE_KEY = 'PRODUCT_CACHE_SIZE'
+PRODUCT_CACHE_TTL_KEY = 'PRODUCT_CACHE_TTL'
+
+DEFAULT_PRODUCT_CACHE_SIZE = 10000
+DEFAULT_PRODUCT_CACHE_TTL = 60
+
+
+class LRUCache:
+    """
+    In-process cache bounded both in size and in entry age
+
+    Holds at most `maxsize` entries, evicting the least recently used one
+    when full. Entries older than `ttl` seconds are treated as missing, so
+    a lost invalidation can only serve stale data for a bounded time.
+
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value):
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def set_many(self, values):
+        for key, value in values.items():
+            self.set(key, value)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ProductCache(DependencyProvider):
+    """
+    Read-through product cache shared by all workers of the service
+
+    Services using it keep the entries up to date by handling the
+    ``product_updated``, ``products_updated`` and ``product_deleted``
+    events dispatched by the products service.
+
+    """
+
+    def setup(self):
+        self.cache = LRUCache(
+            maxsize=config.get(
+                PRODUCT_CACHE_SIZE_KEY, DEFAULT_PRODUCT_CACHE_SIZE),
+            ttl=config.get(PRODUCT_CACHE_TTL_KEY, DEFAULT_PRODUCT_CACHE_TTL),
+        )
+
+    def stop(self):
+        self.cache.clear()
+
+    def get_dependency(self, worker_ctx):
+        return self.cache
@@ -0,0 +1,332 @@
+""" Metrics kept in process memory, and their rendering in the Prometheus
+text format.
+
+Each service records into its own `Registry`: `Metrics` times the
+entrypoints of a service and `TimedRpcProxy` the RPC calls it makes, into
+a `ServiceRegistry`. Recording is a dict lookup and a few integer
+increments, so both can stay on every worker. A registry snapshot is plain
+data that can be returned over RPC, so `merge` and `render` can serve the
+metrics of several services together.
+"""
+import time
+from bisect import bisect_left
+
+from nameko.exceptions import RemoteError
+from nameko.extensions import DependencyProvider
+from nameko.rpc import RpcProxy
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10
+)
+
+
+class Value:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Histogram:
+    """ Counts observations into buckets with the given upper bounds, plus
+    one for observations above the last bound.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {
+            'buckets': buckets,
+            'sum': self.sum,
+            'count': cumulative + self.counts[-1],
+        }
+
+
+class Family:
+    """ A metric and its children, one per combination of label values """
+
+    def __init__(self, name, type_, help_, label_names):
+        self.name = name
+        self.type = type_
+        self.help = help_
+        self.label_names = label_names
+        self.children = {}
+
+    def labels(self, *label_values):
+        child = self.children.get(label_values)
+        if child is None:
+            child = Histogram() if self.type == HISTOGRAM else Value()
+            self.children[label_values] = child
+        return child
+
+    def snapshot(self):
+        samples = []
+        for label_values, child in self.children.items():
+            sample = child.snapshot()
+            sample['labels'] = dict(zip(self.label_names, label_values))
+            samples.append(sample)
+        return {
+            'name': self.name,
+            'type': self.type,
+            'help': self.help,
+            'samples': samples,
+        }
+
+
+class Registry:
+
+    def __init__(self):
+        self.families = []
+
+    def add(self, name, type_, help_, label_names):
+        family = Family(name, type_, help_, label_names)
+        self.families.append(family)
+        return family
+
+    def snapshot(self):
+        """ Returns the current value of every metric, in a form that can
+        be sent over RPC and passed to `render`.
+        """
+        return [family.snapshot() for family in self.families]
+
+    def clear(self):
+        for family in self.families:
+            family.children.clear()
+
+
+class ServiceRegistry(Registry):
+    """ Registry of a service, holding the metrics recorded by `Metrics`
+    and `TimedRpcProxy`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.entrypoint_duration = self.add(
+            'entrypoint_duration_seconds', HISTOGRAM,
+            'Time taken by entrypoint workers.', ('service', 'entrypoint'))
+        self.entrypoint_in_flight = self.add(
+            'entrypoint_in_flight', GAUGE,
+            'Entrypoint workers currently running.',
+            ('service', 'entrypoint'))
+        self.entrypoint_errors = self.add(
+            'entrypoint_errors_total', COUNTER,
+            'Entrypoint workers that raised, by exception type.',
+            ('service', 'entrypoint', 'error'))
+        self.rpc_duration = self.add(
+            'rpc_duration_seconds', HISTOGRAM,
+            'Time from sending an RPC request to reading its reply.',
+            ('service', 'target'))
+        self.rpc_errors = self.add(
+            'rpc_errors_total', COUNTER,
+            'RPC calls that failed, by exception type.',
+            ('service', 'target', 'error'))
+
+
+class Metrics(DependencyProvider):
+    """ Records the duration, concurrency and errors of every entrypoint
+    of the service in `registry`, and gives workers the registry.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def setup(self):
+        self.started = {}
+
+    def worker_setup(self, worker_ctx):
+        self.registry.entrypoint_in_flight.labels(
+            self.container.service_name,
+            worker_ctx.entrypoint.method_name
+        ).inc()
+        self.started[worker_ctx] = time.perf_counter()
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        started = self.started.pop(worker_ctx, None)
+        if started is None:
+            return
+
+        labels = (
+            self.container.service_name, worker_ctx.entrypoint.method_name)
+        self.registry.entrypoint_duration.labels(*labels).observe(
+            time.perf_counter() - started)
+        self.registry.entrypoint_in_flight.labels(*labels).dec()
+        if exc_info is not None:
+            self.registry.entrypoint_errors.labels(
+                *labels, exc_info[0].__name__).inc()
+
+    def get_dependency(self, worker_ctx):
+        return self.registry
+
+
+class TimedRpcProxy(RpcProxy):
+    """ `RpcProxy` that records the duration and errors of each call in
+    `registry`.
+
+    A call is timed from sending its request to reading its reply, so
+    replies of ``call_async`` calls that are never read are not recorded.
+    Errors are counted by the type of the remote exception.
+    """
+
+    def __init__(self, target_service, registry, **kwargs):
+        self.registry = registry
+        super().__init__(target_service, **kwargs)
+
+    def get_dependency(self, worker_ctx):
+        return TimedClient(
+            super().get_dependency(worker_ctx), self.registry,
+            self.container.service_name, self.target_service)
+
+
+class TimedClient:
+    """ Wraps the RPC client of a service, or of one of its methods, and
+    times the calls made through it.
+    """
+
+    def __init__(self, client, registry, service_name, target):
+        self._client = client
+        self._registry = registry
+        self._service_name = service_name
+        self._target = target
+
+    def __getattr__(self, name):
+        return TimedClient(
+            getattr(self._client, name), self._registry,
+            self._service_name, '{}.{}'.format(self._target, name))
+
+    def __call__(self, *args, **kwargs):
+        return self.call_async(*args, **kwargs).result()
+
+    def call_async(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            rpc_call = self._client.call_async(*args, **kwargs)
+        except Exception as exc:
+            self._record(started, type(exc).__name__)
+            raise
+        return TimedCall(rpc_call, self, started)
+
+    def _record(self, started, error=None):
+        labels = (self._service_name, self._target)
+        self._registry.rpc_duration.labels(*labels).observe(
+            time.perf_counter() - started)
+        if error:
+            self._registry.rpc_errors.labels(*labels, error).inc()
+
+
+class TimedCall:
+    """ Wraps a call made with ``call_async``, recording it with its
+    `TimedClient` the first time its reply is read.
+    """
+
+    def __init__(self, rpc_call, client, started):
+        self._rpc_call = rpc_call
+        self._client = client
+        self._started = started
+        self._recorded = False
+
+    def result(self):
+        error = None
+        try:
+            return self._rpc_call.result()
+        except RemoteError as exc:
+            error = exc.exc_type
+            raise
+        except BaseException as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            if not self._recorded:
+                self._recorded = True
+                self._client._record(self._started, error)
+
+
+def merge(*snapshots):
+    """ Combines snapshots into one, joining the samples of metrics with
+    the same name.
+    """
+    families = {}
+    for snapshot in snapshots:
+        for family in snapshot:
+            merged = families.get(family['name'])
+            if merged is None:
+                families[family['name']] = dict(
+                    family, samples=list(family['samples']))
+            else:
+                merged['samples'].extend(family['samples'])
+    return list(families.values())
+
+
+def _escape(value):
+    return (
+        str(value).replace('\\', r'\\').replace('\n', r'\n')
+        .replace('"', r'\"')
+    )
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, _escape(value))
+        for name, value in labels.items()
+    ))
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def render(snapshot):
+    """ Returns `snapshot` in the Prometheus text exposition format """
+    lines = []
+    for family in snapshot:
+        name = family['name']
+        lines.append('# HELP {} {}'.format(name, family['help']))
+        lines.append('# TYPE {} {}'.format(name, family['type']))
+        for sample in family['samples']:
+            labels = sample['labels']
+            if family['type'] != HISTOGRAM:
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(labels), sample['value']))
+                continue
+            for bound, count in sample['buckets']:
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels, le=_format_bound(bound)),
+                    count))
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels, le='+Inf'), sample['count']))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), sample['sum']))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(labels), sample['count']))
+    lines.append('')
+    return '\n'.join(lines)
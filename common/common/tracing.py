@@ -0,0 +1,250 @@
+""" Trace context propagation and span export.
+
+Every worker runs in a span. The trace it belongs to travels in the
+worker's context data as a W3C ``traceparent`` (``00-<trace id>-<span
+id>-<flags>``), which nameko copies into the headers of the RPC calls and
+events the worker makes, so the workers they start continue the trace.
+
+Whether a trace is recorded is decided once, where it starts, with
+probability TRACE_SAMPLE_RATE, and carried in the ``traceparent`` flags.
+Workers of traces that are not sampled only pass the context on. Spans
+of sampled traces are buffered and exported in the background, in the
+OTLP/HTTP JSON format: POSTed to TRACE_OTLP_ENDPOINT, or appended as one
+line per batch to TRACE_FILE.
+"""
+import json
+import logging
+import random
+import re
+import time
+import urllib.request
+from contextlib import contextmanager
+
+import eventlet
+from nameko import config
+from nameko.events import EventHandler
+from nameko.extensions import DependencyProvider
+from nameko.timer import Timer
+
+
+TRACEPARENT_KEY = 'traceparent'
+TRACEPARENT_PATTERN = re.compile(
+    r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+TRACE_SAMPLE_RATE_KEY = 'TRACE_SAMPLE_RATE'
+TRACE_FILE_KEY = 'TRACE_FILE'
+TRACE_OTLP_ENDPOINT_KEY = 'TRACE_OTLP_ENDPOINT'
+TRACE_EXPORT_INTERVAL_KEY = 'TRACE_EXPORT_INTERVAL'
+TRACE_BUFFER_SIZE_KEY = 'TRACE_BUFFER_SIZE'
+
+DEFAULT_TRACE_SAMPLE_RATE = 0
+DEFAULT_TRACE_EXPORT_INTERVAL = 1
+DEFAULT_TRACE_BUFFER_SIZE = 10000
+
+OTLP_EXPORT_TIMEOUT = 5
+
+SAMPLED = '01'
+NOT_SAMPLED = '00'
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CONSUMER = 5
+STATUS_CODE_ERROR = 2
+
+
+logger = logging.getLogger(__name__)
+
+
+def format_traceparent(trace_id, span_id, sampled):
+    return '00-{}-{}-{}'.format(
+        trace_id, span_id, SAMPLED if sampled else NOT_SAMPLED)
+
+
+def parse_traceparent(traceparent):
+    """ Returns the ``(trace id, span id, sampled)`` of `traceparent`, or
+    None if it is missing or malformed.
+    """
+    match = TRACEPARENT_PATTERN.match(traceparent or '')
+    if match is None:
+        return None
+    trace_id, span_id, flags = match.groups()
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+def new_trace_id():
+    return '{:032x}'.format(random.getrandbits(128))
+
+
+def new_span_id():
+    return '{:016x}'.format(random.getrandbits(64))
+
+
+class FileExporter:
+    """ Appends each export request to `path`, as one line of JSON """
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, request):
+        with open(self.path, 'a') as spans_file:
+            spans_file.write(json.dumps(request) + '\n')
+
+
+class OtlpExporter:
+    """ POSTs each export request to an OTLP/HTTP collector, as JSON """
+
+    def __init__(self, endpoint, timeout=OTLP_EXPORT_TIMEOUT):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def export(self, request):
+        http_request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(request).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST',
+        )
+        with urllib.request.urlopen(http_request, timeout=self.timeout):
+            pass
+
+
+class WorkerTrace:
+    """ The trace context of a worker, injected by `Tracer` """
+
+    def __init__(self, worker_ctx):
+        self.worker_ctx = worker_ctx
+
+    @property
+    def traceparent(self):
+        return self.worker_ctx.context_data.get(TRACEPARENT_KEY)
+
+    @contextmanager
+    def continued(self, traceparent):
+        """ Makes the RPC calls and events of the block carry `traceparent`
+        instead of the worker's own, continuing the trace of work the
+        worker does on behalf of another one.
+        """
+        context_data = self.worker_ctx.context_data
+        own = context_data.get(TRACEPARENT_KEY)
+        context_data[TRACEPARENT_KEY] = traceparent
+        try:
+            yield
+        finally:
+            context_data[TRACEPARENT_KEY] = own
+
+
+class Tracer(DependencyProvider):
+    """ Runs every worker of the service in a span, continuing the trace
+    of the ``traceparent`` in its context data if there is one.
+    """
+
+    def setup(self):
+        self.sample_rate = config.get(
+            TRACE_SAMPLE_RATE_KEY, DEFAULT_TRACE_SAMPLE_RATE)
+        self.export_interval = config.get(
+            TRACE_EXPORT_INTERVAL_KEY, DEFAULT_TRACE_EXPORT_INTERVAL)
+        self.buffer_size = config.get(
+            TRACE_BUFFER_SIZE_KEY, DEFAULT_TRACE_BUFFER_SIZE)
+
+        self.exporter = None
+        if config.get(TRACE_OTLP_ENDPOINT_KEY):
+            self.exporter = OtlpExporter(config[TRACE_OTLP_ENDPOINT_KEY])
+        elif config.get(TRACE_FILE_KEY):
+            self.exporter = FileExporter(config[TRACE_FILE_KEY])
+
+        self.spans = {}
+        self.finished = []
+        self.dropped = 0
+
+    def start(self):
+        if self.exporter is not None:
+            self.container.spawn_managed_thread(self._export_periodically)
+
+    def stop(self):
+        self.flush()
+
+    def worker_setup(self, worker_ctx):
+        context_data = worker_ctx.context_data
+        parent = parse_traceparent(context_data.get(TRACEPARENT_KEY))
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = new_trace_id(), None
+            sampled = random.random() < self.sample_rate
+
+        span_id = new_span_id()
+        context_data[TRACEPARENT_KEY] = format_traceparent(
+            trace_id, span_id, sampled)
+
+        if sampled and self.exporter is not None:
+            self.spans[worker_ctx] = {
+                'traceId': trace_id,
+                'spanId': span_id,
+                'parentSpanId': parent_id or '',
+                'name': '{}.{}'.format(
+                    self.container.service_name,
+                    worker_ctx.entrypoint.method_name),
+                'kind': self._span_kind(worker_ctx.entrypoint),
+                'startTimeUnixNano': str(time.time_ns()),
+            }
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        span = self.spans.pop(worker_ctx, None)
+        if span is None:
+            return
+
+        span['endTimeUnixNano'] = str(time.time_ns())
+        if exc_info is not None:
+            span['status'] = {
+                'code': STATUS_CODE_ERROR,
+                'message': '{}: {}'.format(
+                    exc_info[0].__name__, exc_info[1]),
+            }
+
+        if len(self.finished) < self.buffer_size:
+            self.finished.append(span)
+        else:
+            self.dropped += 1
+
+    def get_dependency(self, worker_ctx):
+        return WorkerTrace(worker_ctx)
+
+    def _span_kind(self, entrypoint):
+        if isinstance(entrypoint, EventHandler):
+            return SPAN_KIND_CONSUMER
+        if isinstance(entrypoint, Timer):
+            return SPAN_KIND_INTERNAL
+        return SPAN_KIND_SERVER
+
+    def _export_periodically(self):
+        while True:
+            eventlet.sleep(self.export_interval)
+            self.flush()
+
+    def flush(self):
+        """ Exports the finished spans. Spans that fail to export are
+        logged and dropped.
+        """
+        spans, self.finished = self.finished, []
+        if self.dropped:
+            logger.warning(
+                "Dropped %s spans, the export buffer was full", self.dropped)
+            self.dropped = 0
+        if not spans or self.exporter is None:
+            return
+
+        try:
+            self.exporter.export({'resourceSpans': [{
+                'resource': {'attributes': [{
+                    'key': 'service.name',
+                    'value': {'stringValue': self.container.service_name},
+                }]},
+                'scopeSpans': [{
+                    'scope': {'name': __name__},
+                    'spans': spans,
+                }],
+            }]})
+        except Exception:
+            logger.warning(
+                "Failed to export %s spans", len(spans), exc_info=True)
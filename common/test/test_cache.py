@@ -0,0 +1,70 @@
+import pytest
+
+from common.cache import LRUCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def cache(clock):
+    return LRUCache(maxsize=2, ttl=10, clock=clock)
+
+
+class TestLRUCache(object):
+
+    def test_get_miss(self, cache):
+        assert cache.get('the_odyssey') is None
+        assert cache.stats() == {
+            'size': 0, 'maxsize': 2, 'hits': 0, 'misses': 1
+        }
+
+    def test_get_hit(self, cache):
+        cache.set('the_odyssey', {'id': 'the_odyssey'})
+        assert cache.get('the_odyssey') == {'id': 'the_odyssey'}
+        assert cache.stats() == {
+            'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 0
+        }
+
+    def test_get_many(self, cache):
+        cache.set_many({'the_odyssey': 1, 'the_enigma': 2})
+        assert cache.get_many(['the_odyssey', 'unknown']) == {
+            'the_odyssey': 1
+        }
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_entries_expire(self, cache, clock):
+        cache.set('the_odyssey', 1)
+        clock.now = 9
+        assert cache.get('the_odyssey') == 1
+        clock.now = 10
+        assert cache.get('the_odyssey') is None
+        assert len(cache) == 0
+
+    def test_evicts_least_recently_used(self, cache):
+        cache.set('the_odyssey', 1)
+        cache.set('the_enigma', 2)
+        cache.get('the_odyssey')
+        cache.set('the_hindenburg', 3)
+
+        assert len(cache) == 2
+        assert cache.get('the_enigma') is None
+        assert cache.get('the_odyssey') == 1
+        assert cache.get('the_hindenburg') == 3
+
+    def test_invalidate(self, cache):
+        cache.set('the_odyssey', 1)
+        cache.invalidate('the_odyssey')
+        cache.invalidate('unknown')
+        assert cache.get('the_odyssey') is None
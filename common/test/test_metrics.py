@@ -0,0 +1,181 @@
+import pytest
+from nameko.exceptions import RemoteError
+from nameko.rpc import rpc
+from nameko.testing.services import entrypoint_hook
+
+from common import metrics
+from common.metrics import Metrics, ServiceRegistry, TimedRpcProxy
+
+
+registry = ServiceRegistry()
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    registry.clear()
+    yield
+    registry.clear()
+
+
+def get_sample(family, **labels):
+    for sample in family.snapshot()['samples']:
+        if sample['labels'] == labels:
+            return sample
+
+
+class TestHistogram(object):
+
+    def test_observations_are_counted_in_cumulative_buckets(self):
+        histogram = metrics.Histogram(bounds=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+
+        assert histogram.snapshot() == {
+            'buckets': [[0.1, 2], [1, 3]],
+            'sum': 2.65,
+            'count': 4,
+        }
+
+
+class TestRender(object):
+
+    def test_counter(self):
+        assert metrics.render([{
+            'name': 'errors_total',
+            'type': 'counter',
+            'help': 'Errors.',
+            'samples': [
+                {'labels': {'service': 'orders'}, 'value': 2},
+                {'labels': {'service': 'say "hi"\n'}, 'value': 1},
+            ],
+        }]) == (
+            '# HELP errors_total Errors.\n'
+            '# TYPE errors_total counter\n'
+            'errors_total{service="orders"} 2\n'
+            'errors_total{service="say \\"hi\\"\\n"} 1\n'
+        )
+
+    def test_histogram(self):
+        assert metrics.render([{
+            'name': 'duration_seconds',
+            'type': 'histogram',
+            'help': 'Durations.',
+            'samples': [{
+                'labels': {'service': 'orders'},
+                'buckets': [[0.1, 2], [1, 3]],
+                'sum': 2.65,
+                'count': 4,
+            }],
+        }]) == (
+            '# HELP duration_seconds Durations.\n'
+            '# TYPE duration_seconds histogram\n'
+            'duration_seconds_bucket{service="orders",le="0.1"} 2\n'
+            'duration_seconds_bucket{service="orders",le="1.0"} 3\n'
+            'duration_seconds_bucket{service="orders",le="+Inf"} 4\n'
+            'duration_seconds_sum{service="orders"} 2.65\n'
+            'duration_seconds_count{service="orders"} 4\n'
+        )
+
+    def test_merge_groups_samples_by_metric(self):
+        def snapshot(service, value):
+            return [{
+                'name': 'in_flight',
+                'type': 'gauge',
+                'help': 'In flight.',
+                'samples': [{'labels': {'service': service}, 'value': value}],
+            }]
+
+        merged = metrics.merge(snapshot('a', 1), snapshot('b', 2))
+
+        assert metrics.render(merged) == (
+            '# HELP in_flight In flight.\n'
+            '# TYPE in_flight gauge\n'
+            'in_flight{service="a"} 1\n'
+            'in_flight{service="b"} 2\n'
+        )
+
+
+class EchoService(object):
+    name = 'echo'
+
+    @rpc
+    def echo(self, value):
+        return value
+
+    @rpc
+    def fail(self):
+        raise ValueError('boom')
+
+
+class CallerService(object):
+    name = 'caller'
+
+    echo_rpc = TimedRpcProxy('echo', registry)
+    metrics = Metrics(registry)
+
+    @rpc
+    def call_echo(self, value):
+        return self.echo_rpc.echo(value)
+
+    @rpc
+    def call_echo_async(self, value):
+        reply = self.echo_rpc.echo.call_async(value)
+        return [reply.result(), reply.result()]
+
+    @rpc
+    def call_fail(self):
+        return self.echo_rpc.fail()
+
+
+@pytest.fixture
+def caller(container_factory, rabbit_config):
+    for service_cls in (EchoService, CallerService):
+        container = container_factory(service_cls)
+        container.start()
+    return container
+
+
+class TestMetricsDependencies(object):
+
+    def test_entrypoints_and_rpc_calls_are_timed(self, caller):
+        with entrypoint_hook(caller, 'call_echo') as call_echo:
+            assert call_echo('hello') == 'hello'
+
+        duration = get_sample(
+            registry.entrypoint_duration,
+            service='caller', entrypoint='call_echo')
+        assert duration['count'] == 1
+        assert get_sample(
+            registry.entrypoint_in_flight,
+            service='caller', entrypoint='call_echo'
+        )['value'] == 0
+        assert get_sample(
+            registry.rpc_duration, service='caller', target='echo.echo'
+        )['count'] == 1
+        assert registry.entrypoint_errors.snapshot()['samples'] == []
+        assert registry.rpc_errors.snapshot()['samples'] == []
+
+    def test_errors_are_counted_by_type(self, caller):
+        with entrypoint_hook(caller, 'call_fail') as call_fail:
+            with pytest.raises(RemoteError):
+                call_fail()
+
+        assert get_sample(
+            registry.rpc_errors,
+            service='caller', target='echo.fail', error='ValueError'
+        )['value'] == 1
+        assert get_sample(
+            registry.entrypoint_errors,
+            service='caller', entrypoint='call_fail', error='RemoteError'
+        )['value'] == 1
+        assert get_sample(
+            registry.rpc_duration, service='caller', target='echo.fail'
+        )['count'] == 1
+
+    def test_async_calls_are_timed_once_their_reply_is_read(self, caller):
+        with entrypoint_hook(caller, 'call_echo_async') as call_echo_async:
+            assert call_echo_async('hello') == ['hello', 'hello']
+
+        assert get_sample(
+            registry.rpc_duration, service='caller', target='echo.echo'
+        )['count'] == 1
@@ -0,0 +1,217 @@
+import json
+
+import pytest
+from nameko import config
+from nameko.events import EventDispatcher, event_handler
+from nameko.rpc import RpcProxy, rpc
+from nameko.testing.services import entrypoint_hook, entrypoint_waiter
+from nameko.testing.utils import get_extension
+from nameko.web.handlers import http
+
+from common import tracing
+from common.tracing import Tracer
+
+
+TRACE_ID = '0af7651916cd43dd8448eb211c80319c'
+SPAN_ID = 'b7ad6b7169203331'
+
+
+class TestTraceparent(object):
+
+    def test_format_and_parse(self):
+        traceparent = tracing.format_traceparent(TRACE_ID, SPAN_ID, True)
+        assert traceparent == '00-{}-{}-01'.format(TRACE_ID, SPAN_ID)
+        assert tracing.parse_traceparent(traceparent) == (
+            TRACE_ID, SPAN_ID, True)
+
+    def test_parse_not_sampled(self):
+        assert tracing.parse_traceparent(
+            '00-{}-{}-00'.format(TRACE_ID, SPAN_ID)
+        ) == (TRACE_ID, SPAN_ID, False)
+
+    @pytest.mark.parametrize('traceparent', [
+        None,
+        '',
+        'garbage',
+        '00-{}-{}'.format(TRACE_ID, SPAN_ID),
+        '00-{}-{}-01'.format(TRACE_ID[:-1], SPAN_ID),
+        '00-{}-{}-01'.format(TRACE_ID, SPAN_ID.upper()),
+    ])
+    def test_parse_malformed(self, traceparent):
+        assert tracing.parse_traceparent(traceparent) is None
+
+
+class BackendService(object):
+    name = 'backend'
+
+    tracer = Tracer()
+
+    @rpc
+    def work(self):
+        return self.tracer.traceparent
+
+    @rpc
+    def fail(self):
+        raise ValueError('boom')
+
+    @event_handler('frontend', 'work_done')
+    def handle_work_done(self, payload):
+        pass
+
+
+class FrontendService(object):
+    name = 'frontend'
+
+    backend_rpc = RpcProxy('backend')
+    dispatch = EventDispatcher()
+    tracer = Tracer()
+
+    @rpc
+    def call_backend(self):
+        return self.backend_rpc.work()
+
+    @rpc
+    def call_failing_backend(self):
+        return self.backend_rpc.fail()
+
+    @rpc
+    def dispatch_continued(self, traceparent):
+        with self.tracer.continued(traceparent):
+            self.dispatch('work_done', {})
+        return self.tracer.traceparent
+
+
+@pytest.fixture
+def trace_file(tmpdir):
+    return tmpdir.join('spans.jsonl')
+
+
+@pytest.fixture
+def sample_rate():
+    return 1
+
+
+@pytest.fixture
+def trace_config(rabbit_config, trace_file, sample_rate):
+    with config.patch({
+        'TRACE_FILE': str(trace_file),
+        'TRACE_SAMPLE_RATE': sample_rate,
+    }):
+        yield
+
+
+@pytest.fixture
+def containers(container_factory, trace_config):
+    containers = {}
+    for service_cls in (BackendService, FrontendService):
+        containers[service_cls.name] = container_factory(service_cls)
+        containers[service_cls.name].start()
+    return containers
+
+
+def read_spans(containers, trace_file):
+    for container in containers.values():
+        get_extension(container, Tracer).flush()
+
+    spans = {}
+    if not trace_file.check():
+        return spans
+    for line in trace_file.readlines():
+        request = json.loads(line)
+        resource_spans, = request['resourceSpans']
+        for scope_spans in resource_spans['scopeSpans']:
+            for span in scope_spans['spans']:
+                spans[span['name']] = span
+    return spans
+
+
+class TestTracer(object):
+
+    def test_rpc_calls_continue_the_trace(self, containers, trace_file):
+        with entrypoint_hook(
+            containers['frontend'], 'call_backend'
+        ) as call_backend:
+            backend_traceparent = call_backend()
+
+        spans = read_spans(containers, trace_file)
+        frontend = spans['frontend.call_backend']
+        backend = spans['backend.work']
+
+        assert frontend['parentSpanId'] == ''
+        assert backend['traceId'] == frontend['traceId']
+        assert backend['parentSpanId'] == frontend['spanId']
+        assert backend_traceparent == tracing.format_traceparent(
+            backend['traceId'], backend['spanId'], True)
+        assert (
+            int(frontend['startTimeUnixNano']) <=
+            int(backend['startTimeUnixNano']) <=
+            int(backend['endTimeUnixNano']) <=
+            int(frontend['endTimeUnixNano'])
+        )
+        assert frontend['kind'] == tracing.SPAN_KIND_SERVER
+
+    def test_errors_are_recorded(self, containers, trace_file):
+        with entrypoint_hook(
+            containers['frontend'], 'call_failing_backend'
+        ) as call_failing_backend:
+            with pytest.raises(Exception):
+                call_failing_backend()
+
+        spans = read_spans(containers, trace_file)
+        assert spans['backend.fail']['status'] == {
+            'code': tracing.STATUS_CODE_ERROR,
+            'message': 'ValueError: boom',
+        }
+        assert spans['frontend.call_failing_backend']['status'][
+            'code'] == tracing.STATUS_CODE_ERROR
+
+    def test_events_continue_the_given_trace(self, containers, trace_file):
+        traceparent = tracing.format_traceparent(TRACE_ID, SPAN_ID, True)
+
+        with entrypoint_waiter(containers['backend'], 'handle_work_done'):
+            with entrypoint_hook(
+                containers['frontend'], 'dispatch_continued'
+            ) as dispatch_continued:
+                own_traceparent = dispatch_continued(traceparent)
+
+        assert own_traceparent != traceparent
+        span = read_spans(containers, trace_file)[
+            'backend.handle_work_done']
+        assert span['traceId'] == TRACE_ID
+        assert span['parentSpanId'] == SPAN_ID
+        assert span['kind'] == tracing.SPAN_KIND_CONSUMER
+
+    @pytest.mark.parametrize('sample_rate', [0])
+    def test_traces_that_are_not_sampled_are_not_exported(
+        self, containers, trace_file
+    ):
+        with entrypoint_hook(
+            containers['frontend'], 'call_backend'
+        ) as call_backend:
+            backend_traceparent = call_backend()
+
+        assert read_spans(containers, trace_file) == {}
+        assert backend_traceparent.endswith('-00')
+
+
+class TestOtlpExporter(object):
+
+    def test_posts_export_requests(self, container_factory, web_config_port):
+        received = []
+
+        class CollectorService(object):
+            name = 'collector'
+
+            @http('POST', '/v1/traces')
+            def traces(self, request):
+                received.append(
+                    (request.content_type, json.loads(request.get_data())))
+                return '{}'
+
+        container_factory(CollectorService).start()
+
+        exporter = tracing.OtlpExporter(
+            'http://127.0.0.1:{}/v1/traces'.format(web_config_port))
+        exporter.export({'resourceSpans': []})
+
+        assert received == [('application/json', {'resourceSpans': []})]
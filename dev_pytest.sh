@@ -1,3 +1,4 @@
-coverage run -m pytest gateway/test 
+coverage run -m pytest common/test
+coverage run --append -m pytest gateway/test
 coverage run --append -m pytest orders/test
 coverage run --append -m pytest products/test
\ No newline at end of file
@@ -1,101 +1,204 @@
 """
-source reference: https://github.com/nameko/nameko/pull/357
+asyncio RPC client for the Nameko cluster, speaking the Nameko AMQP RPC
+protocol directly so FastAPI routes can await RPC calls without tying up
+a threadpool thread per request.
 """
-import weakref
+import asyncio
+import itertools
+import json
 import os
+import time
+import uuid
 
-from six.moves import xrange as xrange_six, queue as queue_six
-from nameko.standalone.rpc import ClusterRpcClient
+import aio_pika
+from aio_pika.exceptions import DeliveryError
 from nameko import config
 from nameko.cli.utils.config import setup_config
+from nameko.exceptions import UnknownService, deserialize
 
-class ClusterRpcProxyPool(object):
-    """ Connection pool for Nameko RPC cluster.
-    Pool size can be customized by passing `pool_size` kwarg to constructor.
-    Default size is 2 per uvicorn worker (should be enough)
+from gateapi.api import metrics
+
+RPC_EXCHANGE = 'nameko-rpc'
+RPC_REPLY_QUEUE_TEMPLATE = 'rpc.reply-{}-{}'
+
+
+class RpcTimeout(Exception):
+    pass
+
+
+class AsyncRpcClient(object):
+    """ asyncio RPC client for a Nameko cluster.
+    Calls are multiplexed over `pool_size` AMQP connections, each with its
+    own reply queue. Any number of calls may be in flight on a connection at
+    once; replies are matched back to their callers by correlation id.
+    Default pool size is 2 per uvicorn worker (should be enough)
     *Usage*
-        pool = ClusterRpcProxyPool(config)
-        pool.start()
+        client = AsyncRpcClient(uri, timeout=10)
+        await client.start()
         # ...
-        with pool.next() as rpc:
-            rpc.mailer.send_mail(foo='bar')
+        order = await client.orders.get_order(1)
+        order = await client.call('orders', 'get_order', 1, timeout=5)
         # ...
-        pool.stop()
-    This class is thread-safe and designed to work with GEvent.
+        await client.stop()
     """
-    class RpcContext(object):
-        def __init__(self, pool, uri, timeout):
-            self.pool = weakref.proxy(pool)
-            self.proxy = ClusterRpcClient(uri=uri, timeout=timeout)
-            self.rpc = self.proxy.start()
+    class Connection(object):
+        def __init__(self, uri):
+            self.uri = uri
+            self.routing_key = str(uuid.uuid4())
+            self.pending = {}
 
-        def stop(self):
-            self.proxy.stop()
-            self.proxy = None
-            self.rpc = None
+        async def start(self):
+            self.connection = await aio_pika.connect_robust(self.uri)
+            self.channel = await self.connection.channel(
+                publisher_confirms=True, on_return_raises=True
+            )
+            self.exchange = await self.channel.declare_exchange(
+                RPC_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True
+            )
+            queue = await self.channel.declare_queue(
+                RPC_REPLY_QUEUE_TEMPLATE.format('gateapi', self.routing_key),
+                exclusive=True, auto_delete=True
+            )
+            await queue.bind(self.exchange, routing_key=self.routing_key)
+            await queue.consume(self.on_reply, no_ack=True)
 
-        def __enter__(self):
-            return self.rpc
+        async def stop(self):
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            await self.connection.close()
 
-        def __exit__(self, *args, **kwargs):
+        async def on_reply(self, message):
+            future = self.pending.pop(message.correlation_id, None)
+            if future is not None and not future.done():
+                future.set_result(message.body)
+
+        async def call(self, service_name, method_name, args, kwargs, timeout):
+            correlation_id = str(uuid.uuid4())
+            future = asyncio.get_event_loop().create_future()
+            self.pending[correlation_id] = future
             try:
-                self.pool._put_back(self)
-            except ReferenceError:  # pragma: no cover
-                # We're detached from the parent, so this context
-                # is going to silently die.
-                self.stop()
+                try:
+                    await self.exchange.publish(
+                        aio_pika.Message(
+                            json.dumps({'args': args, 'kwargs': kwargs})
+                            .encode('utf-8'),
+                            content_type='application/json',
+                            correlation_id=correlation_id,
+                            reply_to=self.routing_key,
+                        ),
+                        routing_key='{}.{}'.format(service_name, method_name),
+                        mandatory=True,
+                    )
+                except DeliveryError:
+                    raise UnknownService(service_name)
+
+                try:
+                    body = await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    raise RpcTimeout(
+                        '{}.{} did not reply within {}s'.format(
+                            service_name, method_name, timeout)
+                    )
+            finally:
+                self.pending.pop(correlation_id, None)
+
+            payload = json.loads(body)
+            if payload['error'] is not None:
+                raise deserialize(payload['error'])
+            return payload['result']
+
+    class ServiceProxy(object):
+        def __init__(self, client, service_name):
+            self.client = client
+            self.service_name = service_name
+
+        def __getattr__(self, method_name):
+            if method_name.startswith('_'):
+                raise AttributeError(method_name)
+
+            async def method(*args, **kwargs):
+                return await self.client.call(
+                    self.service_name, method_name, *args, **kwargs
+                )
+            return method
 
     def __init__(self, uri, timeout=None, pool_size=2):
         self.uri = uri
         self.timeout = timeout
         self.pool_size = pool_size
+        self.connections = []
+        self._next_connection = None
 
-    def start(self):
-        """ Populate pool with connections.
-        """
-        self.queue = queue_six.Queue()
-        for i in xrange_six(self.pool_size):
-            ctx = ClusterRpcProxyPool.RpcContext(self, self.uri, self.timeout)
-            self.queue.put(ctx)
-
-    def next(self, timeout=None):
-        """ Fetch next connection.
-        This method is thread-safe.
+    def __getattr__(self, service_name):
+        if service_name.startswith('_'):
+            raise AttributeError(service_name)
+        return AsyncRpcClient.ServiceProxy(self, service_name)
+
+    async def start(self):
+        """ Open the pool connections.
         """
-        return self.queue.get(timeout=timeout)
+        self.connections = [
+            AsyncRpcClient.Connection(self.uri)
+            for _ in range(self.pool_size)
+        ]
+        await asyncio.gather(*(
+            connection.start() for connection in self.connections
+        ))
+        self._next_connection = itertools.cycle(self.connections)
 
-    def _put_back(self, ctx):
-        self.queue.put(ctx)
+    async def call(
+        self, service_name, method_name, *args, timeout=None, **kwargs
+    ):
+        """ Call `service_name.method_name`, waiting at most `timeout`
+        seconds (the client default if not given) for the reply.
+        """
+        if self._next_connection is None:
+            raise RuntimeError('RPC client is not started')
+        connection = next(self._next_connection)
+        started = time.perf_counter()
+        error = None
+        try:
+            return await connection.call(
+                service_name, method_name, args, kwargs,
+                timeout if timeout is not None else self.timeout
+            )
+        except Exception as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            metrics.record_rpc(
+                '{}.{}'.format(service_name, method_name), started, error)
 
-    def stop(self):
-        """ Stop queue and remove all connections from pool.
+    async def stop(self):
+        """ Close all pool connections, cancelling calls still in flight.
         """
-        while True:
-            try:
-                ctx = self.queue.get_nowait()
-                ctx.stop()
-            except queue_six.Empty:
-                break
-        self.queue.queue.clear()
-        self.queue = None
-
-# Global/Module pool
+        await asyncio.gather(*(
+            connection.stop() for connection in self.connections
+        ))
+        self.connections = []
+        self._next_connection = None
+
+# Global/Module client
 if os.path.exists('config.yml'):
     with open('config.yml', 'r') as config_file:
         setup_config(config_file)
 else:
     raise Exception("config.yml configuration file not found")
 
-NAMEKO_POOL = ClusterRpcProxyPool(
+NAMEKO_RPC = AsyncRpcClient(
     uri=config['AMQP_URI'],
-    timeout=None
+    timeout=config.get('RPC_TIMEOUT', 30),
+    pool_size=config.get('RPC_POOL_SIZE', 2)
 )
-NAMEKO_POOL.start()
 
-def destroy_nameko_pool():
-    NAMEKO_POOL.stop()
+async def start_nameko_rpc():
+    await NAMEKO_RPC.start()
+
+async def stop_nameko_rpc():
+    await NAMEKO_RPC.stop()
 
 def get_rpc():
-    yield NAMEKO_POOL
+    yield NAMEKO_RPC
 
-config = config
\ No newline at end of file
+config = config
@@ -0,0 +1,100 @@
+""" Latency histograms, in-flight gauges and error counters of the API's
+routes and of the RPC calls they make.
+
+Recording is a dict lookup and a few integer increments, so
+`MetricsMiddleware` can wrap every request. ``GET /metrics`` serves these
+together with the metrics of the orders and products services, in the
+Prometheus text format.
+"""
+import time
+
+from starlette.routing import Match
+
+from common.metrics import COUNTER, GAUGE, HISTOGRAM, Registry
+
+
+SERVICE_NAME = 'gateapi'
+
+# starlette adds the charset to text responses
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+registry = Registry()
+
+entrypoint_duration = registry.add(
+    'entrypoint_duration_seconds', HISTOGRAM,
+    'Time taken by entrypoint workers.', ('service', 'entrypoint'))
+entrypoint_in_flight = registry.add(
+    'entrypoint_in_flight', GAUGE,
+    'Entrypoint workers currently running.', ('service', 'entrypoint'))
+entrypoint_errors = registry.add(
+    'entrypoint_errors_total', COUNTER,
+    'Requests that failed, by HTTP status or exception type.',
+    ('service', 'entrypoint', 'error'))
+rpc_duration = registry.add(
+    'rpc_duration_seconds', HISTOGRAM,
+    'Time from sending an RPC request to reading its reply.',
+    ('service', 'target'))
+rpc_errors = registry.add(
+    'rpc_errors_total', COUNTER,
+    'RPC calls that failed, by exception type.',
+    ('service', 'target', 'error'))
+
+
+class MetricsMiddleware:
+    """ ASGI middleware recording the duration, concurrency and errors of
+    each route, named after its endpoint function.
+
+    Errors are counted by HTTP status for error responses and by exception
+    type for unhandled exceptions.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = None
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        labels = (SERVICE_NAME, self._endpoint_name(scope))
+        in_flight = entrypoint_in_flight.labels(*labels)
+        in_flight.inc()
+        started = time.perf_counter()
+        error = None
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            entrypoint_duration.labels(*labels).observe(
+                time.perf_counter() - started)
+            in_flight.dec()
+            if error is None and status is not None and status >= 400:
+                error = str(status)
+            if error is not None:
+                entrypoint_errors.labels(*labels, error).inc()
+
+    def _endpoint_name(self, scope):
+        # the router has not matched the request yet, so match it here
+        for route in scope['app'].router.routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                endpoint = child_scope.get('endpoint')
+                return getattr(endpoint, '__name__', 'unmatched')
+        return 'unmatched'
+
+
+def record_rpc(target, started, error=None):
+    rpc_duration.labels(SERVICE_NAME, target).observe(
+        time.perf_counter() - started)
+    if error is not None:
+        rpc_errors.labels(SERVICE_NAME, target, error).inc()
@@ -0,0 +1,46 @@
+import json
+from fastapi import HTTPException, status
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+async def read_documents(request):
+    # Yields the documents of a json array or NDJSON request body. A json
+    # array is parsed as a whole, NDJSON one line at a time as the body
+    # streams in.
+    if request.headers.get('content-type', '').split(';')[0] != NDJSON_MIMETYPE:
+        try:
+            documents = json.loads(await request.body())
+        except ValueError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid json: {}".format(exc)
+            )
+        if not isinstance(documents, list):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Expected a json array"
+            )
+        for document in documents:
+            yield document
+        return
+
+    number = 0
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield _load_line(line, number)
+    if buffer.strip():
+        yield _load_line(buffer, number + 1)
+
+def _load_line(line, number):
+    try:
+        return json.loads(line)
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid json on line {}: {}".format(number, exc)
+        )
@@ -26,5 +26,11 @@ class OrderNotFound(Exception):
 
 
 @remote_error('products.exceptions.NotFound')
+@remote_error('orders.exceptions.ProductNotFound')
 class ProductNotFound(Exception):
     pass
+
+
+@remote_error('orders.exceptions.ProductOutOfStock')
+class ProductOutOfStock(Exception):
+    pass
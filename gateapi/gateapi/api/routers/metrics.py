@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from fastapi import APIRouter, Response
+from fastapi.params import Depends
+from common.metrics import GAUGE, merge, render
+from gateapi.api import metrics
+from gateapi.api.dependencies import get_rpc, config
+
+router = APIRouter(
+    tags = ['Metrics']
+)
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ['orders', 'products']
+
+@router.get("/metrics")
+async def get_metrics(rpc = Depends(get_rpc)):
+    # Metrics of this API and of the orders and products services, in the
+    # Prometheus text format. Services that do not reply within
+    # METRICS_TIMEOUT seconds are left out, with metrics_scrape_success 0.
+    timeout = config.get('METRICS_TIMEOUT', 5)
+    replies = await asyncio.gather(
+        *(
+            rpc.call(service_name, 'get_metrics', timeout=timeout)
+            for service_name in SERVICES
+        ),
+        return_exceptions=True
+    )
+
+    snapshots = [metrics.registry.snapshot()]
+    scraped = []
+    for service_name, reply in zip(SERVICES, replies):
+        success = 0
+        if isinstance(reply, Exception):
+            logger.warning(
+                "Failed to get the metrics of %s: %r", service_name, reply)
+        else:
+            snapshots.append(reply)
+            success = 1
+        scraped.append(
+            {'labels': {'service': service_name}, 'value': success})
+    snapshots.append([{
+        'name': 'metrics_scrape_success',
+        'type': GAUGE,
+        'help': 'Whether the metrics of a service could be read.',
+        'samples': scraped,
+    }])
+
+    return Response(
+        render(merge(*snapshots)),
+        media_type=metrics.CONTENT_TYPE
+    )
@@ -1,64 +1,219 @@
+import asyncio
+import json
+import logging
 from os import name
-from fastapi import APIRouter, status, HTTPException
+from fastapi import APIRouter, status, HTTPException, Header, Query, Request
 from fastapi.params import Depends
-from typing import List
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from typing import List, Optional
 from gateapi.api import schemas
 from gateapi.api.dependencies import get_rpc, config
-from .exceptions import OrderNotFound
+from .documents import NDJSON_MIMETYPE, read_documents
+from .exceptions import OrderNotFound, ProductNotFound, ProductOutOfStock
 
 router = APIRouter(
     prefix = "/orders",
     tags = ['Orders']
 )
 
-@router.get("/{order_id}", status_code=status.HTTP_200_OK)
-def get_order(order_id: int, rpc = Depends(get_rpc)):
-    try:
-        return _get_order(order_id, rpc)
-    except OrderNotFound as error:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=str(error)
-        )
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+async def _get_products(product_ids, nameko_rpc):
+    # Split the lookup into batches and keep up to PRODUCT_FETCH_CONCURRENCY
+    # of them in flight at once. Batches that have not replied within
+    # PRODUCT_FETCH_TIMEOUT seconds are given up on, leaving their products
+    # out of the order.
+    batch_size = config.get('PRODUCT_BATCH_SIZE', 100)
+    deadline = config.get('PRODUCT_FETCH_TIMEOUT', 5)
+    semaphore = asyncio.Semaphore(config.get('PRODUCT_FETCH_CONCURRENCY', 4))
+
+    async def fetch(batch):
+        async with semaphore:
+            return await nameko_rpc.products.get_many(batch)
+
+    tasks = [
+        asyncio.ensure_future(fetch(product_ids[start:start + batch_size]))
+        for start in range(0, len(product_ids), batch_size)
+    ]
+    if not tasks:
+        return {}
 
-def _get_order(order_id, nameko_rpc):
-    # Retrieve order data from the orders service.
-    # Note - this may raise a remote exception that has been mapped to
-    # raise``OrderNotFound``
-    with nameko_rpc.next() as nameko:
-        order = nameko.orders.get_order(order_id)
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning("Timed out fetching products after %ss", deadline)
+
+    products = {}
+    for task in done:
+        products.update(task.result())
+    return products
+
+@router.get("", status_code=status.HTTP_200_OK)
+async def list_orders(
+    after_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    rpc = Depends(get_rpc)
+):
+    orders = await _list_orders(after_id, limit, rpc)
+    return orders_page_response(orders, limit)
+
+def orders_page_response(orders, limit):
+    headers = {}
+    if len(orders) == limit:
+        headers['X-Next-After-Id'] = str(orders[-1]['id'])
+    return StreamingResponse(
+        _stream_orders(orders),
+        media_type='application/json',
+        headers=headers
+    )
+
+def _stream_orders(orders):
+    yield '['
+    for index, order in enumerate(orders):
+        if index:
+            yield ','
+        yield json.dumps(order)
+    yield ']'
+
+async def _list_orders(after_id, limit, nameko_rpc):
+    # Retrieve a page of order data from the orders service.
+    orders = await nameko_rpc.orders.list_orders(after_id, limit)
+    await enrich_orders(orders, nameko_rpc)
+    return orders
+
+async def enrich_orders(orders, nameko_rpc):
+    # Fetch all products referenced by the orders in a single call.
+    product_ids = list({
+        order_details['product_id']
+        for order in orders
+        for order_details in order['order_details']
+    })
+    products = await _get_products(product_ids, nameko_rpc)
 
     # get the configured image root
     image_root = config['PRODUCT_IMAGE_ROOT']
 
     # Enhance order details with product and image details.
-    for order_details in order['order_details']:
-        product_id = order_details['product_id']
-        if(bool(nameko.products.exist(product_id))):
-            order_details['product'] = nameko.products.get(product_id)
-        # Construct an image url.
-        order_details['image'] = '{}/{}.jpg'.format(image_root, product_id)
+    for order in orders:
+        for order_details in order['order_details']:
+            product_id = order_details['product_id']
+            if product_id in products:
+                order_details['product'] = products[product_id]
+            # Construct an image url.
+            order_details['image'] = '{}/{}.jpg'.format(image_root, product_id)
+
+@router.post("/bulk", status_code=status.HTTP_200_OK)
+async def create_orders(request: Request, rpc = Depends(get_rpc)):
+    # Orders are posted as a json array or as NDJSON and created in batches
+    # of ORDER_IMPORT_BATCH_SIZE, one transaction each. One NDJSON result
+    # per posted order is streamed back as each batch completes.
+    orders = [order async for order in read_documents(request)]
+    return StreamingResponse(
+        _stream_created_orders(orders, rpc),
+        media_type=NDJSON_MIMETYPE
+    )
+
+async def _stream_created_orders(orders, nameko_rpc):
+    batch_size = config.get('ORDER_IMPORT_BATCH_SIZE', 500)
+    for offset in range(0, len(orders), batch_size):
+        batch = orders[offset:offset + batch_size]
+        for result in await _create_orders(batch, offset, nameko_rpc):
+            yield json.dumps(result) + '\n'
+
+async def _create_orders(orders, offset, nameko_rpc):
+    results = {}
+    valid = {}
+    for index, order in enumerate(orders):
+        try:
+            valid[index] = schemas.CreateOrder.parse_obj(order).dict()
+        except ValidationError as error:
+            results[index] = {'status': 'invalid', 'errors': error.errors()}
+
+    # check the products of all the orders exist with a single call
+    product_ids = list({
+        order_details['product_id']
+        for order in valid.values()
+        for order_details in order['order_details']
+    })
+    exists = {}
+    if product_ids:
+        exists = await nameko_rpc.products.exists_many(product_ids)
 
-    return order
+    creatable = []
+    for index, order in valid.items():
+        missing = [
+            order_details['product_id']
+            for order_details in order['order_details']
+            if not exists.get(order_details['product_id'])
+        ]
+        if missing:
+            results[index] = {
+                'status': 'product_not_found',
+                'error': "Product with id {} not found".format(missing[0])
+            }
+        else:
+            creatable.append(index)
+
+    if creatable:
+        created = await nameko_rpc.orders.create_orders(
+            [valid[index] for index in creatable]
+        )
+        for index, result in zip(creatable, created):
+            if result['status'] == 'created':
+                result = {'status': 'created', 'id': result['order']['id']}
+            results[index] = result
+
+    return [
+        dict(results[index], index=offset + index)
+        for index in range(len(orders))
+    ]
+
+@router.get("/{order_id}", status_code=status.HTTP_200_OK)
+async def get_order(order_id: int, rpc = Depends(get_rpc)):
+    try:
+        # The orders service fills in product and image details itself,
+        # so the order is read in a single call.
+        return await rpc.orders.get_order_enriched(order_id)
+    except OrderNotFound as error:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(error)
+        )
 
 @router.post("", status_code=status.HTTP_200_OK, response_model=schemas.CreateOrderSuccess)
-def create_order(request: schemas.CreateOrder, rpc = Depends(get_rpc)):
-    id_ =  _create_order(request.dict(), rpc)
+async def create_order(
+    request: schemas.CreateOrder,
+    idempotency_key: Optional[str] = Header(None, min_length=1, max_length=255),
+    rpc = Depends(get_rpc)
+):
+    # Retries carrying the Idempotency-Key of an earlier request get the
+    # order that request created, rather than a new one.
+    try:
+        id_ = await _create_order(request.dict(), rpc, idempotency_key)
+    except ProductNotFound as error:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(error)
+        )
+    except ProductOutOfStock as error:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(error)
+        )
     return {
         'id': id_
     }
 
-def _create_order(order_data, nameko_rpc):
-    # check order product ids are valid
-    with nameko_rpc.next() as nameko:
-        for item in order_data['order_details']:
-            exist_product = nameko.products.exist(item['product_id'])
-            if not exist_product:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                    detail=f"Product with id {item['product_id']} not found"
-            )
-        # Call orders-service to create the order.
-        result = nameko.orders.create_order(
-            order_data['order_details']
-        )
-        return result['id']
\ No newline at end of file
+async def _create_order(order_data, nameko_rpc, idempotency_key=None):
+    # Call orders-service to create the order.
+    # It checks the order product ids are valid after looking up the
+    # idempotency key, so a retry is answered from its cache.
+    result = await nameko_rpc.orders.create_order(
+        order_data['order_details'], idempotency_key=idempotency_key
+    )
+    return result['id']
\ No newline at end of file
@@ -1,29 +1,93 @@
-from fastapi import APIRouter, status, HTTPException
+from fastapi import APIRouter, status, HTTPException, Query, Request
 from fastapi.params import Depends
-from gateapi.api.dependencies import get_rpc
+from pydantic import ValidationError
+from typing import List, Optional
+from gateapi.api.dependencies import get_rpc, config
 from gateapi.api import schemas
+from .documents import read_documents
 from .exceptions import ProductNotFound
+from .order import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, enrich_orders, orders_page_response
+)
 
 router = APIRouter(
     prefix = "/products",
     tags = ["Products"]
 )
 
+async def _create_products(products, offset, nameko_rpc):
+    valid = {}
+    results = []
+    for index, product in enumerate(products):
+        try:
+            valid[index] = schemas.Product.parse_obj(product).dict()
+        except ValidationError as error:
+            results.append({
+                'index': offset + index,
+                'status': 'invalid',
+                'errors': error.errors()
+            })
+        else:
+            results.append(None)
+
+    if valid:
+        created = await nameko_rpc.products.create_many(list(valid.values()))
+        for index, result in zip(valid, created):
+            if result['status'] != 'created':
+                result['index'] = offset + index
+            results[index] = result
+    return results
+
+@router.get("", status_code=status.HTTP_200_OK, response_model=List[schemas.Product])
+async def list_products(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    rpc = Depends(get_rpc)
+):
+    return await rpc.products.list(offset, limit)
+
+@router.post("/bulk", status_code=status.HTTP_200_OK)
+async def create_products(request: Request, rpc = Depends(get_rpc)):
+    # Products are posted as a json array or as NDJSON, and sent to the
+    # products service in batches of PRODUCT_IMPORT_BATCH_SIZE. Invalid
+    # products are skipped and reported in the per-product results.
+    batch_size = config.get('PRODUCT_IMPORT_BATCH_SIZE', 1000)
+    results = []
+    batch = []
+    async for product in read_documents(request):
+        batch.append(product)
+        if len(batch) == batch_size:
+            results.extend(await _create_products(batch, len(results), rpc))
+            batch = []
+    if batch:
+        results.extend(await _create_products(batch, len(results), rpc))
+    return results
+
 @router.get("/{product_id}", status_code=status.HTTP_200_OK, response_model=schemas.Product)
-def get_product(product_id: str, rpc = Depends(get_rpc)):
-    try: 
-        with rpc.next() as nameko:
-            return nameko.products.get(product_id)
+async def get_product(product_id: str, rpc = Depends(get_rpc)):
+    try:
+        return await rpc.products.get(product_id)
     except ProductNotFound as error:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=str(error)
         )
 
+@router.get("/{product_id}/orders", status_code=status.HTTP_200_OK)
+async def get_product_orders(
+    product_id: str,
+    after_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    rpc = Depends(get_rpc)
+):
+    # Paged like GET /orders, over the orders containing the product.
+    orders = await rpc.orders.get_orders_by_product(product_id, after_id, limit)
+    await enrich_orders(orders, rpc)
+    return orders_page_response(orders, limit)
+
 @router.post("", status_code=status.HTTP_200_OK, response_model=schemas.CreateProductSuccess)
-def create_product(request: schemas.Product, rpc = Depends(get_rpc)):
-    with rpc.next() as nameko:
-        nameko.products.create(request.dict())
-        return {
-            "id": request.id
-        }
+async def create_product(request: schemas.Product, rpc = Depends(get_rpc)):
+    await rpc.products.create(request.dict())
+    return {
+        "id": request.id
+    }
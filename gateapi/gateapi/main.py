@@ -1,23 +1,36 @@
 import uvicorn
-from fastapi import FastAPI
-from gateapi.api.routers import order, product
-from gateapi.api.dependencies import destroy_nameko_pool, config
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
+from gateapi.api.metrics import MetricsMiddleware
+from gateapi.api.routers import metrics, order, product
+from gateapi.api.dependencies import (
+    RpcTimeout, start_nameko_rpc, stop_nameko_rpc, config
+)
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
 
 # Load routes
 app.include_router(order.router)
 app.include_router(product.router)
+app.include_router(metrics.router)
 
-# Setting up nameko cluster rpc client pool connections
+# Setting up nameko cluster rpc client connections
 @app.on_event("startup")
 async def startup_event():
-    pass
+    await start_nameko_rpc()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    # stopping nameko rpc pool
-    destroy_nameko_pool()
+    # stopping nameko rpc client
+    await stop_nameko_rpc()
+
+@app.exception_handler(RpcTimeout)
+async def rpc_timeout_handler(request: Request, exc: RpcTimeout):
+    return JSONResponse(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        content={'detail': str(exc)}
+    )
 
 if __name__ == "__main__":
     uvicorn.run("gateapi.main:app", host="0.0.0.0", port=config['PORT'], workers=config['WEB_CONCURRENCY'])
\ No newline at end of file
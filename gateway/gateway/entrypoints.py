@@ -1,22 +1,41 @@
-import json
-
 from marshmallow import ValidationError
 from nameko.exceptions import safe_for_serialization, BadRequest
 from nameko.web.handlers import HttpRequestHandler
+from nameko.web.server import WebServer
 from werkzeug import Response
 
-from gateway.exceptions import ProductNotFound, OrderNotFound
+from common.tracing import TRACEPARENT_KEY
+from gateway import serializers
+from gateway.exceptions import (
+    OrderConflict, OrderNotFound, ProductNotFound, ProductOutOfStock
+)
+
+
+class TracingWebServer(WebServer):
+    """ Passes the W3C ``traceparent`` header of a request on to its worker,
+    so requests can continue a trace started by the client.
+    """
+
+    def context_data_from_headers(self, request):
+        traceparent = request.headers.get('traceparent')
+        if traceparent is None:
+            return {}
+        return {TRACEPARENT_KEY: traceparent}
 
 
 class HttpEntrypoint(HttpRequestHandler):
     """ Overrides `response_from_exception` so we can customize error handling.
     """
 
+    server = TracingWebServer()
+
     mapped_errors = {
         BadRequest: (400, 'BAD_REQUEST'),
         ValidationError: (400, 'VALIDATION_ERROR'),
         ProductNotFound: (404, 'PRODUCT_NOT_FOUND'),
         OrderNotFound: (404, 'ORDER_NOT_FOUND'),
+        ProductOutOfStock: (409, 'PRODUCT_OUT_OF_STOCK'),
+        OrderConflict: (409, 'ORDER_CONFLICT'),
     }
 
     def response_from_exception(self, exc):
@@ -30,7 +49,7 @@ class HttpEntrypoint(HttpRequestHandler):
                 error_code = 'BAD_REQUEST'
 
         return Response(
-            json.dumps({
+            serializers.dumps({
                 'error': error_code,
                 'message': safe_for_serialization(exc),
             }),
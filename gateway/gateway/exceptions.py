@@ -25,6 +25,17 @@ class OrderNotFound(Exception):
     pass
 
 
+@remote_error('orders.exceptions.Conflict')
+class OrderConflict(Exception):
+    pass
+
+
 @remote_error('products.exceptions.NotFound')
+@remote_error('orders.exceptions.ProductNotFound')
 class ProductNotFound(Exception):
     pass
+
+
+@remote_error('orders.exceptions.ProductOutOfStock')
+class ProductOutOfStock(Exception):
+    pass
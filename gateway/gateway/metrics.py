@@ -0,0 +1,13 @@
+""" Latency histograms, in-flight gauges and error counters of the
+gateway's entrypoints and of the RPC calls it makes.
+
+Metrics are kept in this process only: ``GET /metrics`` merges our
+snapshot with those the other services return from their ``get_metrics``
+RPC.
+"""
+from common.metrics import ServiceRegistry
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = ServiceRegistry()
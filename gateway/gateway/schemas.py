@@ -13,6 +13,19 @@ class CreateOrderSchema(Schema):
     )
 
 
+class UpdateOrderDetailSchema(Schema):
+    id = fields.Int(required=True)
+    price = fields.Decimal(as_string=True, required=True)
+    quantity = fields.Int(required=True)
+
+
+class UpdateOrderSchema(Schema):
+    version = fields.Int()
+    order_details = fields.Nested(
+        UpdateOrderDetailSchema, many=True, required=True
+    )
+
+
 class ProductSchema(Schema):
     id = fields.Str(required=True)
     title = fields.Str(required=True)
@@ -32,4 +45,18 @@ class GetOrderSchema(Schema):
         product = fields.Nested(ProductSchema, many=False)
 
     id = fields.Int()
+    version = fields.Int()
     order_details = fields.Nested(OrderDetail, many=True)
+
+
+# Schema instances keep no state between calls (marshmallow builds a new
+# marshaller for every dump and load), so these are shared instead of
+# being built, nested schemas and all, on every request.
+create_order_schema = CreateOrderSchema(strict=True)
+create_orders_schema = CreateOrderSchema(many=True)
+update_order_schema = UpdateOrderSchema(strict=True)
+product_schema = ProductSchema()
+products_schema = ProductSchema(many=True)
+create_product_schema = ProductSchema(strict=True)
+get_order_schema = GetOrderSchema()
+get_orders_schema = GetOrderSchema(many=True)
@@ -0,0 +1,41 @@
+""" JSON encoding of gateway responses.
+
+Encodes with orjson when it is installed and with the standard library
+otherwise. Both backends encode `Decimal` values as strings, the way the
+schemas dump prices, and both return UTF-8 encoded bytes.
+"""
+import json
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(
+            type(obj).__name__)
+    )
+
+
+def _dumps_orjson(obj):
+    # validation errors are keyed by item index, which json turns into
+    # strings and orjson refuses unless told to do the same
+    return orjson.dumps(
+        obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _dumps_json(obj):
+    return json.dumps(obj, default=_default).encode('utf-8')
+
+
+if orjson is not None:
+    backend = 'orjson'
+    dumps = _dumps_orjson
+else:  # pragma: no cover
+    backend = 'json'
+    dumps = _dumps_json
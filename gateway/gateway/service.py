@@ -1,14 +1,53 @@
 import json
+import logging
+from collections import deque
 
+import eventlet
 from marshmallow import ValidationError
 from nameko import config
+from nameko.events import BROADCAST, event_handler
 from nameko.exceptions import BadRequest
-from nameko.rpc import RpcProxy
 from werkzeug import Response
 
+from common.cache import ProductCache
+from common.metrics import GAUGE, Metrics, TimedRpcProxy, merge, render
+from common.tracing import Tracer
+from gateway import serializers
 from gateway.entrypoints import http
-from gateway.exceptions import OrderNotFound, ProductNotFound
-from gateway.schemas import CreateOrderSchema, GetOrderSchema, ProductSchema
+from gateway.exceptions import (
+    OrderConflict, OrderNotFound, ProductNotFound, ProductOutOfStock
+)
+from gateway.metrics import CONTENT_TYPE, registry
+from gateway.schemas import (
+    create_order_schema, create_orders_schema, create_product_schema,
+    get_order_schema, get_orders_schema, product_schema, products_schema,
+    update_order_schema
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+PRODUCT_BATCH_SIZE_KEY = 'PRODUCT_BATCH_SIZE'
+PRODUCT_FETCH_CONCURRENCY_KEY = 'PRODUCT_FETCH_CONCURRENCY'
+PRODUCT_FETCH_TIMEOUT_KEY = 'PRODUCT_FETCH_TIMEOUT'
+PRODUCT_IMPORT_BATCH_SIZE_KEY = 'PRODUCT_IMPORT_BATCH_SIZE'
+ORDER_IMPORT_BATCH_SIZE_KEY = 'ORDER_IMPORT_BATCH_SIZE'
+METRICS_TIMEOUT_KEY = 'METRICS_TIMEOUT'
+
+DEFAULT_PRODUCT_BATCH_SIZE = 100
+DEFAULT_PRODUCT_FETCH_CONCURRENCY = 4
+DEFAULT_PRODUCT_FETCH_TIMEOUT = 5
+DEFAULT_PRODUCT_IMPORT_BATCH_SIZE = 1000
+DEFAULT_ORDER_IMPORT_BATCH_SIZE = 500
+DEFAULT_METRICS_TIMEOUT = 5
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
 
 
 class GatewayService(object):
@@ -18,19 +57,79 @@ class GatewayService(object):
 
     name = 'gateway'
 
-    orders_rpc = RpcProxy('orders')
-    products_rpc = RpcProxy('products')
+    orders_rpc = TimedRpcProxy('orders', registry)
+    products_rpc = TimedRpcProxy('products', registry)
+    product_cache = ProductCache()
+    metrics = Metrics(registry)
+    tracer = Tracer()
+
+    @event_handler(
+        'products', 'product_updated',
+        handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_product_updated(self, payload):
+        self.product_cache.invalidate(payload['product_id'])
+
+    @event_handler(
+        'products', 'product_deleted',
+        handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_product_deleted(self, payload):
+        self.product_cache.invalidate(payload['product_id'])
+
+    @event_handler(
+        'products', 'products_updated',
+        handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_products_updated(self, payload):
+        for product_id in payload['product_ids']:
+            self.product_cache.invalidate(product_id)
+
+    @http("GET", "/products", expected_exceptions=BadRequest)
+    def list_products(self, request):
+        """Gets a page of products ordered by id.
+
+        At most `limit` (default ``DEFAULT_PAGE_SIZE``) products are
+        returned, skipping the first `offset`.
+        """
+        offset = self._get_int_arg(request, 'offset', 0)
+        limit = self._get_int_arg(request, 'limit', DEFAULT_PAGE_SIZE)
+        if offset < 0:
+            raise BadRequest("offset must not be negative")
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise BadRequest(
+                "limit must be between 1 and {}".format(MAX_PAGE_SIZE)
+            )
+
+        products = self.products_rpc.list(offset, limit)
+        return Response(
+            serializers.dumps(products_schema.dump(products).data),
+            mimetype='application/json'
+        )
 
     @http(
         "GET", "/products/<string:product_id>",
-        expected_exceptions=ProductNotFound
+        expected_exceptions=(ProductNotFound, BadRequest)
     )
     def get_product(self, request, product_id):
         """Gets product by `product_id`
+
+        With a comma separated list of `fields`, e.g. ``?fields=id,title``,
+        only those fields are returned, and only those are read if the
+        product is not cached.
         """
-        product = self.products_rpc.get(product_id)
+        fields = self._get_fields_arg(request)
+        product = self.product_cache.get(product_id)
+        if product is None and fields is not None:
+            # only whole products are cached
+            product = self.products_rpc.get(product_id, fields)
+        elif product is None:
+            product = self.products_rpc.get(product_id)
+            self.product_cache.set(product_id, product)
+        elif fields is not None:
+            product = {field: product[field] for field in fields}
         return Response(
-            ProductSchema().dumps(product).data,
+            serializers.dumps(product_schema.dump(product).data),
             mimetype='application/json'
         )
 
@@ -58,7 +157,7 @@ class GatewayService(object):
 
         """
 
-        schema = ProductSchema(strict=True)
+        schema = create_product_schema
 
         try:
             # load input data through a schema (for validation)
@@ -70,10 +169,104 @@ class GatewayService(object):
 
         # Create the product
         self.products_rpc.create(product_data)
+        self.product_cache.invalidate(product_data['id'])
         return Response(
-            json.dumps({'id': product_data['id']}), mimetype='application/json'
+            serializers.dumps({'id': product_data['id']}),
+            mimetype='application/json'
         )
 
+    @http("POST", "/products/bulk", expected_exceptions=BadRequest)
+    def create_products(self, request):
+        """Create many products - posted as a json array, or as one json
+        document per line with the ``application/x-ndjson`` content type
+
+        Products are validated and sent to the products service in
+        batches, so an NDJSON import never has to be held in memory all
+        at once. Invalid products are skipped; the response holds one
+        result per posted product, in order ::
+
+            [
+                {"id": "the_odyssey", "status": "created"},
+                {
+                    "index": 1,
+                    "status": "invalid",
+                    "errors": {"in_stock": ["Not a valid integer."]}
+                }
+            ]
+
+        """
+        batch_size = config.get(
+            PRODUCT_IMPORT_BATCH_SIZE_KEY, DEFAULT_PRODUCT_IMPORT_BATCH_SIZE)
+
+        results = []
+        batch = []
+        for product in self._read_documents(request):
+            batch.append(product)
+            if len(batch) == batch_size:
+                results.extend(self._create_products(batch, len(results)))
+                batch = []
+        if batch:
+            results.extend(self._create_products(batch, len(results)))
+
+        return Response(
+            serializers.dumps(results), mimetype='application/json')
+
+    def _read_documents(self, request):
+        """ Yields the documents of a json array or NDJSON request body
+        """
+        if request.mimetype != NDJSON_MIMETYPE:
+            try:
+                documents = json.loads(request.get_data(as_text=True))
+            except ValueError as exc:
+                raise BadRequest("Invalid json: {}".format(exc))
+            if not isinstance(documents, list):
+                raise BadRequest("Expected a json array")
+            yield from documents
+            return
+
+        for number, line in enumerate(request.stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError as exc:
+                raise BadRequest(
+                    "Invalid json on line {}: {}".format(number, exc))
+
+    def _create_products(self, products, offset):
+        """ Creates the valid `products`, returning a result for each.
+
+        `offset` is the position of the first product in the request, so
+        the reported indexes refer to the posted products.
+        """
+        data, errors = products_schema.load(products)
+        valid = [
+            index for index in range(len(data)) if index not in errors
+        ]
+
+        created = {}
+        if valid:
+            created = dict(zip(valid, self.products_rpc.create_many(
+                [data[index] for index in valid]
+            )))
+
+        results = []
+        for index in range(len(data)):
+            if index in errors:
+                result = {
+                    'status': 'invalid',
+                    'errors': errors[index] or errors.get('_schema'),
+                }
+            else:
+                result = created[index]
+                if result['status'] == 'created':
+                    self.product_cache.invalidate(result['id'])
+            if result['status'] != 'created':
+                result['index'] = offset + index
+            results.append(result)
+        return results
+
     @http(
         "DELETE", "/products/<string:product_id>",
         expected_exceptions=ProductNotFound
@@ -82,6 +275,7 @@ class GatewayService(object):
         """Delete product by `product_id`
         """
         self.products_rpc.delete(product_id)
+        self.product_cache.invalidate(product_id)
         return Response(
             mimetype='application/json', status=204
         )
@@ -97,37 +291,70 @@ class GatewayService(object):
     def get_order(self, request, order_id):
         """Gets the order details for the order given by `order_id`.
 
-        Enhances the order details with full product details from the
-        products-service.
+        The orders service returns the order already enhanced with full
+        product details, in a single call.
         """
-        order = self._get_order(order_id)
+        # Note - this may raise a remote exception that has been mapped to
+        # raise``OrderNotFound``
+        order = self.orders_rpc.get_order_enriched(order_id)
         return Response(
-            GetOrderSchema().dumps(order).data,
+            serializers.dumps(get_order_schema.dump(order).data),
             mimetype='application/json'
         )
 
-    def _get_order(self, order_id):
-        # Retrieve order data from the orders service.
-        # Note - this may raise a remote exception that has been mapped to
-        # raise``OrderNotFound``
-        order = self.orders_rpc.get_order(order_id)
-
-        # get the configured image root
-        image_root = config['PRODUCT_IMAGE_ROOT']
-
-        # Enhance order details with product and image details.
-        for order_details in order['order_details']:
-            product_id = order_details['product_id']
-            if(bool(self.products_rpc.exist(product_id))):
-                order_details['product'] = self.products_rpc.get(product_id)
-            # Construct an image url.
-            order_details['image'] = '{}/{}.jpg'.format(image_root, order_details['product_id'])
-
-        return order
+    def _get_products(self, orders):
+        # Products are read through the product cache. Products missing
+        # from the products service are left out of the returned mapping.
+        product_ids = list({
+            order_details['product_id']
+            for order in orders
+            for order_details in order['order_details']
+        })
+        products = self.product_cache.get_many(product_ids)
+        missing_ids = [
+            product_id for product_id in product_ids
+            if product_id not in products
+        ]
+        if missing_ids:
+            fetched = self._fetch_products(missing_ids)
+            self.product_cache.set_many(fetched)
+            products.update(fetched)
+        return products
+
+    def _fetch_products(self, product_ids):
+        # Split the lookup into batches and keep up to
+        # PRODUCT_FETCH_CONCURRENCY of them in flight at once. Batches that
+        # have not replied within PRODUCT_FETCH_TIMEOUT seconds are given up
+        # on, leaving their products out of the order.
+        batch_size = config.get(
+            PRODUCT_BATCH_SIZE_KEY, DEFAULT_PRODUCT_BATCH_SIZE)
+        concurrency = config.get(
+            PRODUCT_FETCH_CONCURRENCY_KEY, DEFAULT_PRODUCT_FETCH_CONCURRENCY)
+        deadline = config.get(
+            PRODUCT_FETCH_TIMEOUT_KEY, DEFAULT_PRODUCT_FETCH_TIMEOUT)
+
+        products = {}
+        in_flight = deque()
+        with eventlet.Timeout(deadline, False):
+            for start in range(0, len(product_ids), batch_size):
+                if len(in_flight) >= concurrency:
+                    products.update(in_flight.popleft().result())
+                in_flight.append(self.products_rpc.get_many.call_async(
+                    product_ids[start:start + batch_size]
+                ))
+            while in_flight:
+                products.update(in_flight.popleft().result())
+
+        if in_flight:
+            logger.warning(
+                "Timed out fetching products after %ss", deadline)
+        return products
 
     @http(
         "POST", "/orders",
-        expected_exceptions=(ValidationError, ProductNotFound, BadRequest)
+        expected_exceptions=(
+            ValidationError, ProductNotFound, ProductOutOfStock, BadRequest
+        )
     )
     def create_order(self, request):
         """Create a new order - order data is posted as json
@@ -154,9 +381,21 @@ class GatewayService(object):
 
             {"id": 1234}
 
+        Send an ``Idempotency-Key`` header to make retries safe: every
+        request repeating the key of an earlier one responds with the order
+        that request created, rather than creating another.
+
         """
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not (
+            0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH
+        ):
+            raise BadRequest(
+                "Idempotency-Key must be 1 to {} characters long".format(
+                    MAX_IDEMPOTENCY_KEY_LENGTH)
+            )
 
-        schema = CreateOrderSchema(strict=True)
+        schema = create_order_schema
 
         try:
             # load input data through a schema (for validation)
@@ -167,60 +406,295 @@ class GatewayService(object):
             raise BadRequest("Invalid json: {}".format(exc))
 
         # Create the order
-        # Note - this may raise `ProductNotFound`
-        id_ = self._create_order(order_data)
-        return Response(json.dumps({'id': id_}), mimetype='application/json')
-
-    def _create_order(self, order_data):
-        # check order product ids are valid
-        
-        for item in order_data['order_details']:
-            exist_product = self.products_rpc.exist(item['product_id'])
-            if not exist_product:
-                raise ProductNotFound(
-                    "Product Id {}".format(item['product_id'])
-                )
+        # Note - this may raise `ProductNotFound` or `ProductOutOfStock`
+        id_ = self._create_order(order_data, idempotency_key)
+        return Response(
+            serializers.dumps({'id': id_}), mimetype='application/json')
 
+    def _create_order(self, order_data, idempotency_key=None):
         # Call orders-service to create the order.
+        # It checks the order product ids are valid after looking up the
+        # idempotency key, so a retry is answered from its cache.
         # Dump the data through the schema to ensure the values are serialized
         # correctly.
-        serialized_data = CreateOrderSchema().dump(order_data).data
+        serialized_data = create_order_schema.dump(order_data).data
         result = self.orders_rpc.create_order(
-            serialized_data['order_details']
+            serialized_data['order_details'], idempotency_key=idempotency_key
         )
         return result['id']
 
-    @http("GET", "/orders")
+    @http(
+        "PUT", "/orders/<int:order_id>",
+        expected_exceptions=(
+            ValidationError, OrderNotFound, OrderConflict, BadRequest
+        )
+    )
+    def update_order(self, request, order_id):
+        """Update the price and quantity of order details - posted as json
+
+        Example request ::
+
+            {
+                "version": 3,
+                "order_details": [
+                    {
+                        "id": 1,
+                        "price": "89.99",
+                        "quantity": 2
+                    }
+                ]
+            }
+
+        Order details left out of the request are unchanged. Pass the
+        ``version`` of the order as it was read to have the update refused
+        with a 409 if the order has changed since.
+
+        The response contains the order ID and its new version ::
+
+            {"id": 1234, "version": 4}
+
+        """
+        schema = update_order_schema
+
+        try:
+            # Note - this may raise `ValueError` for invalid json,
+            # or `ValidationError` if data is invalid.
+            order_data = schema.loads(request.get_data(as_text=True)).data
+        except ValueError as exc:
+            raise BadRequest("Invalid json: {}".format(exc))
+
+        # Note - this may raise `OrderNotFound` or `OrderConflict`
+        serialized_data = schema.dump(order_data).data
+        serialized_data['id'] = order_id
+        order = self.orders_rpc.update_order(serialized_data)
+        return Response(
+            serializers.dumps(
+                {'id': order['id'], 'version': order['version']}),
+            mimetype='application/json'
+        )
+
+    @http(
+        "POST", "/orders/bulk",
+        expected_exceptions=(ProductNotFound, ProductOutOfStock, BadRequest)
+    )
+    def create_orders(self, request):
+        """Create many orders - posted as a json array of orders in the
+        format taken by ``POST /orders``, or as one order per line with the
+        ``application/x-ndjson`` content type
+
+        Orders are sent to the orders service in batches, each created in
+        a single transaction. The response is NDJSON, one result per
+        posted order ::
+
+            {"index": 0, "status": "created", "id": 1234}
+            {"index": 1, "status": "invalid", "errors": {...}}
+            {"index": 2, "status": "product_not_found", "error": "..."}
+            {"index": 3, "status": "out_of_stock", "error": "..."}
+
+        """
+        # Every batch is created before the worker returns, rather than
+        # while the response is sent, so the RPC calls stay within the
+        # worker: limited by max_workers, timed, traced, and with their
+        # errors mapped to an error response.
+        orders = list(self._read_documents(request))
+        batch_size = config.get(
+            ORDER_IMPORT_BATCH_SIZE_KEY, DEFAULT_ORDER_IMPORT_BATCH_SIZE)
+
+        lines = []
+        for offset in range(0, len(orders), batch_size):
+            batch = orders[offset:offset + batch_size]
+            for result in self._create_orders(batch, offset):
+                lines.append(serializers.dumps(result) + b'\n')
+
+        return Response(b''.join(lines), mimetype=NDJSON_MIMETYPE)
+
+    def _create_orders(self, orders, offset):
+        """ Creates the valid `orders` whose products all exist, returning
+        a result for each.
+        """
+        data, errors = create_orders_schema.load(orders)
+
+        results = {}
+        for index in errors:
+            if isinstance(index, int):
+                results[index] = {
+                    'status': 'invalid',
+                    'errors': errors[index] or errors.get('_schema'),
+                }
+        valid = [index for index in range(len(data)) if index not in errors]
+
+        product_ids = {
+            order_detail['product_id']
+            for index in valid
+            for order_detail in data[index]['order_details']
+        }
+        exists = {}
+        if product_ids:
+            exists = self.products_rpc.exists_many(list(product_ids))
+
+        creatable = []
+        for index in valid:
+            missing = [
+                order_detail['product_id']
+                for order_detail in data[index]['order_details']
+                if not exists.get(order_detail['product_id'])
+            ]
+            if missing:
+                results[index] = {
+                    'status': 'product_not_found',
+                    'error': "Product Id {}".format(missing[0]),
+                }
+            else:
+                creatable.append(index)
+
+        if creatable:
+            created = self.orders_rpc.create_orders(
+                create_orders_schema.dump(
+                    [data[index] for index in creatable]
+                ).data
+            )
+            for index, result in zip(creatable, created):
+                if result['status'] == 'created':
+                    result = {'status': 'created', 'id': result['order']['id']}
+                results[index] = result
+
+        return [
+            dict(results[index], index=offset + index)
+            for index in range(len(data))
+        ]
+
+    @http("GET", "/orders", expected_exceptions=BadRequest)
     def get_orders(self, request):
-        """Gets the all order details.
+        """Gets a page of order details.
+
+        Orders are returned in id order, at most `limit` (default
+        ``DEFAULT_PAGE_SIZE``) at a time. Pass the id of the last order seen
+        as `after_id` to fetch the next page; the `X-Next-After-Id` response
+        header carries it whenever more orders may follow.
 
         Enhances the order details with full product details from the
         products-service.
         """
-        
-        orders = self._get_orders()
-        orders_response = [GetOrderSchema().dumps(order).data for order in orders]
+        after_id, limit = self._get_page_args(request)
+        orders = self._get_orders(after_id, limit)
+        return self._orders_page_response(orders, limit)
+
+    @http(
+        "GET", "/products/<string:product_id>/orders",
+        expected_exceptions=BadRequest
+    )
+    def get_product_orders(self, request, product_id):
+        """Gets a page of the orders containing `product_id`.
+
+        Paged and enhanced with product details like ``GET /orders``. Orders
+        are listed whole, including their details for other products.
+        """
+        after_id, limit = self._get_page_args(request)
+        orders = self.orders_rpc.get_orders_by_product(
+            product_id, after_id, limit)
+        self._enrich_orders(orders)
+        return self._orders_page_response(orders, limit)
+
+    @http("GET", "/metrics")
+    def get_metrics(self, request):
+        """Gets the metrics of the gateway, orders and products services,
+        in the Prometheus text format.
+
+        The metrics of a service that does not reply within METRICS_TIMEOUT
+        seconds are left out, and its ``metrics_scrape_success`` is 0.
+        """
+        timeout = config.get(METRICS_TIMEOUT_KEY, DEFAULT_METRICS_TIMEOUT)
+        replies = {
+            'orders': self.orders_rpc.get_metrics.call_async(),
+            'products': self.products_rpc.get_metrics.call_async(),
+        }
+
+        snapshots = [self.metrics.snapshot()]
+        scraped = []
+        for service_name, reply in replies.items():
+            success = 0
+            try:
+                with eventlet.Timeout(timeout):
+                    snapshots.append(reply.result())
+                success = 1
+            except (Exception, eventlet.Timeout):
+                logger.warning(
+                    "Failed to get the metrics of %s", service_name,
+                    exc_info=True)
+            scraped.append(
+                {'labels': {'service': service_name}, 'value': success})
+        snapshots.append([{
+            'name': 'metrics_scrape_success',
+            'type': GAUGE,
+            'help': 'Whether the metrics of a service could be read.',
+            'samples': scraped,
+        }])
+
+        return Response(
+            render(merge(*snapshots)), content_type=CONTENT_TYPE
+        )
+
+    def _get_page_args(self, request):
+        after_id = self._get_int_arg(request, 'after_id')
+        limit = self._get_int_arg(request, 'limit', DEFAULT_PAGE_SIZE)
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise BadRequest(
+                "limit must be between 1 and {}".format(MAX_PAGE_SIZE)
+            )
+        return after_id, limit
+
+    def _orders_page_response(self, orders, limit):
+        headers = {}
+        if len(orders) == limit:
+            headers['X-Next-After-Id'] = str(orders[-1]['id'])
+
+        # dumped and encoded in one pass over the page
         return Response(
-            orders_response,
+            serializers.dumps(get_orders_schema.dump(orders).data),
+            headers=headers,
             mimetype='application/json'
         )
 
-    def _get_orders(self):
-        # Retrieve order data from the orders service.
-        # Note - this may raise a remote exception that has been mapped to
-        # raise``OrderNotFound``
-        orders = self.orders_rpc.get_orders()
-        
+    def _get_fields_arg(self, request):
+        value = request.args.get('fields')
+        if value is None:
+            return None
+        fields = value.split(',')
+        unknown = set(fields).difference(product_schema.fields)
+        if unknown:
+            raise BadRequest("Unknown product fields: {}".format(
+                ", ".join(sorted(unknown))))
+        return fields
+
+    def _get_int_arg(self, request, name, default=None):
+        value = request.args.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise BadRequest("{} must be an integer".format(name))
+
+    def _get_orders(self, after_id=None, limit=DEFAULT_PAGE_SIZE):
+        # Retrieve a page of order data from the orders service.
+        orders = self.orders_rpc.list_orders(after_id, limit)
+        self._enrich_orders(orders)
+        return orders
+
+    def _enrich_orders(self, orders):
         # get the configured image root
         image_root = config['PRODUCT_IMAGE_ROOT']
 
+        # Fetch all products referenced by the orders in a single call.
+        products = self._get_products(orders)
+
         # Enhance order details with product and image details.
         for order in orders:
             for order_details in order['order_details']:
                 product_id = order_details['product_id']
-                if(bool(self.products_rpc.exist(product_id))):
-                    order_details['product'] = self.products_rpc.get(product_id)
-        #         # Construct an image url.
-                order_details['image'] = '{}/{}.jpg'.format(image_root, product_id)
-
-        return orders
\ No newline at end of file
+                if product_id in products:
+                    order_details['product'] = products[product_id]
+                # Construct an image url.
+                order_details['image'] = '{}/{}.jpg'.format(
+                    image_root, product_id
+                )
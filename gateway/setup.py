@@ -9,8 +9,12 @@ setup(
     install_requires=[
         "marshmallow==2.19.2",
         "nameko==v3.0.0-rc6",
+        "nameko-examples-common==0.0.1",
     ],
     extras_require={
+        'orjson': [
+            'orjson==3.8.3',
+        ],
         'dev': [
             'pytest==4.5.0',
             'coverage==4.5.3',
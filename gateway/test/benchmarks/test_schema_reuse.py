@@ -0,0 +1,77 @@
+""" Compares dumping orders with a schema built per call, as handlers used
+to, and with the shared instances in `gateway.schemas`.
+
+Building a `GetOrderSchema` copies its fields and those of the nested
+order detail and product schemas, which costs more than dumping a small
+order. Dumping a page of orders is dominated by the per-field work
+instead, so there sharing only has to produce the same result. Run with
+``-s`` to see the per-call timings.
+"""
+import timeit
+from decimal import Decimal
+
+from gateway.schemas import (
+    GetOrderSchema, get_order_schema, get_orders_schema
+)
+
+
+CALLS = 1000
+PAGE_SIZE = 100
+
+
+def make_order(order_id):
+    return {
+        'id': order_id,
+        'version': 1,
+        'order_details': [
+            {
+                'id': index,
+                'quantity': 1,
+                'product_id': 'the_odyssey',
+                'image': 'http://example.com/airship/images/the_odyssey.jpg',
+                'price': Decimal('99.99'),
+                'product': {
+                    'id': 'the_odyssey',
+                    'title': 'The Odyssey',
+                    'maximum_speed': 3,
+                    'in_stock': 899,
+                    'passenger_capacity': 100,
+                },
+            }
+            for index in range(2)
+        ],
+    }
+
+
+def per_call(dump, calls):
+    return min(timeit.repeat(dump, number=calls, repeat=3)) / calls
+
+
+def report(name, built, shared):
+    print('{}: {:.1f}us per call built, {:.1f}us shared ({:.1f}x)'.format(
+        name, built * 1e6, shared * 1e6, built / shared))
+
+
+def test_dump_order_with_shared_schema():
+    order = make_order(1)
+
+    built = per_call(lambda: GetOrderSchema().dump(order), CALLS)
+    shared = per_call(lambda: get_order_schema.dump(order), CALLS)
+    print()
+    report('single order', built, shared)
+
+    assert GetOrderSchema().dump(order) == get_order_schema.dump(order)
+    assert shared < built
+
+
+def test_dump_orders_with_shared_schema():
+    orders = [make_order(order_id) for order_id in range(PAGE_SIZE)]
+
+    built = per_call(
+        lambda: GetOrderSchema(many=True).dump(orders), CALLS // 10)
+    shared = per_call(lambda: get_orders_schema.dump(orders), CALLS // 10)
+    print()
+    report('page of {} orders'.format(PAGE_SIZE), built, shared)
+
+    assert GetOrderSchema(many=True).dump(orders) == (
+        get_orders_schema.dump(orders))
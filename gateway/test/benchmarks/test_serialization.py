@@ -0,0 +1,77 @@
+""" Compares the encode time of a 1000 line order with the schema's
+`dumps`, which responses used to go through, and with
+`gateway.serializers`.
+
+Run with ``-s`` to see the timings. The selected backend has to produce
+the same document as the schema's `dumps`, and encode it at least as
+fast as the standard library.
+"""
+import json
+import timeit
+from decimal import Decimal
+
+from gateway import serializers
+from gateway.schemas import GetOrderSchema
+
+
+LINE_COUNT = 1000
+REPEAT = 20
+
+
+def make_order():
+    return {
+        'id': 1,
+        'version': 1,
+        'order_details': [
+            {
+                'id': index,
+                'quantity': index % 7 + 1,
+                'product_id': 'product_{}'.format(index),
+                'image': 'http://example.com/images/product_{}.jpg'.format(
+                    index),
+                'price': Decimal('{}.99'.format(index)),
+                'product': {
+                    'id': 'product_{}'.format(index),
+                    'title': 'Product {}'.format(index),
+                    'maximum_speed': 5,
+                    'in_stock': 10,
+                    'passenger_capacity': 101,
+                },
+            }
+            for index in range(LINE_COUNT)
+        ],
+    }
+
+
+def report(name, elapsed):
+    print('{}: {} lines, {:.2f}ms per order'.format(
+        name, LINE_COUNT, elapsed / REPEAT * 1000))
+
+
+def test_order_encode_time():
+    order = make_order()
+    schema = GetOrderSchema()
+    dumped = schema.dump(order).data
+
+    encoders = {
+        'schema dumps': lambda: schema.dumps(order).data,
+        'schema dump + json': lambda: serializers._dumps_json(
+            schema.dump(order).data),
+        'schema dump + {}'.format(serializers.backend): lambda: (
+            serializers.dumps(schema.dump(order).data)),
+        'json only': lambda: serializers._dumps_json(dumped),
+        '{} only'.format(serializers.backend): lambda: (
+            serializers.dumps(dumped)),
+    }
+    elapsed = {
+        name: min(timeit.repeat(encode, number=REPEAT, repeat=3))
+        for name, encode in encoders.items()
+    }
+    print()
+    for name, seconds in elapsed.items():
+        report(name, seconds)
+
+    assert json.loads(schema.dumps(order).data) == json.loads(
+        serializers.dumps(dumped))
+    assert elapsed['{} only'.format(serializers.backend)] <= (
+        elapsed['json only'] * 1.1)
@@ -20,6 +20,9 @@
 
 import pytest
 from collections import namedtuple
+from functools import partial
+
+from mock import Mock
 
 from nameko import config
 from nameko.testing.services import replace_dependencies
@@ -80,4 +83,13 @@ def create_service_meta(container_factory, test_config):
 def gateway_service(create_service_meta):
     """ Gateway service test instance with mocked `products_rpc` and
     `orders_rpc` dependencies """
-    return create_service_meta('products_rpc', 'orders_rpc')
+    gateway_service = create_service_meta('products_rpc', 'orders_rpc')
+
+    # Make asynchronous `get_many` calls reply with whatever the synchronous
+    # `get_many` mock is set up to return
+    get_many = gateway_service.products_rpc.get_many
+    get_many.call_async.side_effect = (
+        lambda *args: Mock(result=partial(get_many, *args))
+    )
+
+    return gateway_service
@@ -1,8 +1,17 @@
 import json
 
+import eventlet
+import pytest
 from mock import Mock, call
+from nameko import config
+from nameko.testing.services import entrypoint_hook
+from nameko.testing.utils import get_extension
 
-from gateway.exceptions import OrderNotFound, ProductNotFound
+from common.tracing import Tracer
+from gateway import metrics
+from gateway.exceptions import (
+    OrderConflict, OrderNotFound, ProductNotFound, ProductOutOfStock
+)
 
 
 class TestGetProduct(object):
@@ -27,6 +36,46 @@ class TestGetProduct(object):
             "title": "The Odyssey"
         }
 
+    def test_can_get_product_fields(self, gateway_service, web_session):
+        gateway_service.products_rpc.get.return_value = {
+            "id": "the_odyssey",
+            "title": "The Odyssey"
+        }
+        response = web_session.get('/products/the_odyssey?fields=id,title')
+        assert response.status_code == 200
+        assert gateway_service.products_rpc.get.call_args_list == [
+            call("the_odyssey", ["id", "title"])
+        ]
+        assert response.json() == {
+            "id": "the_odyssey",
+            "title": "The Odyssey"
+        }
+
+    def test_get_product_fields_from_cache(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+        web_session.get('/products/the_odyssey')
+        response = web_session.get('/products/the_odyssey?fields=in_stock')
+
+        assert response.json() == {"in_stock": 10}
+        assert gateway_service.products_rpc.get.call_args_list == [
+            call("the_odyssey")
+        ]
+
+    def test_get_product_unknown_fields(self, gateway_service, web_session):
+        response = web_session.get('/products/the_odyssey?fields=id,colour')
+        assert response.status_code == 400
+        assert response.json()['message'] == (
+            'Unknown product fields: colour')
+        assert not gateway_service.products_rpc.get.called
+
     def test_product_not_found(self, gateway_service, web_session):
         gateway_service.products_rpc.get.side_effect = (
             ProductNotFound('missing'))
@@ -37,7 +86,253 @@ class TestGetProduct(object):
         payload = response.json()
         assert payload['error'] == 'PRODUCT_NOT_FOUND'
         assert payload['message'] == 'missing'
-        
+
+    def test_get_product_is_cached(self, gateway_service, web_session):
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+        first = web_session.get('/products/the_odyssey')
+        second = web_session.get('/products/the_odyssey')
+
+        assert first.json() == second.json()
+        assert gateway_service.products_rpc.get.call_args_list == [
+            call("the_odyssey")
+        ]
+
+    def test_product_updated_invalidates_cache(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+        web_session.get('/products/the_odyssey')
+
+        with entrypoint_hook(
+            gateway_service.container, 'handle_product_updated'
+        ) as handle_product_updated:
+            handle_product_updated({'product_id': 'the_odyssey'})
+
+        gateway_service.products_rpc.get.return_value = dict(
+            gateway_service.products_rpc.get.return_value, in_stock=9
+        )
+        response = web_session.get('/products/the_odyssey')
+
+        assert response.json()['in_stock'] == 9
+        assert gateway_service.products_rpc.get.call_count == 2
+
+    def test_product_deleted_invalidates_cache(
+        self, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+        web_session.get('/products/the_odyssey')
+
+        with entrypoint_hook(
+            gateway_service.container, 'handle_product_deleted'
+        ) as handle_product_deleted:
+            handle_product_deleted({'product_id': 'the_odyssey'})
+
+        gateway_service.products_rpc.get.side_effect = (
+            ProductNotFound('missing'))
+        response = web_session.get('/products/the_odyssey')
+
+        assert response.status_code == 404
+
+
+class TestCreateProducts(object):
+
+    @pytest.fixture
+    def products(self):
+        return [
+            {
+                "in_stock": 10,
+                "maximum_speed": 5,
+                "id": "the_odyssey",
+                "passenger_capacity": 101,
+                "title": "The Odyssey"
+            },
+            {
+                "in_stock": "many",
+                "maximum_speed": 5,
+                "id": "the_enigma",
+                "passenger_capacity": 101,
+                "title": "The Enigma"
+            },
+            {
+                "in_stock": 2,
+                "maximum_speed": 7,
+                "id": "the_nautilus",
+                "passenger_capacity": 30,
+                "title": "The Nautilus"
+            },
+        ]
+
+    @pytest.fixture
+    def gateway_service(self, gateway_service):
+        gateway_service.products_rpc.create_many.side_effect = (
+            lambda products: [
+                {'id': product['id'], 'status': 'created'}
+                for product in products
+            ]
+        )
+        return gateway_service
+
+    expected_results = [
+        {'id': 'the_odyssey', 'status': 'created'},
+        {
+            'index': 1,
+            'status': 'invalid',
+            'errors': {'in_stock': ['Not a valid integer.']}
+        },
+        {'id': 'the_nautilus', 'status': 'created'},
+    ]
+
+    def test_can_create_products_from_json_array(
+        self, gateway_service, web_session, products
+    ):
+        response = web_session.post('/products/bulk', json.dumps(products))
+        assert response.status_code == 200
+        assert response.json() == self.expected_results
+        assert gateway_service.products_rpc.create_many.call_args_list == [
+            call([products[0], products[2]])
+        ]
+
+    def test_can_create_products_from_ndjson(
+        self, gateway_service, web_session, products
+    ):
+        body = '\n'.join(json.dumps(product) for product in products)
+        response = web_session.post(
+            '/products/bulk', body + '\n\n',
+            headers={'Content-Type': 'application/x-ndjson'}
+        )
+        assert response.status_code == 200
+        assert response.json() == self.expected_results
+
+    def test_create_products_in_batches(
+        self, gateway_service, web_session, products
+    ):
+        with config.patch({'PRODUCT_IMPORT_BATCH_SIZE': 2}):
+            response = web_session.post(
+                '/products/bulk', json.dumps(products))
+
+        assert response.json() == self.expected_results
+        assert gateway_service.products_rpc.create_many.call_args_list == [
+            call([products[0]]), call([products[2]])
+        ]
+
+    def test_create_products_invalidates_cache(
+        self, gateway_service, web_session, products
+    ):
+        gateway_service.products_rpc.get.return_value = products[0]
+        web_session.get('/products/the_odyssey')
+
+        web_session.post('/products/bulk', json.dumps(products))
+        web_session.get('/products/the_odyssey')
+
+        assert gateway_service.products_rpc.get.call_count == 2
+
+    def test_products_updated_invalidates_cache(
+        self, gateway_service, web_session, products
+    ):
+        gateway_service.products_rpc.get.return_value = products[0]
+        web_session.get('/products/the_odyssey')
+
+        with entrypoint_hook(
+            gateway_service.container, 'handle_products_updated'
+        ) as handle_products_updated:
+            handle_products_updated({'product_ids': ['the_odyssey']})
+        web_session.get('/products/the_odyssey')
+
+        assert gateway_service.products_rpc.get.call_count == 2
+
+    def test_create_products_reports_products_rejected_by_service(
+        self, gateway_service, web_session, products
+    ):
+        gateway_service.products_rpc.create_many.side_effect = None
+        gateway_service.products_rpc.create_many.return_value = [
+            {'id': 'the_odyssey', 'status': 'created'},
+            {'index': 1, 'status': 'invalid', 'errors': ['Invalid']},
+        ]
+        response = web_session.post('/products/bulk', json.dumps(products))
+        assert response.json()[2] == {
+            'index': 2, 'status': 'invalid', 'errors': ['Invalid']
+        }
+
+    @pytest.mark.parametrize('body, headers', [
+        ('NOT-JSON', {}),
+        ('{"id": "the_odyssey"}', {}),
+        ('{"id": "the_odyssey"}\nNOT-JSON', {
+            'Content-Type': 'application/x-ndjson'
+        }),
+    ])
+    def test_create_products_fails_with_invalid_json(
+        self, gateway_service, web_session, body, headers
+    ):
+        response = web_session.post('/products/bulk', body, headers=headers)
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+
+
+class TestListProducts(object):
+    def test_can_list_products(self, gateway_service, web_session):
+        gateway_service.products_rpc.list.return_value = [
+            {
+                "in_stock": 10,
+                "maximum_speed": 5,
+                "id": "the_odyssey",
+                "passenger_capacity": 101,
+                "title": "The Odyssey"
+            }
+        ]
+        response = web_session.get('/products?offset=10&limit=1')
+        assert response.status_code == 200
+        assert gateway_service.products_rpc.list.call_args_list == [
+            call(10, 1)
+        ]
+        assert response.json() == [
+            {
+                "in_stock": 10,
+                "maximum_speed": 5,
+                "id": "the_odyssey",
+                "passenger_capacity": 101,
+                "title": "The Odyssey"
+            }
+        ]
+
+    def test_list_products_defaults(self, gateway_service, web_session):
+        gateway_service.products_rpc.list.return_value = []
+        response = web_session.get('/products')
+        assert response.status_code == 200
+        assert response.json() == []
+        assert gateway_service.products_rpc.list.call_args_list == [
+            call(0, 100)
+        ]
+
+    @pytest.mark.parametrize('query', [
+        'offset=-1', 'offset=one', 'limit=0', 'limit=1001',
+    ])
+    def test_list_products_fails_with_invalid_page(
+        self, gateway_service, web_session, query
+    ):
+        response = web_session.get('/products?{}'.format(query))
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+        assert not gateway_service.products_rpc.list.called
+
+
 class TestVerifyExistProduct(object):
     def test_can_verify_product_exist(self, gateway_service, web_session):
         gateway_service.products_rpc.exist.return_value = True
@@ -116,51 +411,62 @@ class TestCreateProduct(object):
 class TestGetOrder(object):
 
     def test_can_get_order(self, gateway_service, web_session):
-        # setup mock orders-service response:
-        gateway_service.orders_rpc.get_order.return_value = {
+        # setup mock orders-service response, already enriched with
+        # product and image details:
+        enriched_order = {
             'id': 1,
+            'version': 1,
             'order_details': [
                 {
                     'id': 1,
                     'quantity': 2,
                     'product_id': 'the_odyssey',
+                    'image':
+                        'http://example.com/airship/images/the_odyssey.jpg',
+                    'product': {
+                        'id': 'the_odyssey',
+                        'title': 'The Odyssey',
+                        'maximum_speed': 3,
+                        'in_stock': 899,
+                        'passenger_capacity': 100
+                    },
                     'price': '200.00'
                 },
                 {
                     'id': 2,
                     'quantity': 1,
                     'product_id': 'the_enigma',
+                    'image':
+                        'http://example.com/airship/images/the_enigma.jpg',
+                    'product': {
+                        'id': 'the_enigma',
+                        'title': 'The Enigma',
+                        'maximum_speed': 200,
+                        'in_stock': 1,
+                        'passenger_capacity': 4
+                    },
                     'price': '400.00'
                 }
             ]
         }
-
-        products_response = [
-            {
-                'id': 'the_odyssey',
-                'title': 'The Odyssey',
-                'maximum_speed': 3,
-                'in_stock': 899,
-                'passenger_capacity': 100
-            },
-            {
-                'id': 'the_enigma',
-                'title': 'The Enigma',
-                'maximum_speed': 200,
-                'in_stock': 1,
-                'passenger_capacity': 4
-            }
-        ]
-        # gateway_service.products_rpc.get.return_value = products_response.get('the_odyssey')
-        gateway_service.products_rpc.get = Mock()
-        gateway_service.products_rpc.get.side_effect =products_response
+        gateway_service.orders_rpc.get_order_enriched.return_value = (
+            enriched_order)
 
         # call the gateway service to get order #1
         response = web_session.get('/orders/1')
         assert response.status_code == 200
-        gateway_service.products_rpc.get.assert_has_calls([call('the_odyssey'), call('the_enigma')], any_order=True)
+        assert enriched_order == response.json()
 
-        expected_response = {
+        # the order is read in a single call
+        assert [call(1)] == (
+            gateway_service.orders_rpc.get_order_enriched.call_args_list)
+        assert not gateway_service.orders_rpc.get_order.called
+        assert not gateway_service.products_rpc.get_many.called
+
+    def test_can_get_order_with_missing_product(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.get_order_enriched.return_value = {
             'id': 1,
             'order_details': [
                 {
@@ -169,46 +475,43 @@ class TestGetOrder(object):
                     'product_id': 'the_odyssey',
                     'image':
                         'http://example.com/airship/images/the_odyssey.jpg',
-                    'product': {
-                        'id': 'the_odyssey',
-                        'title': 'The Odyssey',
-                        'maximum_speed': 3,
-                        'in_stock': 899,
-                        'passenger_capacity': 100
-                    },
                     'price': '200.00'
-                },
+                }
+            ]
+        }
+
+        response = web_session.get('/orders/1')
+        assert response.status_code == 200
+        assert response.json() == {
+            'id': 1,
+            'order_details': [
                 {
-                    'id': 2,
-                    'quantity': 1,
-                    'product_id': 'the_enigma',
+                    'id': 1,
+                    'quantity': 2,
+                    'product_id': 'the_odyssey',
                     'image':
-                        'http://example.com/airship/images/the_enigma.jpg',
-                    'product': {
-                        'id': 'the_enigma',
-                        'title': 'The Enigma',
-                        'maximum_speed': 200,
-                        'in_stock': 1,
-                        'passenger_capacity': 4
-                    },
-                    'price': '400.00'
+                        'http://example.com/airship/images/the_odyssey.jpg',
+                    'price': '200.00'
                 }
             ]
         }
-        
-        assert expected_response == response.json()
 
-        # check dependencies called as expected
-        assert [call(1)] == gateway_service.orders_rpc.get_order.call_args_list
-        assert gateway_service.products_rpc.get.call_args_list == [
-            call("the_odyssey"),  call('the_enigma')
-        ]
+    def test_get_order_fails_when_order_not_found(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.get_order_enriched.side_effect = (
+            OrderNotFound('Order with id 1 not found'))
+
+        response = web_session.get('/orders/1')
+        assert response.status_code == 404
+        assert response.json()['error'] == 'ORDER_NOT_FOUND'
+
 
 class TestGetOrders(object):
 
     def test_can_get_orders(self, gateway_service, web_session):
         # setup mock orders-service response:
-        gateway_service.orders_rpc.get_orders.return_value = [
+        gateway_service.orders_rpc.list_orders.return_value = [
                 {
                 'id': 1,
                 'order_details': [
@@ -246,26 +549,23 @@ class TestGetOrders(object):
             ]
         }
 
-        products_response = [
-            {
+        gateway_service.products_rpc.get_many.return_value = {
+            'the_odyssey': {
                 'id': 'the_odyssey',
                 'title': 'The Odyssey',
                 'maximum_speed': 3,
                 'in_stock': 899,
                 'passenger_capacity': 100
             },
-            {
+            'the_enigma': {
                 'id': 'the_enigma',
                 'title': 'The Enigma',
                 'maximum_speed': 200,
                 'in_stock': 1,
                 'passenger_capacity': 4
             }
-        ]
-        # gateway_service.products_rpc.get.return_value = products_response.get('the_odyssey')
-        gateway_service.products_rpc.get = Mock()
-        gateway_service.products_rpc.get.side_effect = products_response
-        
+        }
+
         # call the gateway service to get order
         response = web_session.get('/orders')
         assert response.status_code == 200
@@ -306,27 +606,274 @@ class TestGetOrders(object):
             ]
         }
         
-        assert expected_response == response.json()
+        assert [expected_response] == response.json()
+        assert 'X-Next-After-Id' not in response.headers
 
         # check dependencies called as expected
-        assert [call()] == gateway_service.orders_rpc.get_orders.call_args_list
-        assert gateway_service.products_rpc.get.call_args_list == [
-            call("the_odyssey"),  call('the_enigma')
+        assert [call(None, 100)] == (
+            gateway_service.orders_rpc.list_orders.call_args_list)
+        assert gateway_service.products_rpc.get_many.call_count == 1
+        (product_ids,), _ = gateway_service.products_rpc.get_many.call_args
+        assert sorted(product_ids) == ['the_enigma', 'the_odyssey']
+
+    def test_can_get_orders_page(self, gateway_service, web_session):
+        gateway_service.orders_rpc.list_orders.return_value = [
+            {'id': 6, 'order_details': []},
+            {'id': 7, 'order_details': []},
         ]
-class TestCreateOrder(object):
 
-    def test_can_create_order(self, gateway_service, web_session):
-        # setup mock products-service response:
-        gateway_service.products_rpc.exist.return_value = True
+        response = web_session.get('/orders?after_id=5&limit=2')
+        assert response.status_code == 200
+        assert response.json() == [
+            {'id': 6, 'order_details': []},
+            {'id': 7, 'order_details': []},
+        ]
+        assert response.headers['X-Next-After-Id'] == '7'
+        assert [call(5, 2)] == (
+            gateway_service.orders_rpc.list_orders.call_args_list)
+        assert not gateway_service.products_rpc.get_many.called
 
-        # setup mock create response
-        gateway_service.orders_rpc.create_order.return_value = {
-            'id': 11,
-            'order_details': []
-        }
+    def test_can_get_empty_orders_page(self, gateway_service, web_session):
+        gateway_service.orders_rpc.list_orders.return_value = []
 
-        # call the gateway service to create the order
-        response = web_session.post(
+        response = web_session.get('/orders?after_id=100')
+        assert response.status_code == 200
+        assert response.json() == []
+
+    @pytest.mark.parametrize('query', [
+        'limit=0', 'limit=1001', 'limit=ten', 'after_id=one',
+    ])
+    def test_get_orders_fails_with_invalid_page(
+        self, gateway_service, web_session, query
+    ):
+        response = web_session.get('/orders?{}'.format(query))
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+        assert not gateway_service.orders_rpc.list_orders.called
+
+    def test_get_orders_reads_products_through_cache(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.list_orders.return_value = [{
+            'id': 1,
+            'order_details': [
+                {
+                    'id': 1,
+                    'quantity': 2,
+                    'product_id': 'the_odyssey',
+                    'price': '200.00'
+                },
+                {
+                    'id': 2,
+                    'quantity': 1,
+                    'product_id': 'the_enigma',
+                    'price': '400.00'
+                }
+            ]
+        }]
+        odyssey = {
+            'id': 'the_odyssey',
+            'title': 'The Odyssey',
+            'maximum_speed': 3,
+            'in_stock': 899,
+            'passenger_capacity': 100
+        }
+        enigma = {
+            'id': 'the_enigma',
+            'title': 'The Enigma',
+            'maximum_speed': 200,
+            'in_stock': 1,
+            'passenger_capacity': 4
+        }
+        gateway_service.products_rpc.get_many.side_effect = [
+            {'the_odyssey': odyssey, 'the_enigma': enigma},
+            {'the_enigma': dict(enigma, in_stock=0)},
+        ]
+
+        with entrypoint_hook(
+            gateway_service.container, 'handle_product_updated'
+        ) as handle_product_updated:
+            web_session.get('/orders')
+            web_session.get('/orders')
+            handle_product_updated({'product_id': 'the_enigma'})
+            response = web_session.get('/orders')
+
+        assert response.status_code == 200
+        assert [
+            order_details['product']['in_stock']
+            for order_details in response.json()[0]['order_details']
+        ] == [899, 0]
+
+        # the second read is served from the cache, the third only fetches
+        # the invalidated product
+        assert gateway_service.products_rpc.get_many.call_count == 2
+        (product_ids,), _ = gateway_service.products_rpc.get_many.call_args
+        assert product_ids == ['the_enigma']
+
+    def test_get_orders_fetches_products_in_batches(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.list_orders.return_value = [{
+            'id': 1,
+            'order_details': [
+                {
+                    'id': id_,
+                    'quantity': 1,
+                    'product_id': product_id,
+                    'price': '10.00'
+                }
+                for id_, product_id in enumerate(
+                    ['the_odyssey', 'the_enigma', 'the_hindenburg'])
+            ]
+        }]
+        gateway_service.products_rpc.get_many.side_effect = (
+            lambda product_ids: {
+                product_id: {
+                    'id': product_id,
+                    'title': product_id,
+                    'maximum_speed': 3,
+                    'in_stock': 899,
+                    'passenger_capacity': 100
+                }
+                for product_id in product_ids
+            }
+        )
+
+        with config.patch({
+            'PRODUCT_BATCH_SIZE': 2, 'PRODUCT_FETCH_CONCURRENCY': 1
+        }):
+            response = web_session.get('/orders')
+
+        assert response.status_code == 200
+        assert all(
+            order_details['product']['id'] == order_details['product_id']
+            for order_details in response.json()[0]['order_details']
+        )
+        batches = [
+            product_ids for (product_ids,), _ in
+            gateway_service.products_rpc.get_many.call_args_list
+        ]
+        assert [2, 1] == [len(batch) for batch in batches]
+        assert {
+            'the_odyssey', 'the_enigma', 'the_hindenburg'
+        } == set(sum(batches, []))
+
+    def test_get_orders_gives_up_on_slow_products(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.list_orders.return_value = [{
+            'id': 1,
+            'order_details': [
+                {
+                    'id': 1,
+                    'quantity': 2,
+                    'product_id': 'the_odyssey',
+                    'price': '200.00'
+                }
+            ]
+        }]
+        gateway_service.products_rpc.get_many.side_effect = (
+            lambda product_ids: eventlet.sleep(1)
+        )
+
+        with config.patch({'PRODUCT_FETCH_TIMEOUT': 0.01}):
+            response = web_session.get('/orders')
+
+        assert response.status_code == 200
+        assert 'product' not in response.json()[0]['order_details'][0]
+
+
+class TestGetProductOrders(object):
+
+    def test_can_get_product_orders(self, gateway_service, web_session):
+        gateway_service.orders_rpc.get_orders_by_product.return_value = [
+            {
+                'id': 3,
+                'order_details': [
+                    {
+                        'id': 5,
+                        'quantity': 2,
+                        'product_id': 'the_odyssey',
+                        'price': '200.00'
+                    },
+                ]
+            }
+        ]
+        gateway_service.products_rpc.get_many.return_value = {
+            'the_odyssey': {
+                'id': 'the_odyssey',
+                'title': 'The Odyssey',
+                'maximum_speed': 3,
+                'in_stock': 899,
+                'passenger_capacity': 100
+            },
+        }
+
+        response = web_session.get('/products/the_odyssey/orders')
+        assert response.status_code == 200
+        assert response.json() == [
+            {
+                'id': 3,
+                'order_details': [
+                    {
+                        'id': 5,
+                        'quantity': 2,
+                        'product_id': 'the_odyssey',
+                        'image':
+                            'http://example.com/airship/images/'
+                            'the_odyssey.jpg',
+                        'product': {
+                            'id': 'the_odyssey',
+                            'title': 'The Odyssey',
+                            'maximum_speed': 3,
+                            'in_stock': 899,
+                            'passenger_capacity': 100
+                        },
+                        'price': '200.00'
+                    },
+                ]
+            }
+        ]
+        assert 'X-Next-After-Id' not in response.headers
+        assert [call('the_odyssey', None, 100)] == (
+            gateway_service.orders_rpc.get_orders_by_product.call_args_list)
+
+    def test_can_get_product_orders_page(self, gateway_service, web_session):
+        gateway_service.orders_rpc.get_orders_by_product.return_value = [
+            {'id': 6, 'order_details': []},
+            {'id': 9, 'order_details': []},
+        ]
+
+        response = web_session.get(
+            '/products/the_odyssey/orders?after_id=5&limit=2')
+        assert response.status_code == 200
+        assert [6, 9] == [order['id'] for order in response.json()]
+        assert response.headers['X-Next-After-Id'] == '9'
+        assert [call('the_odyssey', 5, 2)] == (
+            gateway_service.orders_rpc.get_orders_by_product.call_args_list)
+
+    @pytest.mark.parametrize('query', ['limit=0', 'after_id=one'])
+    def test_get_product_orders_fails_with_invalid_page(
+        self, gateway_service, web_session, query
+    ):
+        response = web_session.get(
+            '/products/the_odyssey/orders?{}'.format(query))
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+        assert not gateway_service.orders_rpc.get_orders_by_product.called
+
+
+class TestCreateOrder(object):
+
+    def test_can_create_order(self, gateway_service, web_session):
+        # setup mock create response
+        gateway_service.orders_rpc.create_order.return_value = {
+            'id': 11,
+            'order_details': []
+        }
+
+        # call the gateway service to create the order
+        response = web_session.post(
             '/orders',
             json.dumps({
                 'order_details': [
@@ -340,13 +887,53 @@ class TestCreateOrder(object):
         )
         assert response.status_code == 200
         assert response.json() == {'id': 11}
-        assert gateway_service.products_rpc.exist.call_args_list == [call('the_odyssey')]
         assert gateway_service.orders_rpc.create_order.call_args_list == [
             call([
                 {'product_id': 'the_odyssey', 'quantity': 3, 'price': '41.00'}
-            ])
+            ], idempotency_key=None)
         ]
 
+    def test_create_order_passes_idempotency_key(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.create_order.return_value = {
+            'id': 11,
+            'order_details': []
+        }
+
+        response = web_session.post(
+            '/orders',
+            json.dumps({
+                'order_details': [
+                    {
+                        'product_id': 'the_odyssey',
+                        'price': '41.00',
+                        'quantity': 3
+                    }
+                ]
+            }),
+            headers={'Idempotency-Key': 'retry-me'}
+        )
+        assert response.status_code == 200
+        assert response.json() == {'id': 11}
+        assert gateway_service.orders_rpc.create_order.call_args_list == [
+            call([
+                {'product_id': 'the_odyssey', 'quantity': 3, 'price': '41.00'}
+            ], idempotency_key='retry-me')
+        ]
+
+    def test_create_order_fails_with_invalid_idempotency_key(
+        self, gateway_service, web_session
+    ):
+        response = web_session.post(
+            '/orders',
+            json.dumps({'order_details': []}),
+            headers={'Idempotency-Key': 'x' * 256}
+        )
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+        assert not gateway_service.orders_rpc.create_order.called
+
     def test_create_order_fails_with_invalid_json(
         self, gateway_service, web_session
     ):
@@ -378,8 +965,9 @@ class TestCreateOrder(object):
     def test_create_order_fails_with_unknown_product(
         self, gateway_service, web_session
     ):
-        # setup mock products-service response:
-        gateway_service.products_rpc.exist.return_value = False
+        # setup mock orders-service response:
+        gateway_service.orders_rpc.create_order.side_effect = (
+            ProductNotFound('Product Id unknown'))
 
         # call the gateway service to create the order
         response = web_session.post(
@@ -397,3 +985,373 @@ class TestCreateOrder(object):
         assert response.status_code == 404
         assert response.json()['error'] == 'PRODUCT_NOT_FOUND'
         assert response.json()['message'] == 'Product Id unknown'
+
+    def test_create_order_retry_after_product_deleted(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.create_order.return_value = {
+            'id': 11,
+            'order_details': []
+        }
+        order = json.dumps({
+            'order_details': [
+                {
+                    'product_id': 'the_odyssey',
+                    'price': '41.00',
+                    'quantity': 3
+                }
+            ]
+        })
+        headers = {'Idempotency-Key': 'retry-me'}
+        response = web_session.post('/orders', order, headers=headers)
+        assert response.json() == {'id': 11}
+
+        # the product is deleted before the request is retried
+        gateway_service.products_rpc.exists_many.return_value = {
+            'the_odyssey': False
+        }
+
+        response = web_session.post('/orders', order, headers=headers)
+        assert response.status_code == 200
+        assert response.json() == {'id': 11}
+        assert gateway_service.orders_rpc.create_order.call_count == 2
+        assert not gateway_service.products_rpc.exists_many.called
+        assert not gateway_service.products_rpc.exist.called
+
+    def test_create_order_fails_when_out_of_stock(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.create_order.side_effect = (
+            ProductOutOfStock('Product ID the_odyssey is out of stock'))
+
+        response = web_session.post(
+            '/orders',
+            json.dumps({
+                'order_details': [
+                    {
+                        'product_id': 'the_odyssey',
+                        'price': '41',
+                        'quantity': 100
+                    }
+                ]
+            })
+        )
+        assert response.status_code == 409
+        assert response.json()['error'] == 'PRODUCT_OUT_OF_STOCK'
+        assert response.json()['message'] == (
+            'Product ID the_odyssey is out of stock')
+
+
+class TestUpdateOrder(object):
+
+    def test_can_update_order(self, gateway_service, web_session):
+        gateway_service.orders_rpc.update_order.return_value = {
+            'id': 11,
+            'version': 4,
+            'order_details': []
+        }
+
+        response = web_session.put(
+            '/orders/11',
+            json.dumps({
+                'version': 3,
+                'order_details': [
+                    {'id': 1, 'price': '89.99', 'quantity': 2}
+                ]
+            })
+        )
+        assert response.status_code == 200
+        assert response.json() == {'id': 11, 'version': 4}
+        assert gateway_service.orders_rpc.update_order.call_args_list == [
+            call({
+                'id': 11,
+                'version': 3,
+                'order_details': [
+                    {'id': 1, 'price': '89.99', 'quantity': 2}
+                ]
+            })
+        ]
+
+    def test_update_order_fails_on_conflict(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.update_order.side_effect = (
+            OrderConflict('Order with id 11 is at version 4, not 3'))
+
+        response = web_session.put(
+            '/orders/11',
+            json.dumps({'version': 3, 'order_details': []})
+        )
+        assert response.status_code == 409
+        assert response.json() == {
+            'error': 'ORDER_CONFLICT',
+            'message': 'Order with id 11 is at version 4, not 3'
+        }
+
+    def test_update_order_fails_when_order_not_found(
+        self, gateway_service, web_session
+    ):
+        gateway_service.orders_rpc.update_order.side_effect = (
+            OrderNotFound('Order with id 11 not found'))
+
+        response = web_session.put(
+            '/orders/11', json.dumps({'order_details': []}))
+        assert response.status_code == 404
+        assert response.json()['error'] == 'ORDER_NOT_FOUND'
+
+    def test_update_order_fails_with_invalid_data(
+        self, gateway_service, web_session
+    ):
+        response = web_session.put(
+            '/orders/11',
+            json.dumps({'order_details': [{'id': 1, 'quantity': 2}]})
+        )
+        assert response.status_code == 400
+        assert response.json()['error'] == 'VALIDATION_ERROR'
+        assert not gateway_service.orders_rpc.update_order.called
+
+
+class TestCreateOrders(object):
+
+    @pytest.fixture
+    def gateway_service(self, gateway_service):
+        gateway_service.products_rpc.exists_many.side_effect = (
+            lambda product_ids: {
+                product_id: product_id != 'the_enigma'
+                for product_id in product_ids
+            }
+        )
+        order_ids = iter(range(1, 100))
+        gateway_service.orders_rpc.create_orders.side_effect = (
+            lambda orders: [
+                {'status': 'created', 'order': {'id': next(order_ids)}}
+                for order in orders
+            ]
+        )
+        return gateway_service
+
+    @pytest.fixture
+    def orders(self):
+        return [
+            {'order_details': [
+                {'product_id': 'the_odyssey', 'price': '41.00', 'quantity': 3}
+            ]},
+            {'order_details': [{'product_id': 'the_odyssey'}]},
+            {'order_details': [
+                {'product_id': 'the_enigma', 'price': '5.99', 'quantity': 1}
+            ]},
+            {'order_details': [
+                {'product_id': 'the_odyssey', 'price': '41.00', 'quantity': 1}
+            ]},
+        ]
+
+    expected_results = [
+        {'index': 0, 'status': 'created', 'id': 1},
+        {
+            'index': 1,
+            'status': 'invalid',
+            'errors': {'order_details': {0: {
+                'price': ['Missing data for required field.'],
+                'quantity': ['Missing data for required field.'],
+            }}},
+        },
+        {
+            'index': 2,
+            'status': 'product_not_found',
+            'error': 'Product Id the_enigma',
+        },
+        {'index': 3, 'status': 'created', 'id': 2},
+    ]
+
+    def read_results(self, response):
+        return [
+            json.loads(line, object_hook=lambda obj: {
+                int(key) if key.isdigit() else key: value
+                for key, value in obj.items()
+            })
+            for line in response.text.splitlines()
+        ]
+
+    def test_can_create_orders_from_json_array(
+        self, gateway_service, web_session, orders
+    ):
+        response = web_session.post('/orders/bulk', json.dumps(orders))
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith(
+            'application/x-ndjson')
+        assert self.read_results(response) == self.expected_results
+        assert gateway_service.products_rpc.exists_many.call_count == 1
+        assert gateway_service.orders_rpc.create_orders.call_args_list == [
+            call([
+                {'order_details': [{
+                    'product_id': 'the_odyssey',
+                    'price': '41.00',
+                    'quantity': quantity
+                }]}
+                for quantity in (3, 1)
+            ])
+        ]
+
+    def test_can_create_orders_from_ndjson(
+        self, gateway_service, web_session, orders
+    ):
+        response = web_session.post(
+            '/orders/bulk',
+            '\n'.join(json.dumps(order) for order in orders),
+            headers={'Content-Type': 'application/x-ndjson'}
+        )
+        assert response.status_code == 200
+        assert self.read_results(response) == self.expected_results
+
+    def test_create_orders_in_batches(
+        self, gateway_service, web_session, orders
+    ):
+        with config.patch({'ORDER_IMPORT_BATCH_SIZE': 2}):
+            response = web_session.post('/orders/bulk', json.dumps(orders))
+
+        assert self.read_results(response) == self.expected_results
+        assert gateway_service.orders_rpc.create_orders.call_count == 2
+
+    def test_create_orders_reports_out_of_stock(
+        self, gateway_service, web_session, orders
+    ):
+        gateway_service.orders_rpc.create_orders.side_effect = None
+        gateway_service.orders_rpc.create_orders.return_value = [
+            {'status': 'created', 'order': {'id': 1}},
+            {'status': 'out_of_stock', 'error': 'Product ID the_odyssey'},
+        ]
+        response = web_session.post('/orders/bulk', json.dumps(orders))
+
+        assert self.read_results(response)[3] == {
+            'index': 3,
+            'status': 'out_of_stock',
+            'error': 'Product ID the_odyssey',
+        }
+
+    def test_create_orders_maps_errors_of_later_batches(
+        self, gateway_service, web_session, orders
+    ):
+        gateway_service.orders_rpc.create_orders.side_effect = [
+            [{'status': 'created', 'order': {'id': 1}}],
+            ProductNotFound('Product Id the_odyssey'),
+        ]
+        with config.patch({'ORDER_IMPORT_BATCH_SIZE': 2}):
+            response = web_session.post('/orders/bulk', json.dumps(orders))
+
+        assert response.status_code == 404
+        assert response.json() == {
+            'error': 'PRODUCT_NOT_FOUND',
+            'message': 'Product Id the_odyssey',
+        }
+
+    def test_create_orders_fails_with_invalid_json(
+        self, gateway_service, web_session
+    ):
+        response = web_session.post('/orders/bulk', 'NOT-JSON')
+        assert response.status_code == 400
+        assert response.json()['error'] == 'BAD_REQUEST'
+        assert not gateway_service.orders_rpc.create_orders.called
+
+
+class TestGetMetrics(object):
+
+    @pytest.fixture(autouse=True)
+    def registry(self):
+        metrics.registry.clear()
+        yield
+        metrics.registry.clear()
+
+    @pytest.fixture
+    def service_metrics(self, gateway_service):
+        def snapshot(service_name):
+            return [{
+                'name': 'entrypoint_in_flight',
+                'type': 'gauge',
+                'help': 'Entrypoint workers currently running.',
+                'samples': [{
+                    'labels': {
+                        'service': service_name, 'entrypoint': 'get_metrics'
+                    },
+                    'value': 1,
+                }],
+            }]
+
+        for service_name in ('orders', 'products'):
+            rpc = getattr(gateway_service, '{}_rpc'.format(service_name))
+            rpc.get_metrics.call_async.return_value = Mock(
+                result=Mock(return_value=snapshot(service_name)))
+        return gateway_service
+
+    def test_can_get_metrics(self, service_metrics, web_session):
+        service_metrics.products_rpc.get.side_effect = (
+            ProductNotFound('missing'))
+        web_session.get('/products/foo')
+
+        response = web_session.get('/metrics')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+
+        lines = response.text.splitlines()
+        assert (
+            'entrypoint_duration_seconds_count'
+            '{service="gateway",entrypoint="get_product"} 1'
+        ) in lines
+        assert (
+            'entrypoint_errors_total{service="gateway",'
+            'entrypoint="get_product",error="ProductNotFound"} 1'
+        ) in lines
+        assert lines.count('# TYPE entrypoint_in_flight gauge') == 1
+        for service_name in ('gateway', 'orders', 'products'):
+            assert (
+                'entrypoint_in_flight{{service="{}",'
+                'entrypoint="get_metrics"}} 1'.format(service_name)
+            ) in lines
+        assert 'metrics_scrape_success{service="orders"} 1' in lines
+        assert 'metrics_scrape_success{service="products"} 1' in lines
+
+    def test_metrics_of_failing_services_are_left_out(
+        self, service_metrics, web_session
+    ):
+        service_metrics.orders_rpc.get_metrics.call_async.return_value = (
+            Mock(result=Mock(side_effect=ValueError('boom'))))
+
+        response = web_session.get('/metrics')
+        assert response.status_code == 200
+
+        lines = response.text.splitlines()
+        assert 'metrics_scrape_success{service="orders"} 0' in lines
+        assert 'metrics_scrape_success{service="products"} 1' in lines
+        assert not any('service="orders",entrypoint' in line
+                       for line in lines)
+
+
+class TestTracing(object):
+
+    @pytest.fixture
+    def trace_file(self, tmpdir, test_config):
+        trace_file = tmpdir.join('spans.jsonl')
+        with config.patch({'TRACE_FILE': str(trace_file)}):
+            yield trace_file
+
+    def test_requests_continue_the_trace_of_the_client(
+        self, trace_file, gateway_service, web_session
+    ):
+        gateway_service.products_rpc.get.return_value = {
+            "in_stock": 10,
+            "maximum_speed": 5,
+            "id": "the_odyssey",
+            "passenger_capacity": 101,
+            "title": "The Odyssey"
+        }
+        trace_id = '0af7651916cd43dd8448eb211c80319c'
+        response = web_session.get('/products/the_odyssey', headers={
+            'traceparent': '00-{}-b7ad6b7169203331-01'.format(trace_id)
+        })
+        assert response.status_code == 200
+
+        get_extension(gateway_service.container, Tracer).flush()
+        request = json.loads(trace_file.read())
+        span, = request['resourceSpans'][0]['scopeSpans'][0]['spans']
+        assert span['name'] == 'gateway.get_product'
+        assert span['traceId'] == trace_id
+        assert span['parentSpanId'] == 'b7ad6b7169203331'
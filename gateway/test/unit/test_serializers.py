@@ -0,0 +1,38 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+from gateway import serializers
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def dumps(request):
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+    return getattr(serializers, '_dumps_{}'.format(request.param))
+
+
+def test_dumps_returns_bytes(dumps):
+    assert isinstance(dumps({'id': 1}), bytes)
+
+
+def test_dumps_decimals_as_strings(dumps):
+    assert {'price': '99.99', 'quantity': 2} == json.loads(
+        dumps({'price': Decimal('99.99'), 'quantity': 2}))
+
+
+def test_dumps_integer_keys_as_strings(dumps):
+    assert {'0': {'price': ['Missing data for required field.']}} == (
+        json.loads(dumps(
+            {0: {'price': ['Missing data for required field.']}})))
+
+
+def test_dumps_non_ascii(dumps):
+    assert {'title': 'Zeppelin Ü'} == json.loads(
+        dumps({'title': 'Zeppelin Ü'}).decode('utf-8'))
+
+
+def test_dumps_fails_with_unserializable_object(dumps):
+    with pytest.raises(TypeError):
+        dumps({'order': object()})
@@ -0,0 +1,69 @@
+"""order totals
+
+Revision ID: 3a7d5e9b1f62
+Revises: e7b2f4c90d18
+Create Date: 2026-10-17 15:02:48.117530
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3a7d5e9b1f62'
+down_revision = 'e7b2f4c90d18'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 10000
+
+BACKFILL = sa.text(
+    "UPDATE orders SET "
+    "total_amount = ("
+    "SELECT COALESCE(SUM(price * quantity), 0) FROM order_details "
+    "WHERE order_details.order_id = orders.id), "
+    "item_count = ("
+    "SELECT COALESCE(SUM(quantity), 0) FROM order_details "
+    "WHERE order_details.order_id = orders.id) "
+    "WHERE orders.id > :start AND orders.id <= :end"
+)
+
+
+def upgrade():
+    op.add_column(
+        "orders",
+        sa.Column(
+            "total_amount", sa.DECIMAL(18, 2), nullable=False,
+            server_default="0"
+        )
+    )
+    op.add_column(
+        "orders",
+        sa.Column(
+            "item_count", sa.Integer(), nullable=False, server_default="0"
+        )
+    )
+    # the backfill runs in batches of ids, each committed on its own, and
+    # the index is built without blocking writes to the table
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        max_id = connection.execute(
+            sa.text("SELECT MAX(id) FROM orders")).scalar() or 0
+        for start in range(0, max_id, BACKFILL_BATCH_SIZE):
+            connection.execute(BACKFILL, {
+                "start": start, "end": start + BACKFILL_BATCH_SIZE})
+        op.create_index(
+            "ix_orders_created_at", "orders", ["created_at"],
+            postgresql_include=["total_amount", "item_count"],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_orders_created_at", table_name="orders",
+            postgresql_concurrently=True
+        )
+    op.drop_column("orders", "item_count")
+    op.drop_column("orders", "total_amount")
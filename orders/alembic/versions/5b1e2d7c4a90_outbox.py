@@ -0,0 +1,35 @@
+"""outbox
+
+Revision ID: 5b1e2d7c4a90
+Revises: dd33cb03d01f
+Create Date: 2026-10-17 10:12:41.184902
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5b1e2d7c4a90'
+down_revision = 'dd33cb03d01f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "outbox",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("event_type", sa.String(64), nullable=False),
+        sa.Column("payload", sa.JSON(), nullable=False),
+        sa.Column("sent_at", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id")
+    )
+    op.create_index("ix_outbox_sent_at", "outbox", ["sent_at"])
+
+
+def downgrade():
+    op.drop_index("ix_outbox_sent_at", table_name="outbox")
+    op.drop_table("outbox")
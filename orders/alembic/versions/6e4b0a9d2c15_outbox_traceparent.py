@@ -0,0 +1,27 @@
+"""outbox traceparent
+
+Revision ID: 6e4b0a9d2c15
+Revises: 9c2f61b8d7a3
+Create Date: 2026-10-17 20:34:51.226190
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '6e4b0a9d2c15'
+down_revision = '9c2f61b8d7a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "outbox",
+        sa.Column("traceparent", sa.String(length=55), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("outbox", "traceparent")
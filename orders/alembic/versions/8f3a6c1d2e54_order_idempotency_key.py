@@ -0,0 +1,32 @@
+"""order idempotency key
+
+Revision ID: 8f3a6c1d2e54
+Revises: 5b1e2d7c4a90
+Create Date: 2026-10-17 11:40:05.513218
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8f3a6c1d2e54'
+down_revision = '5b1e2d7c4a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "orders",
+        sa.Column("idempotency_key", sa.String(255), nullable=True)
+    )
+    op.create_index(
+        "ix_orders_idempotency_key", "orders", ["idempotency_key"],
+        unique=True
+    )
+
+
+def downgrade():
+    op.drop_index("ix_orders_idempotency_key", table_name="orders")
+    op.drop_column("orders", "idempotency_key")
@@ -0,0 +1,29 @@
+"""order version
+
+Revision ID: 9c2f61b8d7a3
+Revises: 3a7d5e9b1f62
+Create Date: 2026-10-17 15:48:12.904417
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9c2f61b8d7a3'
+down_revision = '3a7d5e9b1f62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "orders",
+        sa.Column(
+            "version", sa.Integer(), nullable=False, server_default="1"
+        )
+    )
+
+
+def downgrade():
+    op.drop_column("orders", "version")
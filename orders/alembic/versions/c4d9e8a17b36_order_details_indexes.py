@@ -0,0 +1,42 @@
+"""order details indexes
+
+Revision ID: c4d9e8a17b36
+Revises: 8f3a6c1d2e54
+Create Date: 2026-10-17 13:05:22.947310
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c4d9e8a17b36'
+down_revision = '8f3a6c1d2e54'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the indexes without locking out writes to a populated table.
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_order_details_order_id", "order_details", ["order_id"],
+            postgresql_concurrently=True
+        )
+        op.create_index(
+            "ix_order_details_product_id_created_at", "order_details",
+            ["product_id", "created_at"],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_order_details_product_id_created_at",
+            table_name="order_details", postgresql_concurrently=True
+        )
+        op.drop_index(
+            "ix_order_details_order_id",
+            table_name="order_details", postgresql_concurrently=True
+        )
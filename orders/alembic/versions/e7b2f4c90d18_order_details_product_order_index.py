@@ -0,0 +1,32 @@
+"""order details product order index
+
+Revision ID: e7b2f4c90d18
+Revises: c4d9e8a17b36
+Create Date: 2026-10-17 14:21:37.602193
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e7b2f4c90d18'
+down_revision = 'c4d9e8a17b36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_order_details_product_id_order_id", "order_details",
+            ["product_id", "order_id"],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_order_details_product_id_order_id",
+            table_name="order_details", postgresql_concurrently=True
+        )
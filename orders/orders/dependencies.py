@@ -0,0 +1,68 @@
+import json
+import logging
+
+from nameko import config
+from nameko.extensions import DependencyProvider
+import redis
+
+
+REDIS_URI_KEY = 'REDIS_URI'
+IDEMPOTENCY_KEY_TTL_KEY = 'IDEMPOTENCY_KEY_TTL'
+
+DEFAULT_IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyCacheWrapper:
+    """
+    Idempotency key cache
+
+    Remembers the order created for each client idempotency key, so a
+    retried request can be answered with the original order without
+    touching the database. Entries expire after `ttl` seconds; the
+    ``orders.idempotency_key`` unique index stays the source of truth, so
+    Redis errors are logged and treated as cache misses.
+
+    """
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def _format_key(self, idempotency_key):
+        return 'orders:idempotency:{}'.format(idempotency_key)
+
+    def get(self, idempotency_key):
+        try:
+            order = self.client.get(self._format_key(idempotency_key))
+        except redis.RedisError:
+            logger.warning(
+                "Failed to read idempotency key %s", idempotency_key,
+                exc_info=True)
+            return None
+        if order is not None:
+            return json.loads(order.decode('utf-8'))
+
+    def set(self, idempotency_key, order):
+        try:
+            self.client.set(
+                self._format_key(idempotency_key), json.dumps(order),
+                ex=self.ttl)
+        except redis.RedisError:
+            logger.warning(
+                "Failed to store idempotency key %s", idempotency_key,
+                exc_info=True)
+
+
+class IdempotencyCache(DependencyProvider):
+
+    def setup(self):
+        self.client = redis.StrictRedis.from_url(config.get(REDIS_URI_KEY))
+
+    def get_dependency(self, worker_ctx):
+        return IdempotencyCacheWrapper(
+            self.client,
+            config.get(IDEMPOTENCY_KEY_TTL_KEY, DEFAULT_IDEMPOTENCY_KEY_TTL)
+        )
@@ -0,0 +1,19 @@
+from nameko import config
+from nameko.timer import Timer
+
+
+class ConfigTimer(Timer):
+    """ Overrides `Timer` to read its interval from config when the service
+    is set up, rather than when the service class is defined.
+    """
+
+    def __init__(self, interval_key, default_interval, **kwargs):
+        self.interval_key = interval_key
+        self.default_interval = default_interval
+        super(ConfigTimer, self).__init__(default_interval, **kwargs)
+
+    def setup(self):
+        self.interval = config.get(self.interval_key, self.default_interval)
+
+
+timer = ConfigTimer.decorator
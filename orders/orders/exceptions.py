@@ -1,2 +1,37 @@
+from nameko.exceptions import registry
+
+
+def remote_error(exc_path):
+    """
+    Decorator that registers remote exception with matching ``exc_path``
+    to be deserialized to decorated exception instance, rather than
+    wrapped in ``RemoteError``.
+    """
+
+    def wrapper(exc_type):
+        registry[exc_path] = exc_type
+        return exc_type
+
+    return wrapper
+
+
 class NotFound(Exception):
     pass
+
+
+class Conflict(Exception):
+    pass
+
+
+class ProductNotFound(Exception):
+    pass
+
+
+@remote_error('products.exceptions.OutOfStock')
+class ProductOutOfStock(Exception):
+    """
+    If the products service cannot reserve stock for an order, the
+    ``RemoteError`` will be transformed and raised locally as this
+    exception instead.
+    """
+    pass
@@ -0,0 +1,10 @@
+""" Latency histograms, in-flight gauges and error counters of the
+service's entrypoints and of the RPC calls it makes.
+
+The gateway reads the `registry` snapshot through the ``get_metrics`` RPC
+and serves it with its own on ``GET /metrics``.
+"""
+from common.metrics import ServiceRegistry
+
+
+registry = ServiceRegistry()
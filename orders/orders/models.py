@@ -1,7 +1,7 @@
 import datetime
 
 from sqlalchemy import (
-    DECIMAL, Column, DateTime, ForeignKey, Integer,
+    DECIMAL, JSON, Column, DateTime, ForeignKey, Index, Integer, String,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -26,12 +26,41 @@ DeclarativeBase = declarative_base(cls=Base)
 
 class Order(DeclarativeBase):
     __tablename__ = "orders"
+    __table_args__ = (
+        # covers the date range aggregates of `get_order_stats`
+        Index(
+            "ix_orders_created_at", "created_at",
+            postgresql_include=["total_amount", "item_count"]
+        ),
+        Index("ix_orders_idempotency_key", "idempotency_key", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String(255), nullable=True)
+    # denormalized from the order details, kept in step on every write
+    total_amount = Column(
+        DECIMAL(18, 2), nullable=False, default=0, server_default="0")
+    item_count = Column(
+        Integer, nullable=False, default=0, server_default="0")
+    # bumped by every update, for optimistic concurrency control
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
 
 class OrderDetail(DeclarativeBase):
     __tablename__ = "order_details"
+    __table_args__ = (
+        Index("ix_order_details_order_id", "order_id"),
+        # also serves lookups on product_id alone
+        Index(
+            "ix_order_details_product_id_created_at",
+            "product_id", "created_at"
+        ),
+        # pages through the orders of a product in order id order
+        Index(
+            "ix_order_details_product_id_order_id",
+            "product_id", "order_id"
+        ),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     order_id = Column(
@@ -40,6 +69,21 @@ class OrderDetail(DeclarativeBase):
         nullable=False
     )
     order = relationship(Order, backref="order_details")
-    product_id = Column(Integer, nullable=False)
+    product_id = Column(String, nullable=False)
     price = Column(DECIMAL(18, 2), nullable=False)
     quantity = Column(Integer, nullable=False)
+
+
+class OutboxEvent(DeclarativeBase):
+    """ An event waiting to be published, written in the same transaction
+    as the change it announces. `sent_at` is set once it is published,
+and the row is deleted once it has been sent for `OUTBOX_RETENTION`
+seconds.
+    """
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_type = Column(String(64), nullable=False)
+    payload = Column(JSON, nullable=False)
+    traceparent = Column(String(55), nullable=True)
+    sent_at = Column(DateTime, nullable=True, index=True)
@@ -10,4 +10,12 @@ class OrderDetailSchema(Schema):
 
 class OrderSchema(Schema):
     id = fields.Int(required=True)
+    version = fields.Int()
     order_details = fields.Nested(OrderDetailSchema, many=True)
+
+
+# Schema instances keep no state between calls (marshmallow builds a new
+# marshaller for every dump), so these are shared instead of being built,
+# nested schemas and all, on every call.
+order_schema = OrderSchema()
+orders_schema = OrderSchema(many=True)
@@ -1,17 +1,91 @@
-from nameko.events import EventDispatcher
+import datetime
+import logging
+from collections import deque
+from decimal import Decimal
+from itertools import groupby
+
+import eventlet
+from nameko import config
+from nameko.events import BROADCAST, EventDispatcher, event_handler
+from nameko.exceptions import BadRequest
 from nameko.rpc import rpc
 from nameko_sqlalchemy import DatabaseSession
 
-from orders.exceptions import NotFound
-from orders.models import DeclarativeBase, Order, OrderDetail
-from orders.schemas import OrderSchema
+from common.cache import ProductCache
+from common.metrics import Metrics, TimedRpcProxy
+from common.tracing import Tracer
+from orders.dependencies import IdempotencyCache
+from orders.entrypoints import timer
+from orders.exceptions import (
+    Conflict, NotFound, ProductNotFound, ProductOutOfStock)
+from orders.metrics import registry
+from orders.models import DeclarativeBase, Order, OrderDetail, OutboxEvent
+from orders.schemas import order_schema, orders_schema
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+RESERVE_STOCK_KEY = 'RESERVE_STOCK'
+RESERVE_STOCK_CONCURRENCY_KEY = 'RESERVE_STOCK_CONCURRENCY'
+
+OUTBOX_RELAY_INTERVAL_KEY = 'OUTBOX_RELAY_INTERVAL'
+OUTBOX_BATCH_SIZE_KEY = 'OUTBOX_BATCH_SIZE'
+OUTBOX_RETENTION_KEY = 'OUTBOX_RETENTION'
+
+PRODUCT_IMAGE_ROOT_KEY = 'PRODUCT_IMAGE_ROOT'
+PRODUCT_FETCH_TIMEOUT_KEY = 'PRODUCT_FETCH_TIMEOUT'
+
+DEFAULT_RESERVE_STOCK_CONCURRENCY = 8
+
+DEFAULT_OUTBOX_RELAY_INTERVAL = 1
+DEFAULT_OUTBOX_BATCH_SIZE = 100
+DEFAULT_OUTBOX_RETENTION = 24 * 60 * 60
+DEFAULT_PRODUCT_FETCH_TIMEOUT = 5
+
+
+logger = logging.getLogger(__name__)
+
+
 class OrdersService:
     name = 'orders'
 
     db = DatabaseSession(DeclarativeBase)
     event_dispatcher = EventDispatcher()
+    products_rpc = TimedRpcProxy('products', registry)
+    idempotency_cache = IdempotencyCache()
+    product_cache = ProductCache()
+    metrics = Metrics(registry)
+    tracer = Tracer()
+
+    @rpc
+    def get_metrics(self):
+        return self.metrics.snapshot()
+
+    @event_handler(
+        'products', 'product_updated',
+        handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_product_updated(self, payload):
+        self.product_cache.invalidate(payload['product_id'])
+
+    @event_handler(
+        'products', 'product_deleted',
+        handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_product_deleted(self, payload):
+        self.product_cache.invalidate(payload['product_id'])
+
+    @event_handler(
+        'products', 'products_updated',
+        handler_type=BROADCAST, reliable_delivery=False
+    )
+    def handle_products_updated(self, payload):
+        for product_id in payload['product_ids']:
+            self.product_cache.invalidate(product_id)
 
     @rpc
     def get_order(self, order_id):
@@ -26,11 +100,91 @@ class OrdersService:
         if not order:
             raise NotFound('Order with id {} not found'.format(order_id))
 
-        return OrderSchema().dump(order).data
+        return order_schema.dump(order).data
 
     @rpc
-    def create_order(self, order_details):
+    def get_order_enriched(self, order_id):
+        """ Returns the order with the ``product`` and ``image`` URL of each
+        order detail filled in, ready to be served.
+
+        Products are read through the product cache, and those missing
+        from it with one `products.get_many` call, so a caller gets the
+        finished order in a single round trip. Details whose product no
+        longer exists, or could not be fetched within
+        `PRODUCT_FETCH_TIMEOUT` seconds, are left without a ``product``.
+        """
+        orders = self._read_orders(
+            select(Order.id).where(Order.id == order_id))
+        if not orders:
+            raise NotFound('Order with id {} not found'.format(order_id))
+        order = order_schema.dump(orders[0]).data
+
+        products = self._get_products(list({
+            order_detail['product_id']
+            for order_detail in order['order_details']
+        }))
+        image_root = config[PRODUCT_IMAGE_ROOT_KEY]
+        for order_detail in order['order_details']:
+            product_id = order_detail['product_id']
+            if product_id in products:
+                order_detail['product'] = products[product_id]
+            order_detail['image'] = '{}/{}.jpg'.format(image_root, product_id)
+
+        return order
+
+    def _get_products(self, product_ids):
+        products = self.product_cache.get_many(product_ids)
+        missing_ids = [
+            product_id for product_id in product_ids
+            if product_id not in products
+        ]
+        if not missing_ids:
+            return products
+
+        timeout = config.get(
+            PRODUCT_FETCH_TIMEOUT_KEY, DEFAULT_PRODUCT_FETCH_TIMEOUT)
+        with eventlet.Timeout(timeout, False):
+            fetched = self.products_rpc.get_many(missing_ids)
+            self.product_cache.set_many(fetched)
+            products.update(fetched)
+            return products
+        logger.warning("Timed out fetching products after %ss", timeout)
+        return products
+
+    @rpc
+    def create_order(self, order_details, idempotency_key=None):
+        """ Creates an order from `order_details`.
+
+        A request repeating the `idempotency_key` of an earlier one returns
+        the order that request created, without storing another order,
+        reserving stock, publishing an event or checking its products
+        still exist.
+        """
+        if idempotency_key is not None:
+            order = self._get_idempotent_order(idempotency_key)
+            if order is not None:
+                return order
+
+        product_ids_quantities = self._sum_quantities(order_details)
+
+        # check the order product ids are valid, all in a single call
+        exists = self.products_rpc.exists_many(list(product_ids_quantities))
+        for product_id in product_ids_quantities:
+            if not exists.get(product_id):
+                raise ProductNotFound("Product Id {}".format(product_id))
+
+        # Reserve stock for every line before the order is stored, so an
+        # order that would oversell a product is never created.
+        # Note - this may raise `ProductOutOfStock`
+        stock_reserved = config.get(RESERVE_STOCK_KEY, False)
+        if stock_reserved:
+            self.products_rpc.reserve_stock(product_ids_quantities)
+
+        total_amount, item_count = self._total(order_details)
         order = Order(
+            idempotency_key=idempotency_key,
+            total_amount=total_amount,
+            item_count=item_count,
             order_details=[
                 OrderDetail(
                     product_id=order_detail['product_id'],
@@ -41,31 +195,367 @@ class OrdersService:
             ]
         )
         self.db.add(order)
+        try:
+            # flush to assign the ids the event payload needs
+            self.db.flush()
+            order = order_schema.dump(order).data
+            self._add_order_created_events([order], stock_reserved)
+            self.db.commit()
+        except IntegrityError:
+            # a concurrent request with the same idempotency key won
+            self.db.rollback()
+            if stock_reserved:
+                self.products_rpc.release_stock(product_ids_quantities)
+            if idempotency_key is None:
+                raise
+            order = self._get_idempotent_order(idempotency_key)
+            if order is None:
+                raise
+            return order
+        except Exception:
+            if stock_reserved:
+                self.products_rpc.release_stock(product_ids_quantities)
+            raise
+
+        if idempotency_key is not None:
+            self.idempotency_cache.set(idempotency_key, order)
+        return order
+
+    def _get_idempotent_order(self, idempotency_key):
+        order = self.idempotency_cache.get(idempotency_key)
+        if order is None:
+            # the cache entry may have expired or been evicted
+            stored = (
+                self.db.query(Order)
+                .options(joinedload(Order.order_details))
+                .filter(Order.idempotency_key == idempotency_key)
+                .first()
+            )
+            if stored is not None:
+                order = order_schema.dump(stored).data
+                self.idempotency_cache.set(idempotency_key, order)
+        return order
+
+    @rpc
+    def create_orders(self, orders):
+        """ Creates many orders in a single transaction.
+
+        Each of `orders` holds the ``order_details`` taken by
+        `create_order`. Returns one result per order, in order: either
+        ``{'status': 'created', 'order': ...}``, or ``{'status':
+        'out_of_stock', 'error': ...}`` for an order whose stock could not
+        be reserved (that order is not created).
+        """
+        stock_reserved = config.get(RESERVE_STOCK_KEY, False)
+        quantities = [
+            self._sum_quantities(order['order_details']) for order in orders
+        ]
+
+        results = [None] * len(orders)
+        if stock_reserved:
+            results = self._reserve_stock_many(quantities)
+        created = [
+            index for index, result in enumerate(results) if result is None
+        ]
+
+        try:
+            order_ids = self._insert_orders(
+                [orders[index]['order_details'] for index in created])
+            new_orders = {}
+            if order_ids:
+                new_orders = {
+                    order['id']: order
+                    for order in orders_schema.dump(
+                        self._read_orders(
+                            select(Order.id).where(Order.id.in_(order_ids)))
+                    ).data
+                }
+            self._add_order_created_events(
+                [new_orders[order_id] for order_id in order_ids],
+                stock_reserved
+            )
+            self.db.commit()
+        except Exception:
+            if stock_reserved and created:
+                self.products_rpc.release_stock(
+                    self._merge_quantities(quantities[index]
+                                           for index in created))
+            raise
+
+        for index, order_id in zip(created, order_ids):
+            results[index] = {
+                'status': 'created', 'order': new_orders[order_id]}
+
+        return results
+
+    def _add_order_created_events(self, orders, stock_reserved):
+        """ Queues an ``order_created`` event per order in the outbox, to
+        be committed with the orders and published by `relay_outbox`.
+        """
+        if orders:
+            self.db.execute(insert(OutboxEvent), [
+                {
+                    'event_type': 'order_created',
+                    'payload': {
+                        'order': order,
+                        'stock_reserved': stock_reserved,
+                    },
+                    'traceparent': self.tracer.traceparent,
+                }
+                for order in orders
+            ])
+
+    @timer(OUTBOX_RELAY_INTERVAL_KEY, DEFAULT_OUTBOX_RELAY_INTERVAL)
+    def relay_outbox(self):
+        """ Publishes the events waiting in the outbox, oldest first.
+
+        Events are taken in batches of `OUTBOX_BATCH_SIZE`, each batch is
+        published (every dispatch waits for its publisher confirm) and
+        then marked sent. Rows locked by another instance's relay are
+        skipped. An event may be published again if the relay dies between
+        publishing and marking it sent, so consumers must tolerate
+        duplicates.
+
+        Events sent more than `OUTBOX_RETENTION` seconds ago are then
+        deleted.
+        """
+        batch_size = config.get(
+            OUTBOX_BATCH_SIZE_KEY, DEFAULT_OUTBOX_BATCH_SIZE)
+        retention = config.get(
+            OUTBOX_RETENTION_KEY, DEFAULT_OUTBOX_RETENTION)
+
+        while True:
+            events = (
+                self.db.query(OutboxEvent.id, OutboxEvent.event_type,
+                              OutboxEvent.payload, OutboxEvent.traceparent)
+                .filter(OutboxEvent.sent_at.is_(None))
+                .order_by(OutboxEvent.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            if not events:
+                break
+
+            for event in events:
+                # handlers of the event continue the trace of the worker
+                # that queued it, not the relay's
+                with self.tracer.continued(event.traceparent):
+                    self.event_dispatcher(event.event_type, event.payload)
+
+            self.db.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_([event.id for event in events]))
+                .values(sent_at=datetime.datetime.utcnow())
+            )
+            self.db.commit()
+
+            if len(events) < batch_size:
+                break
+
+        sent_before = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=retention))
+        self.db.execute(
+            delete(OutboxEvent).where(OutboxEvent.sent_at < sent_before))
         self.db.commit()
 
-        order = OrderSchema().dump(order).data
+    def _total(self, order_details):
+        """ Returns the total amount and item count of `order_details`.
+        """
+        total_amount = sum(
+            Decimal(str(order_detail['price'])) * order_detail['quantity']
+            for order_detail in order_details
+        )
+        item_count = sum(
+            order_detail['quantity'] for order_detail in order_details)
+        return total_amount, item_count
 
-        self.event_dispatcher('order_created', {
-            'order': order,
-        })
+    def _sum_quantities(self, order_details):
+        return self._merge_quantities(
+            {order_detail['product_id']: order_detail['quantity']}
+            for order_detail in order_details
+        )
 
-        return order
+    def _merge_quantities(self, product_ids_quantities):
+        merged = {}
+        for quantities in product_ids_quantities:
+            for product_id, quantity in quantities.items():
+                merged[product_id] = merged.get(product_id, 0) + quantity
+        return merged
+
+    def _reserve_stock_many(self, quantities):
+        """ Reserves stock for every order, with up to
+        `RESERVE_STOCK_CONCURRENCY` reservations in flight at once.
+
+        Returns a list holding ``None`` for each reserved order and an
+        ``out_of_stock`` result for the others. Any other failure stops
+        further reservations, releases the ones that were made and is
+        re-raised.
+        """
+        concurrency = config.get(
+            RESERVE_STOCK_CONCURRENCY_KEY, DEFAULT_RESERVE_STOCK_CONCURRENCY)
+
+        results = [None] * len(quantities)
+        reserved = []
+        errors = []
+        in_flight = deque()
+
+        def collect():
+            index, reply = in_flight.popleft()
+            try:
+                reply.result()
+            except ProductOutOfStock as exc:
+                results[index] = {'status': 'out_of_stock', 'error': str(exc)}
+            except Exception as exc:
+                errors.append(exc)
+            else:
+                reserved.append(index)
+
+        for index, product_quantities in enumerate(quantities):
+            if len(in_flight) >= concurrency:
+                collect()
+            if errors:
+                break
+            in_flight.append((
+                index,
+                self.products_rpc.reserve_stock.call_async(product_quantities)
+            ))
+        while in_flight:
+            collect()
+
+        if errors:
+            if reserved:
+                self.products_rpc.release_stock(self._merge_quantities(
+                    quantities[index] for index in reserved))
+            raise errors[0]
+        return results
+
+    def _insert_orders(self, orders):
+        """ Inserts orders, given as lists of order details, returning
+        their ids.
+
+        On PostgreSQL the order ids are taken from the sequence up front and
+        all the orders are inserted with one multi-row INSERT, elsewhere
+        with one INSERT each. Order details are always inserted with a
+        single executemany.
+        """
+        if not orders:
+            return []
+
+        now = datetime.datetime.utcnow()
+        timestamps = {'created_at': now, 'updated_at': now}
+        rows = []
+        for details in orders:
+            total_amount, item_count = self._total(details)
+            rows.append(dict(
+                timestamps, total_amount=total_amount, item_count=item_count))
+        if self.db.bind.dialect.name == 'postgresql':
+            # the rows of INSERT .. RETURNING are not guaranteed to come
+            # back in the order of the VALUES, so the ids are allocated
+            # before inserting rather than read back after
+            order_ids = list(self.db.execute(
+                select(func.nextval(
+                    func.pg_get_serial_sequence(Order.__tablename__, 'id')
+                )).select_from(func.generate_series(1, len(rows)))
+            ).scalars())
+            self.db.execute(insert(Order).values([
+                dict(row, id=order_id)
+                for order_id, row in zip(order_ids, rows)
+            ]))
+        else:
+            order_ids = [
+                self.db.execute(
+                    insert(Order).values(row)
+                ).inserted_primary_key[0]
+                for row in rows
+            ]
+
+        order_details = [
+            dict(
+                timestamps,
+                order_id=order_id,
+                product_id=order_detail['product_id'],
+                price=order_detail['price'],
+                quantity=order_detail['quantity'],
+            )
+            for order_id, details in zip(order_ids, orders)
+            for order_detail in details
+        ]
+        if order_details:
+            self.db.execute(insert(OrderDetail), order_details)
+        return order_ids
 
     @rpc
     def update_order(self, order):
-        order_details = {
-            order_details['id']: order_details
-            for order_details in order['order_details']
+        """ Updates the price and quantity of the order details in `order`.
+
+        Details left out of `order` are unchanged. If `order` carries a
+        ``version`` it must be the current version of the order, otherwise
+        `Conflict` is raised. The order row is written with a single
+        UPDATE conditional on the version that was read, so an update
+        racing with another one raises `Conflict` rather than overwriting
+        it, and the details are then written with one executemany.
+        Returns the updated order with its new version.
+        """
+        order_id = order['id']
+        stored = self._read_orders(
+            select(Order.id).where(Order.id == order_id))
+        if not stored:
+            raise NotFound('Order with id {} not found'.format(order_id))
+        stored = stored[0]
+
+        version = order.get('version', stored['version'])
+        if version != stored['version']:
+            raise Conflict('Order with id {} is at version {}, not {}'.format(
+                order_id, stored['version'], version))
+
+        changes = {
+            order_detail['id']: order_detail
+            for order_detail in order['order_details']
         }
+        unknown_ids = set(changes).difference(
+            order_detail['id'] for order_detail in stored['order_details'])
+        if unknown_ids:
+            raise NotFound('Order with id {} has no details {}'.format(
+                order_id, sorted(unknown_ids)))
 
-        order = self.db.query(Order).get(order['id'])
+        for order_detail in stored['order_details']:
+            change = changes.get(order_detail['id'])
+            if change is not None:
+                order_detail['price'] = Decimal(str(change['price']))
+                order_detail['quantity'] = change['quantity']
+        total_amount, item_count = self._total(stored['order_details'])
 
-        for order_detail in order.order_details:
-            order_detail.price = order_details[order_detail.id]['price']
-            order_detail.quantity = order_details[order_detail.id]['quantity']
+        updated = self.db.execute(
+            update(Order)
+            .where(Order.id == order_id, Order.version == version)
+            .values(
+                version=version + 1,
+                total_amount=total_amount,
+                item_count=item_count,
+            )
+        )
+        if updated.rowcount != 1:
+            raise Conflict(
+                'Order with id {} was updated concurrently'.format(order_id))
 
+        if changes:
+            self.db.execute(
+                update(OrderDetail)
+                .where(OrderDetail.id == bindparam('order_detail_id')),
+                [
+                    {
+                        'order_detail_id': order_detail_id,
+                        'price': change['price'],
+                        'quantity': change['quantity'],
+                    }
+                    for order_detail_id, change in changes.items()
+                ]
+            )
         self.db.commit()
-        return OrderSchema().dump(order).data
+
+        stored['version'] = version + 1
+        return order_schema.dump(stored).data
 
     @rpc
     def delete_order(self, order_id):
@@ -75,5 +565,136 @@ class OrdersService:
 
     @rpc
     def get_orders(self):
-        orders = self.db.query(Order).all()
-        return OrderSchema(many=True).dump(orders).data
\ No newline at end of file
+        orders = self._read_orders()
+        return orders_schema.dump(orders).data
+
+    @rpc
+    def list_orders(self, after_id=None, limit=DEFAULT_PAGE_SIZE):
+        """ Returns a page of at most `limit` orders ordered by id.
+
+        Pages are keyed on the order id rather than an offset, so fetching
+        the next page (by passing the last id seen as `after_id`) costs the
+        same however deep into the table it is.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        page = select(Order.id).order_by(Order.id).limit(limit)
+        if after_id is not None:
+            page = page.where(Order.id > after_id)
+
+        orders = self._read_orders(page)
+        return orders_schema.dump(orders).data
+
+    @rpc
+    def get_order_stats(self, since=None, until=None):
+        """ Returns the number of orders created from `since` until (but
+        not including) `until`, with their item count and revenue.
+
+        Both bounds are optional ISO 8601 timestamps, taken as UTC unless
+        they carry an offset; `BadRequest` is raised for anything else. The
+        sums are taken over the denormalized order totals with the
+        ``orders.created_at`` index, so order details are never read.
+        """
+        query = select(
+            func.count(Order.id),
+            func.coalesce(func.sum(Order.item_count), 0),
+            func.coalesce(func.sum(Order.total_amount), 0),
+        )
+        if since is not None:
+            query = query.where(
+                Order.created_at >= self._parse_timestamp('since', since))
+        if until is not None:
+            query = query.where(
+                Order.created_at < self._parse_timestamp('until', until))
+
+        order_count, item_count, revenue = self.db.execute(query).one()
+        return {
+            'order_count': order_count,
+            'item_count': item_count,
+            'revenue': '{:.2f}'.format(Decimal(str(revenue))),
+        }
+
+    def _parse_timestamp(self, name, value):
+        """ Returns the ISO 8601 timestamp `value` as a naive UTC datetime,
+        like the stored ones.
+        """
+        try:
+            timestamp = datetime.datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise BadRequest(
+                '{} must be an ISO 8601 timestamp, not {!r}'.format(
+                    name, value))
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(
+                datetime.timezone.utc).replace(tzinfo=None)
+        return timestamp
+
+    @rpc
+    def get_orders_by_product(
+        self, product_id, after_id=None, limit=DEFAULT_PAGE_SIZE
+    ):
+        """ Returns a page of at most `limit` orders containing
+        `product_id`, ordered by id.
+
+        Paged like `list_orders`. Each page is read off the
+        ``(product_id, order_id)`` index, so it costs the same however
+        many orders the product appears in.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        page = (
+            select(OrderDetail.order_id)
+            .where(OrderDetail.product_id == product_id)
+            .distinct()
+            .order_by(OrderDetail.order_id)
+            .limit(limit)
+        )
+        if after_id is not None:
+            page = page.where(OrderDetail.order_id > after_id)
+
+        orders = self._read_orders(page)
+        return orders_schema.dump(orders).data
+
+    def _read_orders(self, order_ids=None):
+        """ Reads the orders whose ids are selected by `order_ids`, or all
+        orders if it is not given.
+
+        Plain columns are read for all the orders and their details in one
+        statement, skipping ORM object construction and the identity map.
+        """
+        query = (
+            select(
+                Order.id.label('order_id'),
+                Order.version,
+                OrderDetail.id,
+                OrderDetail.product_id,
+                OrderDetail.price,
+                OrderDetail.quantity,
+            )
+            .select_from(Order)
+            .outerjoin(OrderDetail)
+            .order_by(Order.id, OrderDetail.id)
+        )
+        if order_ids is not None:
+            query = query.where(Order.id.in_(order_ids.scalar_subquery()))
+        rows = self.db.execute(query)
+
+        return [
+            {
+                'id': order_id,
+                'version': version,
+                'order_details': [
+                    {
+                        'id': row.id,
+                        'product_id': row.product_id,
+                        'price': row.price,
+                        'quantity': row.quantity,
+                    }
+                    for row in order_rows
+                    if row.id is not None
+                ],
+            }
+            for (order_id, version), order_rows in groupby(
+                rows, key=lambda row: (row.order_id, row.version)
+            )
+        ]
@@ -8,10 +8,12 @@ setup(
     packages=find_packages(exclude=['test', 'test.*']),
     install_requires=[
         'nameko==v3.0.0-rc6',
+        'nameko-examples-common==0.0.1',
         'nameko-sqlalchemy==1.5.0',
-        'alembic==1.0.10',
+        'alembic==1.9.3',
         'marshmallow==2.19.2',
         'psycopg2-binary==2.8.2',
+        'redis==3.5.3',
     ],
     extras_require={
         'dev': [
@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+
+import pytest
+from nameko import config
+from nameko.testing.services import replace_dependencies
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from orders.service import OrdersService
+
+
+@pytest.fixture
+def test_config(rabbit_config, db_url):
+    # keep the outbox relay from adding to the measured statements
+    with config.patch({
+        'DB_URIS': {'orders:Base': db_url},
+        'REDIS_URI': 'redis://localhost:6379/12',
+        'OUTBOX_RELAY_INTERVAL': 3600,
+    }):
+        yield
+
+
+@pytest.fixture
+def service_container(container_factory, test_config):
+    container = container_factory(OrdersService)
+    # products are checked and reserved by the products service, which is
+    # not what is measured
+    replace_dependencies(container, 'products_rpc')
+    container.start()
+    return container
+
+
+@pytest.fixture
+def count_statements():
+    """ Returns a context manager collecting the SQL statements emitted
+    while it is active """
+
+    @contextmanager
+    def count():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(
+                Engine, 'before_cursor_execute', before_cursor_execute)
+
+    return count
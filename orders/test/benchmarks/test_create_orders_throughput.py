@@ -0,0 +1,59 @@
+""" Compares creating orders in bulk with creating them one at a time.
+
+`create_orders` stores a whole batch in one transaction, so it has to
+emit fewer statements than `create_order`. The timings are only reported,
+as they vary too much between machines to assert on.
+"""
+import time
+
+import pytest
+from nameko.testing.services import entrypoint_hook
+
+from orders.models import Order, OrderDetail
+
+
+ORDER_COUNT = 1000
+
+
+@pytest.fixture
+def orders():
+    return [
+        {'order_details': [
+            {'product_id': 'the_odyssey', 'price': '99.99', 'quantity': 1},
+            {'product_id': 'the_enigma', 'price': '5.99', 'quantity': 8},
+        ]}
+        for _ in range(ORDER_COUNT)
+    ]
+
+
+def report(name, statements, elapsed):
+    print('{}: {} orders, {} statements, {:.3f}s, {:.0f} orders/s'.format(
+        name, ORDER_COUNT, len(statements), elapsed, ORDER_COUNT / elapsed))
+
+
+def test_create_orders_throughput(
+    service_container, count_statements, db_session, orders
+):
+    with entrypoint_hook(service_container, 'create_order') as create_order:
+        with count_statements() as single_statements:
+            start = time.time()
+            for order in orders:
+                create_order(order['order_details'])
+            single_elapsed = time.time() - start
+    report('create_order', single_statements, single_elapsed)
+
+    with entrypoint_hook(service_container, 'create_orders') as create_orders:
+        with count_statements() as bulk_statements:
+            start = time.time()
+            results = create_orders(orders)
+            bulk_elapsed = time.time() - start
+    report('create_orders', bulk_statements, bulk_elapsed)
+
+    assert ['created'] * ORDER_COUNT == [
+        result['status'] for result in results]
+    assert 2 * ORDER_COUNT == db_session.query(Order).count()
+    assert 4 * ORDER_COUNT == db_session.query(OrderDetail).count()
+
+    # without RETURNING (as on SQLite) each order is still one INSERT, but
+    # the details go in one executemany and nothing is read back per order
+    assert len(bulk_statements) < len(single_statements) / 2
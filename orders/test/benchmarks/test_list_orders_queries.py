@@ -0,0 +1,79 @@
+""" Guards the number of SQL statements emitted when listing orders.
+
+Listing must not lazy load `Order.order_details` one order at a time, so
+the statement count has to stay flat however many orders are stored.
+"""
+import time
+
+import pytest
+from nameko.testing.services import entrypoint_hook
+
+from orders.models import Order, OrderDetail
+from orders.service import MAX_PAGE_SIZE
+
+
+ORDER_COUNT = 10000
+
+
+@pytest.fixture
+def orders(db_session):
+    db_session.execute(
+        Order.__table__.insert(),
+        [{'id': id_} for id_ in range(1, ORDER_COUNT + 1)]
+    )
+    db_session.execute(
+        OrderDetail.__table__.insert(),
+        [
+            {
+                'order_id': order_id,
+                'product_id': product_id,
+                'price': 10,
+                'quantity': 1,
+            }
+            for order_id in range(1, ORDER_COUNT + 1)
+            for product_id in ('the_odyssey', 'the_enigma')
+        ]
+    )
+    db_session.commit()
+
+
+@pytest.mark.usefixtures('orders')
+def test_get_orders_statement_count(service_container, count_statements):
+    with entrypoint_hook(service_container, 'get_orders') as get_orders:
+        with count_statements() as statements:
+            start = time.time()
+            listed = get_orders()
+            elapsed = time.time() - start
+
+    print('get_orders: {} orders, {} statements, {:.3f}s'.format(
+        len(listed), len(statements), elapsed))
+
+    assert ORDER_COUNT == len(listed)
+    assert all(len(order['order_details']) == 2 for order in listed)
+    # a single SELECT joining orders to their details
+    assert len(statements) == 1
+
+
+@pytest.mark.usefixtures('orders')
+def test_list_orders_statement_count(service_container, count_statements):
+    listed = []
+    with entrypoint_hook(service_container, 'list_orders') as list_orders:
+        with count_statements() as statements:
+            start = time.time()
+            after_id = None
+            while True:
+                page = list_orders(after_id=after_id, limit=MAX_PAGE_SIZE)
+                if not page:
+                    break
+                listed.extend(page)
+                after_id = page[-1]['id']
+            elapsed = time.time() - start
+
+    pages = ORDER_COUNT // MAX_PAGE_SIZE + 1
+    print('list_orders: {} orders, {} pages, {} statements, {:.3f}s'.format(
+        len(listed), pages, len(statements), elapsed))
+
+    assert ORDER_COUNT == len(listed)
+    assert all(len(order['order_details']) == 2 for order in listed)
+    # a single SELECT per page, including the final empty one
+    assert len(statements) == pages
@@ -0,0 +1,111 @@
+""" Shows the query plans of order detail lookups before and after the
+``order_details`` indexes are created.
+
+Needs a scratch PostgreSQL database, which it empties and seeds with
+1M order details. Point ``ORDERS_BENCHMARK_POSTGRES_URI`` at it to run ::
+
+    export ORDERS_BENCHMARK_POSTGRES_URI=postgresql://localhost/bench
+    pytest test/benchmarks/test_order_details_query_plans.py -s
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session, joinedload
+
+from orders.models import DeclarativeBase, Order, OrderDetail
+
+
+POSTGRES_URI = os.getenv('ORDERS_BENCHMARK_POSTGRES_URI')
+
+ORDER_COUNT = 250000
+DETAILS_PER_ORDER = 4
+PRODUCT_COUNT = 1000
+
+pytestmark = pytest.mark.skipif(
+    not POSTGRES_URI, reason='ORDERS_BENCHMARK_POSTGRES_URI is not set')
+
+
+@pytest.fixture(scope='module')
+def engine():
+    engine = create_engine(POSTGRES_URI)
+    DeclarativeBase.metadata.drop_all(engine)
+    DeclarativeBase.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for index in OrderDetail.__table__.indexes:
+            index.drop(connection)
+        connection.execute(text(
+            "INSERT INTO orders (id, created_at, updated_at) "
+            "SELECT id, now(), now() FROM generate_series(1, :orders) id"
+        ), {'orders': ORDER_COUNT})
+        connection.execute(text(
+            "INSERT INTO order_details "
+            "(order_id, product_id, price, quantity, created_at, updated_at) "
+            "SELECT order_id, 'product_' || ((order_id * :details + line) "
+            "% :products), 9.99, 1, "
+            "now() - order_id * interval '1 second', now() "
+            "FROM generate_series(1, :orders) order_id, "
+            "generate_series(1, :details) line"
+        ), {
+            'orders': ORDER_COUNT,
+            'details': DETAILS_PER_ORDER,
+            'products': PRODUCT_COUNT,
+        })
+    yield engine
+    DeclarativeBase.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def get_order_query(session):
+    # the query `OrdersService.get_order` runs
+    return (
+        session.query(Order)
+        .select_from(Order)
+        .options(joinedload(Order.order_details))
+        .filter(Order.id == ORDER_COUNT // 2)
+        .statement
+    )
+
+
+def orders_for_product_query():
+    return (
+        select(OrderDetail.order_id)
+        .where(OrderDetail.product_id == 'product_1')
+        .order_by(OrderDetail.created_at.desc())
+        .limit(100)
+    )
+
+
+def explain(engine, query):
+    sql = str(query.compile(engine, compile_kwargs={'literal_binds': True}))
+    with engine.connect() as connection:
+        connection.execute(text('ANALYZE'))
+        rows = connection.execute(text(
+            'EXPLAIN (ANALYZE, BUFFERS) ' + sql))
+        return '\n'.join(row[0] for row in rows)
+
+
+def test_order_details_query_plans(engine):
+    session = Session(engine)
+    queries = {
+        'get_order': get_order_query(session),
+        'orders for product': orders_for_product_query(),
+    }
+
+    before = {
+        name: explain(engine, query) for name, query in queries.items()
+    }
+    with engine.begin() as connection:
+        for index in OrderDetail.__table__.indexes:
+            index.create(connection)
+    after = {
+        name: explain(engine, query) for name, query in queries.items()
+    }
+
+    for name in queries:
+        print('\n{} without indexes:\n{}'.format(name, before[name]))
+        print('\n{} with indexes:\n{}'.format(name, after[name]))
+
+    for name in queries:
+        assert 'Seq Scan on order_details' in before[name]
+        assert 'Seq Scan on order_details' not in after[name]
@@ -0,0 +1,63 @@
+""" Compares dumping orders with an `OrderSchema` built per call, as the
+service used to, and with the shared instances in `orders.schemas`.
+
+Sharing has to make single orders cheaper to dump. Dumping a page of
+orders is dominated by the per-field work instead, so there it only has to
+produce the same result. Run with ``-s`` to see the per-call timings.
+"""
+import timeit
+from decimal import Decimal
+
+from orders.schemas import OrderSchema, order_schema, orders_schema
+
+
+CALLS = 1000
+PAGE_SIZE = 100
+
+
+def make_order(order_id):
+    return {
+        'id': order_id,
+        'version': 1,
+        'order_details': [
+            {
+                'id': index,
+                'product_id': 'the_odyssey',
+                'price': Decimal('99.99'),
+                'quantity': 1,
+            }
+            for index in range(2)
+        ],
+    }
+
+
+def per_call(dump, calls):
+    return min(timeit.repeat(dump, number=calls, repeat=3)) / calls
+
+
+def report(name, built, shared):
+    print('{}: {:.1f}us per call built, {:.1f}us shared ({:.1f}x)'.format(
+        name, built * 1e6, shared * 1e6, built / shared))
+
+
+def test_dump_order_with_shared_schema():
+    order = make_order(1)
+
+    built = per_call(lambda: OrderSchema().dump(order), CALLS)
+    shared = per_call(lambda: order_schema.dump(order), CALLS)
+    print()
+    report('single order', built, shared)
+
+    assert OrderSchema().dump(order) == order_schema.dump(order)
+    assert shared < built
+
+
+def test_dump_orders_with_shared_schema():
+    orders = [make_order(order_id) for order_id in range(PAGE_SIZE)]
+
+    built = per_call(lambda: OrderSchema(many=True).dump(orders), CALLS // 10)
+    shared = per_call(lambda: orders_schema.dump(orders), CALLS // 10)
+    print()
+    report('page of {} orders'.format(PAGE_SIZE), built, shared)
+
+    assert OrderSchema(many=True).dump(orders) == orders_schema.dump(orders)
@@ -19,6 +19,7 @@
 """
 
 import pytest
+import redis
 from collections import namedtuple
 
 from nameko import config
@@ -30,10 +31,23 @@ from orders.service import OrdersService
 
 @pytest.fixture
 def test_config(rabbit_config, db_url):
-    with config.patch({'DB_URIS': {'orders:Base': db_url}}):
+    # the outbox relay is only run explicitly by the tests
+    with config.patch({
+        'DB_URIS': {'orders:Base': db_url},
+        'REDIS_URI': 'redis://localhost:6379/12',
+        'OUTBOX_RELAY_INTERVAL': 3600,
+        'PRODUCT_IMAGE_ROOT': 'http://example.com/airship/images',
+    }):
         yield
 
 
+@pytest.yield_fixture
+def redis_client(test_config):
+    client = redis.StrictRedis.from_url(config.get('REDIS_URI'))
+    yield client
+    client.flushdb()
+
+
 @pytest.fixture
 def create_service_meta(container_factory, test_config):
     """ Returns a convenience method for creating service test instance
@@ -77,9 +91,9 @@ def create_service_meta(container_factory, test_config):
 
 @pytest.fixture
 def orders_service(create_service_meta):
-    """ Orders service test instance with `event_dispatcher`
-    dependency mocked """
-    return create_service_meta('event_dispatcher')
+    """ Orders service test instance with `event_dispatcher` and
+    `products_rpc` dependencies mocked """
+    return create_service_meta('event_dispatcher', 'products_rpc')
 
 
 @pytest.fixture
@@ -1,12 +1,26 @@
+import datetime
+from decimal import Decimal
+
+import eventlet
 import pytest
 
-from mock import call
+from mock import Mock, call
+from nameko import config
 from nameko.exceptions import RemoteError
+from nameko.standalone.rpc import ServiceRpcProxy
+from nameko.testing.services import entrypoint_hook
 
-from orders.models import Order, OrderDetail
+from orders import metrics
+from orders.exceptions import NotFound, ProductOutOfStock
+from orders.models import Order, OrderDetail, OutboxEvent
 from orders.schemas import OrderSchema, OrderDetailSchema
 
 
+def relay_outbox(service):
+    with entrypoint_hook(service.container, 'relay_outbox') as relay:
+        relay()
+
+
 @pytest.fixture
 def order(db_session):
     order = Order()
@@ -34,6 +48,159 @@ def test_get_order(orders_rpc, order):
     assert response['id'] == order.id
 
 
+def test_get_metrics(orders_rpc, order):
+    metrics.registry.clear()
+
+    orders_rpc.get_order(order.id)
+    snapshot = orders_rpc.get_metrics()
+
+    families = {family['name']: family for family in snapshot}
+    assert [
+        (sample['labels'], sample['count'])
+        for sample in families['entrypoint_duration_seconds']['samples']
+    ] == [({'service': 'orders', 'entrypoint': 'get_order'}, 1)]
+    assert families['entrypoint_in_flight']['samples'] == [
+        {'labels': {'service': 'orders', 'entrypoint': 'get_order'},
+         'value': 0},
+        {'labels': {'service': 'orders', 'entrypoint': 'get_metrics'},
+         'value': 1},
+    ]
+
+
+@pytest.fixture
+def enriching_orders_service(create_service_meta):
+    """ Orders service test instance with `products_rpc` mocked """
+    return create_service_meta('products_rpc')
+
+
+def get_order_enriched(service, order_id):
+    with entrypoint_hook(
+        service.container, 'get_order_enriched'
+    ) as get_order_enriched:
+        return get_order_enriched(order_id)
+
+
+@pytest.mark.usefixtures('order_details')
+def test_get_order_enriched(enriching_orders_service, order):
+    odyssey = {
+        'id': 'the_odyssey',
+        'title': 'The Odyssey',
+        'maximum_speed': 3,
+        'in_stock': 899,
+        'passenger_capacity': 100
+    }
+    products_rpc = enriching_orders_service.products_rpc
+    products_rpc.get_many.return_value = {'the_odyssey': odyssey}
+
+    response = get_order_enriched(enriching_orders_service, order.id)
+
+    assert {
+        'id': order.id,
+        'version': 1,
+        'order_details': [
+            {
+                'id': 1,
+                'product_id': 'the_odyssey',
+                'price': '99.51',
+                'quantity': 1,
+                'image': 'http://example.com/airship/images/the_odyssey.jpg',
+                'product': odyssey,
+            },
+            {
+                'id': 2,
+                'product_id': 'the_enigma',
+                'price': '30.99',
+                'quantity': 8,
+                'image': 'http://example.com/airship/images/the_enigma.jpg',
+            },
+        ],
+    } == response
+    assert 1 == products_rpc.get_many.call_count
+    (product_ids,), _ = products_rpc.get_many.call_args
+    assert ['the_enigma', 'the_odyssey'] == sorted(product_ids)
+
+
+def test_get_order_enriched_gives_up_on_slow_products(
+    enriching_orders_service, order, order_details
+):
+    def get_many(product_ids):
+        eventlet.sleep(1)
+
+    products_rpc = enriching_orders_service.products_rpc
+    products_rpc.get_many.side_effect = get_many
+
+    with config.patch({'PRODUCT_FETCH_TIMEOUT': 0.01}):
+        response = get_order_enriched(enriching_orders_service, order.id)
+
+    assert [None, None] == [
+        order_detail.get('product')
+        for order_detail in response['order_details']
+    ]
+
+
+@pytest.mark.usefixtures('order_details')
+def test_get_order_enriched_reads_products_through_cache(
+    enriching_orders_service, order
+):
+    odyssey = {'id': 'the_odyssey', 'title': 'The Odyssey'}
+    products_rpc = enriching_orders_service.products_rpc
+    products_rpc.get_many.return_value = {'the_odyssey': odyssey}
+
+    get_order_enriched(enriching_orders_service, order.id)
+    response = get_order_enriched(enriching_orders_service, order.id)
+
+    assert odyssey == response['order_details'][0]['product']
+    # the missing enigma is asked for again, the cached odyssey is not
+    assert [
+        ['the_enigma', 'the_odyssey'], ['the_enigma']
+    ] == [
+        sorted(product_ids)
+        for (product_ids,), _ in products_rpc.get_many.call_args_list
+    ]
+
+
+@pytest.mark.parametrize('handler, payload', [
+    ('handle_product_updated', {'product_id': 'the_odyssey'}),
+    ('handle_product_deleted', {'product_id': 'the_odyssey'}),
+    ('handle_products_updated', {'product_ids': ['the_odyssey']}),
+])
+@pytest.mark.usefixtures('order_details')
+def test_product_events_invalidate_cached_products(
+    enriching_orders_service, order, handler, payload
+):
+    products_rpc = enriching_orders_service.products_rpc
+    products_rpc.get_many.return_value = {
+        'the_odyssey': {'id': 'the_odyssey'},
+        'the_enigma': {'id': 'the_enigma'},
+    }
+    get_order_enriched(enriching_orders_service, order.id)
+
+    with entrypoint_hook(
+        enriching_orders_service.container, handler
+    ) as handle:
+        handle(payload)
+    get_order_enriched(enriching_orders_service, order.id)
+
+    assert call(['the_odyssey']) == products_rpc.get_many.call_args
+
+
+def test_get_order_enriched_without_order_details(
+    enriching_orders_service, order
+):
+    response = get_order_enriched(enriching_orders_service, order.id)
+
+    assert [] == response['order_details']
+    assert not enriching_orders_service.products_rpc.get_many.called
+
+
+@pytest.mark.usefixtures('db_session')
+def test_get_order_enriched_raises_when_order_not_found(
+    enriching_orders_service
+):
+    with pytest.raises(NotFound):
+        get_order_enriched(enriching_orders_service, 1)
+
+
 @pytest.mark.usefixtures('db_session')
 def test_will_raise_when_order_not_found(orders_rpc):
     with pytest.raises(RemoteError) as err:
@@ -60,9 +227,12 @@ def test_can_create_order(orders_service, orders_rpc):
     )
     assert new_order['id'] > 0
     assert len(new_order['order_details']) == len(order_details)
+
+    relay_outbox(orders_service)
     assert [call(
         'order_created', {'order': {
             'id': 1,
+            'version': 1,
             'order_details': [
                 {
                     'price': '99.99',
@@ -76,10 +246,390 @@ def test_can_create_order(orders_service, orders_rpc):
                     'id': 2,
                     'quantity': 8
                 }
-            ]}}
+            ]},
+            'stock_reserved': False}
     )] == orders_service.event_dispatcher.call_args_list
 
 
+def test_create_order_event_continues_the_trace(orders_service, db_session):
+    trace_id = '0af7651916cd43dd8448eb211c80319c'
+    traceparent = '00-{}-b7ad6b7169203331-01'.format(trace_id)
+    with ServiceRpcProxy(
+        'orders', context_data={'traceparent': traceparent}
+    ) as orders_rpc:
+        orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+        ])
+
+    event = db_session.query(OutboxEvent).one()
+    assert event.traceparent.startswith('00-{}-'.format(trace_id))
+    assert event.traceparent != traceparent
+
+
+@pytest.fixture
+def reserving_orders_service(create_service_meta):
+    """ Orders service test instance reserving stock on order creation,
+    with `event_dispatcher` and `products_rpc` dependencies mocked """
+    with config.patch({'RESERVE_STOCK': True}):
+        yield create_service_meta('event_dispatcher', 'products_rpc')
+
+
+@pytest.mark.usefixtures('db_session')
+def test_create_order_reserves_stock(reserving_orders_service, orders_rpc):
+    order_details = [
+        {'product_id': "the_odyssey", 'price': 99.99, 'quantity': 1},
+        {'product_id': "the_enigma", 'price': 5.99, 'quantity': 8},
+        {'product_id': "the_odyssey", 'price': 99.99, 'quantity': 2},
+    ]
+    new_order = orders_rpc.create_order(
+        OrderDetailSchema(many=True).dump(order_details).data
+    )
+
+    products_rpc = reserving_orders_service.products_rpc
+    assert [
+        call({'the_odyssey': 3, 'the_enigma': 8})
+    ] == products_rpc.reserve_stock.call_args_list
+
+    relay_outbox(reserving_orders_service)
+    assert [call('order_created', {
+        'order': new_order,
+        'stock_reserved': True,
+    })] == reserving_orders_service.event_dispatcher.call_args_list
+
+
+def test_create_order_fails_when_product_not_found(
+    orders_service, orders_rpc, db_session
+):
+    products_rpc = orders_service.products_rpc
+    products_rpc.exists_many.return_value = {
+        'the_odyssey': True, 'the_enigma': False}
+
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 8},
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 2},
+        ])
+
+    assert err.value.exc_type == 'ProductNotFound'
+    assert err.value.value == 'Product Id the_enigma'
+    assert [
+        call(['the_odyssey', 'the_enigma'])
+    ] == products_rpc.exists_many.call_args_list
+    assert not db_session.query(Order).count()
+
+
+def test_create_order_fails_when_out_of_stock(
+    reserving_orders_service, orders_rpc, db_session
+):
+    products_rpc = reserving_orders_service.products_rpc
+    products_rpc.reserve_stock.side_effect = ProductOutOfStock(
+        'Product ID the_odyssey is out of stock')
+
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 5}
+        ])
+
+    assert err.value.exc_type == 'ProductOutOfStock'
+    assert not db_session.query(Order).count()
+
+    relay_outbox(reserving_orders_service)
+    assert not reserving_orders_service.event_dispatcher.called
+
+
+@pytest.mark.usefixtures('db_session')
+def test_can_create_orders(orders_service, orders_rpc):
+    orders = [
+        {'order_details': [
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 8},
+        ]},
+        {'order_details': [
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 2},
+        ]},
+        {'order_details': []},
+    ]
+    results = orders_rpc.create_orders(orders)
+
+    assert ['created'] * 3 == [result['status'] for result in results]
+    new_orders = [result['order'] for result in results]
+    assert new_orders == orders_rpc.get_orders()
+    assert [
+        [
+            {key: detail[key] for key in ('product_id', 'price', 'quantity')}
+            for detail in order['order_details']
+        ]
+        for order in new_orders
+    ] == [order['order_details'] for order in orders]
+
+    relay_outbox(orders_service)
+    assert [
+        call('order_created', {'order': order, 'stock_reserved': False})
+        for order in new_orders
+    ] == orders_service.event_dispatcher.call_args_list
+
+
+@pytest.mark.usefixtures('db_session')
+def test_create_orders_with_no_orders(orders_service, orders_rpc):
+    assert [] == orders_rpc.create_orders([])
+    assert not orders_service.event_dispatcher.called
+
+
+@pytest.mark.usefixtures('db_session')
+def test_create_orders_reserves_stock_per_order(
+    reserving_orders_service, orders_rpc
+):
+    products_rpc = reserving_orders_service.products_rpc
+    out_of_stock = ProductOutOfStock('Product ID the_enigma is out of stock')
+    products_rpc.reserve_stock.call_async.side_effect = [
+        Mock(result=Mock()),
+        Mock(result=Mock(side_effect=out_of_stock)),
+    ]
+
+    results = orders_rpc.create_orders([
+        {'order_details': [
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 2},
+        ]},
+        {'order_details': [
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 20},
+        ]},
+    ])
+
+    assert [
+        call({'the_odyssey': 3}), call({'the_enigma': 20})
+    ] == products_rpc.reserve_stock.call_async.call_args_list
+    assert 'created' == results[0]['status']
+    assert {
+        'status': 'out_of_stock',
+        'error': 'Product ID the_enigma is out of stock',
+    } == results[1]
+    assert [results[0]['order']] == orders_rpc.get_orders()
+
+    relay_outbox(reserving_orders_service)
+    assert [call('order_created', {
+        'order': results[0]['order'],
+        'stock_reserved': True,
+    })] == reserving_orders_service.event_dispatcher.call_args_list
+
+
+def test_create_orders_releases_stock_on_failure(
+    reserving_orders_service, orders_rpc, db_session
+):
+    products_rpc = reserving_orders_service.products_rpc
+    products_rpc.reserve_stock.call_async.side_effect = [
+        Mock(result=Mock()),
+        Mock(result=Mock(side_effect=ValueError('boom'))),
+    ]
+
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.create_orders([
+            {'order_details': [
+                {'product_id': "the_odyssey", 'price': '9.99', 'quantity': 1}
+            ]},
+            {'order_details': [
+                {'product_id': "the_enigma", 'price': '5.99', 'quantity': 2}
+            ]},
+        ])
+
+    assert err.value.exc_type == 'ValueError'
+    assert [
+        call({'the_odyssey': 1})
+    ] == products_rpc.release_stock.call_args_list
+    assert not db_session.query(Order).count()
+
+
+def test_create_orders_bounds_reservations_in_flight(
+    reserving_orders_service, orders_rpc, db_session
+):
+    products_rpc = reserving_orders_service.products_rpc
+    products_rpc.reserve_stock.call_async.side_effect = [
+        Mock(result=Mock(side_effect=ValueError('boom'))),
+        Mock(result=Mock()),
+    ]
+
+    with config.patch({'RESERVE_STOCK_CONCURRENCY': 1}):
+        with pytest.raises(RemoteError):
+            orders_rpc.create_orders([
+                {'order_details': [{
+                    'product_id': "the_odyssey", 'price': '9.99',
+                    'quantity': 1,
+                }]},
+                {'order_details': [{
+                    'product_id': "the_enigma", 'price': '5.99',
+                    'quantity': 2,
+                }]},
+            ])
+
+    assert [
+        call({'the_odyssey': 1})
+    ] == products_rpc.reserve_stock.call_async.call_args_list
+    assert not products_rpc.release_stock.called
+    assert not db_session.query(Order).count()
+
+
+def test_create_order_writes_event_to_outbox(
+    orders_service, orders_rpc, db_session
+):
+    new_order = orders_rpc.create_order([
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+    ])
+
+    events = db_session.query(OutboxEvent).all()
+    assert [('order_created', {
+        'order': new_order,
+        'stock_reserved': False,
+    })] == [(event.event_type, event.payload) for event in events]
+
+
+def test_relay_outbox_publishes_pending_events_once(
+    orders_service, orders_rpc, db_session
+):
+    new_orders = [
+        orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+        ])
+        for _ in range(5)
+    ]
+
+    with config.patch({'OUTBOX_BATCH_SIZE': 2}):
+        relay_outbox(orders_service)
+        relay_outbox(orders_service)
+
+    assert [
+        call('order_created', {'order': order, 'stock_reserved': False})
+        for order in new_orders
+    ] == orders_service.event_dispatcher.call_args_list
+    assert not db_session.query(OutboxEvent).filter(
+        OutboxEvent.sent_at.is_(None)).count()
+
+
+def test_relay_outbox_deletes_events_sent_before_retention(
+    orders_service, orders_rpc, db_session
+):
+    for _ in range(2):
+        orders_rpc.create_order([
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+        ])
+    relay_outbox(orders_service)
+
+    old, recent = db_session.query(OutboxEvent).order_by(OutboxEvent.id)
+    old.sent_at -= datetime.timedelta(hours=2)
+    db_session.commit()
+
+    with config.patch({'OUTBOX_RETENTION': 60 * 60}):
+        relay_outbox(orders_service)
+
+    db_session.expire_all()
+    assert [recent.id] == [
+        event.id for event in db_session.query(OutboxEvent)]
+
+
+def test_relay_outbox_keeps_events_that_failed_to_publish(
+    orders_service, orders_rpc, db_session
+):
+    new_order = orders_rpc.create_order([
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+    ])
+
+    orders_service.event_dispatcher.side_effect = IOError('broker down')
+    with pytest.raises(IOError):
+        relay_outbox(orders_service)
+    assert db_session.query(OutboxEvent).filter(
+        OutboxEvent.sent_at.is_(None)).count() == 1
+
+    orders_service.event_dispatcher.side_effect = None
+    orders_service.event_dispatcher.reset_mock()
+    relay_outbox(orders_service)
+    assert [call('order_created', {
+        'order': new_order,
+        'stock_reserved': False,
+    })] == orders_service.event_dispatcher.call_args_list
+
+
+@pytest.mark.usefixtures('redis_client')
+def test_create_order_is_idempotent(orders_service, orders_rpc, db_session):
+    order_details = [
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+    ]
+    new_order = orders_rpc.create_order(
+        order_details, idempotency_key='retry-me')
+    retried_order = orders_rpc.create_order(
+        order_details, idempotency_key='retry-me')
+    other_order = orders_rpc.create_order(
+        order_details, idempotency_key='another')
+
+    assert new_order == retried_order
+    assert new_order['id'] != other_order['id']
+    assert 2 == db_session.query(Order).count()
+
+    relay_outbox(orders_service)
+    assert [
+        call('order_created', {'order': order, 'stock_reserved': False})
+        for order in (new_order, other_order)
+    ] == orders_service.event_dispatcher.call_args_list
+
+
+def test_create_order_retry_does_not_check_products(
+    orders_service, orders_rpc, db_session, redis_client
+):
+    order_details = [
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+    ]
+    products_rpc = orders_service.products_rpc
+    products_rpc.exists_many.return_value = {'the_odyssey': True}
+    new_order = orders_rpc.create_order(
+        order_details, idempotency_key='retry-me')
+
+    # the product is deleted before the request is retried
+    products_rpc.exists_many.return_value = {'the_odyssey': False}
+
+    assert new_order == orders_rpc.create_order(
+        order_details, idempotency_key='retry-me')
+    assert 1 == products_rpc.exists_many.call_count
+    assert 1 == db_session.query(Order).count()
+
+
+def test_create_order_is_idempotent_after_cache_expiry(
+    orders_service, orders_rpc, db_session, redis_client
+):
+    order_details = [
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}
+    ]
+    new_order = orders_rpc.create_order(
+        order_details, idempotency_key='retry-me')
+    redis_client.flushdb()
+
+    assert new_order == orders_rpc.create_order(
+        order_details, idempotency_key='retry-me')
+    assert 1 == db_session.query(Order).count()
+    assert redis_client.exists('orders:idempotency:retry-me')
+
+
+def test_create_order_returns_concurrently_created_order(
+    reserving_orders_service, orders_rpc, db_session, redis_client
+):
+    # another request with the same key commits while stock is reserved
+    def create_concurrent_order(product_ids_quantities):
+        db_session.add(Order(idempotency_key='retry-me'))
+        db_session.commit()
+
+    products_rpc = reserving_orders_service.products_rpc
+    products_rpc.reserve_stock.side_effect = create_concurrent_order
+
+    order = orders_rpc.create_order(
+        [{'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1}],
+        idempotency_key='retry-me'
+    )
+
+    assert {'id': 1, 'version': 1, 'order_details': []} == order
+    assert [
+        call({'the_odyssey': 1})
+    ] == products_rpc.release_stock.call_args_list
+    assert 1 == db_session.query(Order).count()
+
+
 @pytest.mark.usefixtures('db_session', 'order_details')
 def test_can_update_order(orders_rpc, order):
     order_payload = OrderSchema().dump(order).data
@@ -89,6 +639,163 @@ def test_can_update_order(orders_rpc, order):
     updated_order = orders_rpc.update_order(order_payload)
 
     assert updated_order['order_details'] == order_payload['order_details']
+    assert 2 == updated_order['version']
+
+
+@pytest.mark.usefixtures('order_details')
+def test_can_update_some_order_details(orders_rpc, order, db_session):
+    order_payload = OrderSchema().dump(order).data
+    unchanged_detail = order_payload['order_details'][0]
+    order_payload['order_details'][1]['quantity'] = 2
+    del order_payload['order_details'][0]
+
+    updated_order = orders_rpc.update_order(order_payload)
+
+    assert [
+        unchanged_detail, order_payload['order_details'][0]
+    ] == updated_order['order_details']
+    assert updated_order == orders_rpc.get_order(order.id)
+
+
+@pytest.mark.usefixtures('order_details')
+def test_update_order_checks_version(orders_rpc, order):
+    order_payload = OrderSchema().dump(order).data
+    orders_rpc.update_order(order_payload)
+
+    # the payload still carries the version read before the update above
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.update_order(order_payload)
+    assert err.value.exc_type == 'Conflict'
+
+    order_payload['version'] = 2
+    assert 3 == orders_rpc.update_order(order_payload)['version']
+
+
+@pytest.mark.usefixtures('order_details')
+def test_update_order_fails_with_unknown_order_detail(
+    orders_rpc, order, db_session
+):
+    order_payload = OrderSchema().dump(order).data
+    order_payload['order_details'][0]['quantity'] = 5
+    order_payload['order_details'].append(
+        {'id': 99, 'price': '1.00', 'quantity': 1})
+
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.update_order(order_payload)
+    assert err.value.exc_type == 'NotFound'
+
+    db_session.expire_all()
+    assert [1, 8] == [
+        order_detail.quantity for order_detail in order.order_details]
+    assert 1 == order.version
+
+
+@pytest.mark.usefixtures('db_session')
+def test_update_order_fails_when_order_not_found(orders_rpc):
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.update_order({'id': 1, 'order_details': []})
+    assert err.value.exc_type == 'NotFound'
+
+
+@pytest.mark.usefixtures('db_session')
+def test_create_order_stores_totals(orders_rpc, db_session):
+    orders_rpc.create_order([
+        {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+        {'product_id': "the_enigma", 'price': '5.99', 'quantity': 8},
+    ])
+
+    order = db_session.query(Order).one()
+    assert Decimal('147.91') == order.total_amount
+    assert 9 == order.item_count
+
+
+@pytest.mark.usefixtures('db_session')
+def test_create_orders_stores_totals(orders_rpc, db_session):
+    orders_rpc.create_orders([
+        {'order_details': [
+            {'product_id': "the_odyssey", 'price': '99.99', 'quantity': 1},
+            {'product_id': "the_enigma", 'price': '5.99', 'quantity': 8},
+        ]},
+        {'order_details': []},
+    ])
+
+    assert [(Decimal('147.91'), 9), (Decimal('0.00'), 0)] == [
+        (order.total_amount, order.item_count)
+        for order in db_session.query(Order).order_by(Order.id)
+    ]
+
+
+@pytest.mark.usefixtures('order_details')
+def test_update_order_updates_totals(orders_rpc, order, db_session):
+    order_payload = OrderSchema().dump(order).data
+    order_payload['order_details'][0]['price'] = '10.00'
+    order_payload['order_details'][1]['quantity'] = 2
+
+    orders_rpc.update_order(order_payload)
+
+    db_session.expire_all()
+    order = db_session.query(Order).one()
+    assert Decimal('71.98') == order.total_amount
+    assert 3 == order.item_count
+
+
+@pytest.fixture
+def dated_orders(db_session):
+    orders = [
+        Order(
+            created_at=datetime.datetime(2026, 10, day),
+            total_amount=Decimal(total_amount),
+            item_count=item_count,
+        )
+        for day, total_amount, item_count in [
+            (1, '10.50', 1), (2, '20.25', 2), (3, '30.00', 3),
+        ]
+    ]
+    db_session.add_all(orders)
+    db_session.commit()
+    return orders
+
+
+@pytest.mark.usefixtures('dated_orders')
+def test_get_order_stats(orders_rpc):
+    assert {
+        'order_count': 3, 'item_count': 6, 'revenue': '60.75'
+    } == orders_rpc.get_order_stats()
+
+
+@pytest.mark.usefixtures('dated_orders')
+def test_get_order_stats_in_range(orders_rpc):
+    assert {
+        'order_count': 1, 'item_count': 2, 'revenue': '20.25'
+    } == orders_rpc.get_order_stats(
+        since='2026-10-02T00:00:00', until='2026-10-03T00:00:00')
+
+
+@pytest.mark.usefixtures('dated_orders')
+def test_get_order_stats_converts_offsets_to_utc(orders_rpc):
+    assert {
+        'order_count': 1, 'item_count': 2, 'revenue': '20.25'
+    } == orders_rpc.get_order_stats(
+        since='2026-10-02T02:00:00+02:00', until='2026-10-03T02:00:00+02:00')
+
+
+@pytest.mark.parametrize('bounds', [
+    {'since': 'yesterday'},
+    {'until': '2026-13-01T00:00:00'},
+    {'since': 20261001},
+])
+@pytest.mark.usefixtures('db_session')
+def test_get_order_stats_rejects_bad_timestamps(orders_rpc, bounds):
+    with pytest.raises(RemoteError) as err:
+        orders_rpc.get_order_stats(**bounds)
+    assert err.value.exc_type == 'BadRequest'
+
+
+@pytest.mark.usefixtures('db_session')
+def test_get_order_stats_without_orders(orders_rpc):
+    assert {
+        'order_count': 0, 'item_count': 0, 'revenue': '0.00'
+    } == orders_rpc.get_order_stats()
 
 
 def test_can_delete_order(orders_rpc, order, db_session):
@@ -97,4 +804,83 @@ def test_can_delete_order(orders_rpc, order, db_session):
 
 def test_get_orders(orders_rpc, order):
     response = orders_rpc.get_orders()
-    assert response[0]['id'] == order.id
\ No newline at end of file
+    assert response[0]['id'] == order.id
+
+
+@pytest.fixture
+def orders(db_session):
+    orders = [Order() for _ in range(5)]
+    db_session.add_all(orders)
+    db_session.commit()
+    return orders
+
+
+def test_list_orders(orders_rpc, orders):
+    response = orders_rpc.list_orders()
+    assert [order.id for order in orders] == [
+        order['id'] for order in response]
+
+
+def test_list_orders_page(orders_rpc, orders):
+    first_page = orders_rpc.list_orders(limit=2)
+    assert [orders[0].id, orders[1].id] == [
+        order['id'] for order in first_page]
+
+    second_page = orders_rpc.list_orders(
+        after_id=first_page[-1]['id'], limit=2)
+    assert [orders[2].id, orders[3].id] == [
+        order['id'] for order in second_page]
+
+    last_page = orders_rpc.list_orders(after_id=orders[-1].id)
+    assert [] == last_page
+
+
+@pytest.fixture
+def product_orders(db_session):
+    orders = [
+        Order(order_details=[
+            OrderDetail(product_id=product_id, price=9.99, quantity=1)
+            for product_id in product_ids
+        ])
+        for product_ids in [
+            ['the_odyssey'],
+            ['the_enigma'],
+            ['the_odyssey', 'the_enigma'],
+            ['the_odyssey', 'the_odyssey'],
+            ['the_odyssey'],
+        ]
+    ]
+    db_session.add_all(orders)
+    db_session.commit()
+    return orders
+
+
+def test_get_orders_by_product(orders_rpc, product_orders):
+    response = orders_rpc.get_orders_by_product('the_odyssey')
+
+    assert [
+        product_orders[0].id, product_orders[2].id,
+        product_orders[3].id, product_orders[4].id
+    ] == [order['id'] for order in response]
+    # orders come with all their details, not only the matching ones
+    assert ['the_odyssey', 'the_enigma'] == [
+        detail['product_id'] for detail in response[1]['order_details']]
+
+
+def test_get_orders_by_product_page(orders_rpc, product_orders):
+    first_page = orders_rpc.get_orders_by_product('the_odyssey', limit=2)
+    assert [product_orders[0].id, product_orders[2].id] == [
+        order['id'] for order in first_page]
+
+    second_page = orders_rpc.get_orders_by_product(
+        'the_odyssey', after_id=first_page[-1]['id'], limit=2)
+    assert [product_orders[3].id, product_orders[4].id] == [
+        order['id'] for order in second_page]
+
+    last_page = orders_rpc.get_orders_by_product(
+        'the_odyssey', after_id=product_orders[-1].id)
+    assert [] == last_page
+
+
+def test_get_orders_by_product_not_ordered(orders_rpc, product_orders):
+    assert [] == orders_rpc.get_orders_by_product('the_mayflower')
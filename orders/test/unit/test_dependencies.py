@@ -0,0 +1,26 @@
+from mock import Mock
+import redis
+
+from orders.dependencies import IdempotencyCacheWrapper
+
+
+def test_idempotency_cache_treats_redis_errors_as_misses():
+    client = Mock()
+    client.get.side_effect = redis.ConnectionError('down')
+    client.set.side_effect = redis.ConnectionError('down')
+    cache = IdempotencyCacheWrapper(client, ttl=60)
+
+    assert cache.get('retry-me') is None
+    cache.set('retry-me', {'id': 1})
+
+
+def test_idempotency_cache_stores_orders_with_ttl():
+    client = Mock()
+    client.get.return_value = b'{"id": 1, "order_details": []}'
+    cache = IdempotencyCacheWrapper(client, ttl=60)
+
+    cache.set('retry-me', {'id': 1, 'order_details': []})
+    client.set.assert_called_once_with(
+        'orders:idempotency:retry-me', '{"id": 1, "order_details": []}',
+        ex=60)
+    assert {'id': 1, 'order_details': []} == cache.get('retry-me')
@@ -0,0 +1,19 @@
+from mock import Mock
+from nameko import config
+
+from orders.entrypoints import ConfigTimer
+
+
+def test_config_timer_reads_interval_on_setup():
+    timer = ConfigTimer('RELAY_INTERVAL', 5).bind(Mock(), 'relay')
+    assert timer.interval == 5
+
+    with config.patch({'RELAY_INTERVAL': 0.5}):
+        timer.setup()
+    assert timer.interval == 0.5
+
+
+def test_config_timer_defaults_interval():
+    timer = ConfigTimer('RELAY_INTERVAL', 5).bind(Mock(), 'relay')
+    timer.setup()
+    assert timer.interval == 5
@@ -1,11 +1,177 @@
+import logging
+from queue import Empty, LifoQueue
+
 from nameko import config
+from nameko.constants import DEFAULT_MAX_WORKERS, MAX_WORKERS_CONFIG_KEY
+from nameko.exceptions import ConfigurationError
 from nameko.extensions import DependencyProvider
 import redis
+from redis.connection import HiredisParser, PythonParser
+from redis.utils import HIREDIS_AVAILABLE
+
+from products.exceptions import NotFound, OutOfStock
 
-from products.exceptions import NotFound
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 
 REDIS_URI_KEY = 'REDIS_URI'
+REDIS_MAX_CONNECTIONS_KEY = 'REDIS_MAX_CONNECTIONS'
+REDIS_POOL_TIMEOUT_KEY = 'REDIS_POOL_TIMEOUT'
+REDIS_SOCKET_TIMEOUT_KEY = 'REDIS_SOCKET_TIMEOUT'
+REDIS_SOCKET_CONNECT_TIMEOUT_KEY = 'REDIS_SOCKET_CONNECT_TIMEOUT'
+REDIS_HEALTH_CHECK_INTERVAL_KEY = 'REDIS_HEALTH_CHECK_INTERVAL'
+REDIS_HIREDIS_KEY = 'REDIS_HIREDIS'
+PRODUCT_STORAGE_FORMAT_KEY = 'PRODUCT_STORAGE_FORMAT'
+
+DEFAULT_REDIS_POOL_TIMEOUT = 2
+DEFAULT_REDIS_SOCKET_TIMEOUT = 2
+DEFAULT_REDIS_SOCKET_CONNECT_TIMEOUT = 1
+DEFAULT_REDIS_HEALTH_CHECK_INTERVAL = 30
+DEFAULT_REDIS_HIREDIS = False
+
+HASH_FORMAT = 'hash'
+MSGPACK_FORMAT = 'msgpack'
+DEFAULT_PRODUCT_STORAGE_FORMAT = HASH_FORMAT
+
+# outside the ``products:`` keys, where a product with the id ``index``
+# would be stored
+INDEX_KEY = 'products-index'
+LIST_BATCH_SIZE = 500
+CREATE_BATCH_SIZE = 1000
+CONVERT_BATCH_SIZE = 100
+
+RESERVE_OK = 0
+RESERVE_NOT_FOUND = 1
+RESERVE_OUT_OF_STOCK = 2
+
+
+def _decode_text(value):
+    return value.decode('utf-8')
+
+
+# Product fields, with the decoders of their values in a product hash
+FIELDS = {
+    'id': _decode_text,
+    'title': _decode_text,
+    'passenger_capacity': int,
+    'maximum_speed': int,
+    'in_stock': int,
+}
+INTEGER_FIELDS = [field for field, decode in FIELDS.items() if decode is int]
+
+# A product is stored either as a hash or, in the compact format, as a
+# string holding the product as a msgpack map. The stock scripts handle
+# both, so products can be converted while the service is running.
+STOCK_FUNCTIONS = """
+local function get_stock(key)
+    if redis.call('TYPE', key)['ok'] == 'string' then
+        return cmsgpack.unpack(redis.call('GET', key))['in_stock']
+    end
+    local in_stock = redis.call('HGET', key, 'in_stock')
+    return in_stock and tonumber(in_stock)
+end
+
+local function increment_stock(key, amount)
+    if redis.call('TYPE', key)['ok'] ~= 'string' then
+        return redis.call('HINCRBY', key, 'in_stock', amount)
+    end
+    local product = cmsgpack.unpack(redis.call('GET', key))
+    product['in_stock'] = product['in_stock'] + amount
+    redis.call('SET', key, cmsgpack.pack(product))
+    return product['in_stock']
+end
+"""
+
+# KEYS are products and ARGV the quantities to reserve. Replies with
+# {RESERVE_OK, remaining stock per product}, or with a failure status and
+# the (1-based) index of the first product that cannot be reserved.
+RESERVE_STOCK_SCRIPT = STOCK_FUNCTIONS + """
+for i, key in ipairs(KEYS) do
+    local in_stock = get_stock(key)
+    if not in_stock then
+        return {1, i}
+    end
+    if in_stock < tonumber(ARGV[i]) then
+        return {2, i}
+    end
+end
+local remaining = {}
+for i, key in ipairs(KEYS) do
+    remaining[i] = increment_stock(key, -ARGV[i])
+end
+return {0, remaining}
+"""
+
+# KEYS are products and ARGV the amounts to add to their stock. Replies
+# with the new stock per product.
+INCREMENT_STOCK_SCRIPT = STOCK_FUNCTIONS + """
+local in_stock = {}
+for i, key in ipairs(KEYS) do
+    in_stock[i] = increment_stock(key, tonumber(ARGV[i]))
+end
+return in_stock
+"""
+
+# KEYS are products and ARGV the integer fields. Rewrites the products
+# stored as hashes in the compact format and replies with their number.
+TO_MSGPACK_SCRIPT = """
+local converted = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('TYPE', key)['ok'] == 'hash' then
+        local values = redis.call('HGETALL', key)
+        local product = {}
+        for i = 1, #values, 2 do
+            product[values[i]] = values[i + 1]
+        end
+        for _, field in ipairs(ARGV) do
+            product[field] = tonumber(product[field])
+        end
+        redis.call('SET', key, cmsgpack.pack(product))
+        converted = converted + 1
+    end
+end
+return converted
+"""
+
+# KEYS are products. Rewrites the products stored in the compact format
+# as hashes and replies with their number.
+TO_HASH_SCRIPT = """
+local converted = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('TYPE', key)['ok'] == 'string' then
+        local product = cmsgpack.unpack(redis.call('GET', key))
+        local values = {}
+        for field, value in pairs(product) do
+            values[#values + 1] = field
+            values[#values + 1] = value
+        end
+        redis.call('DEL', key)
+        redis.call('HMSET', key, unpack(values))
+        converted = converted + 1
+    end
+end
+return converted
+"""
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scripts:
+    """ The Lua scripts of `StorageWrapper`, registered with `client`.
+
+    Registering a script hashes it, so this is done once per client rather
+    than for every worker.
+    """
+
+    def __init__(self, client):
+        self.reserve_stock = client.register_script(RESERVE_STOCK_SCRIPT)
+        self.increment_stock = client.register_script(INCREMENT_STOCK_SCRIPT)
+        self.to_msgpack = client.register_script(TO_MSGPACK_SCRIPT)
+        self.to_hash = client.register_script(TO_HASH_SCRIPT)
 
 
 class StorageWrapper:
@@ -14,75 +180,395 @@ class StorageWrapper:
 
     A very simple example of a custom Nameko dependency. Simplified
     implementation of products database based on Redis key value store.
-    Handling the product ID increments or keeping sorted sets of product
-    names for ordering the products is out of the scope of this example.
+    Product ids are kept in the ``products-index`` sorted set (all with the
+    same score, so ordered by id) for listing without scanning the
+    keyspace. Handling the product ID increments is out of the scope of
+    this example.
+
+    Products are stored as hashes or, if `compact`, as msgpack blobs,
+    which take less memory and are read whole with a single ``GET``.
+    Compact storage still reads products stored as hashes, until
+    `convert` rewrites them.
 
     """
 
     NotFound = NotFound
+    OutOfStock = OutOfStock
 
-    def __init__(self, client):
+    def __init__(self, client, scripts, compact=False):
         self.client = client
+        self.scripts = scripts
+        self.compact = compact
+
+    def pool_stats(self):
+        """ Returns the size, in use, idle and waiting counts of the
+        connection pool, and how many waits for a connection timed out.
+        """
+        return self.client.connection_pool.stats()
 
     def _format_key(self, product_id):
         return 'products:{}'.format(product_id)
 
     def _from_hash(self, document):
         return {
-            'id': document[b'id'].decode('utf-8'),
-            'title': document[b'title'].decode('utf-8'),
-            'passenger_capacity': int(document[b'passenger_capacity']),
-            'maximum_speed': int(document[b'maximum_speed']),
-            'in_stock': int(document[b'in_stock'])
+            field: decode(document[field.encode('utf-8')])
+            for field, decode in FIELDS.items()
+        }
+
+    def _check_fields(self, fields):
+        unknown = set(fields).difference(FIELDS)
+        if unknown:
+            raise ValueError('Unknown product fields: {}'.format(
+                ', '.join(sorted(unknown))))
+
+    def _read(self, pipe, product_id, fields, compact):
+        key = self._format_key(product_id)
+        if compact:
+            pipe.get(key)
+        elif fields is None:
+            pipe.hgetall(key)
+        else:
+            pipe.hmget(key, fields)
+
+    def _decode(self, reply, fields, compact):
+        """ Returns the product read by `_read`, or None if there is no
+        such product.
+        """
+        if compact:
+            if reply is None:
+                return None
+            product = msgpack.unpackb(reply, raw=False)
+            if fields is None:
+                return product
+            return {field: product[field] for field in fields}
+
+        if fields is None:
+            return self._from_hash(reply) if reply else None
+        if all(value is None for value in reply):
+            return None
+        return {
+            field: FIELDS[field](value)
+            for field, value in zip(fields, reply)
+            if value is not None
         }
 
+    def _pack(self, product):
+        return msgpack.packb(
+            {field: product[field] for field in FIELDS}, use_bin_type=True)
+
+    def _write(self, pipe, product):
+        key = self._format_key(product['id'])
+        if self.compact:
+            pipe.set(key, self._pack(product))
+        else:
+            pipe.hmset(key, product)
+
     def _format_ids(self, key):
         return key.decode('utf-8').replace('products:', '')
     
-    def get(self, product_id):
-        product = self.client.hgetall(self._format_key(product_id))
-        if not product:
+    def get(self, product_id, fields=None):
+        """ Returns the product, or only its `fields` if given """
+        product = self.get_many([product_id], fields).get(product_id)
+        if product is None:
             raise NotFound('Product ID {} does not exist'.format(product_id))
-        else:
-            return self._from_hash(product)
+        return product
+
+    def get_many(self, product_ids, fields=None):
+        """ Returns the products that exist, or only their `fields` if
+        given, by id.
+
+        Hashes are read with ``HMGET`` when only some fields are wanted.
+        Compact products are always read whole and projected here.
+        """
+        if fields is not None:
+            self._check_fields(fields)
+        return self._get_many(product_ids, fields, self.compact)
 
-    def list(self):
-        keys = self.client.keys(self._format_key('*'))
-        for key in keys:
-            yield self._from_hash(self.client.hgetall(key))
+    def _get_many(self, product_ids, fields, compact):
+        with self.client.pipeline(transaction=False) as pipe:
+            for product_id in product_ids:
+                self._read(pipe, product_id, fields, compact)
+            replies = pipe.execute(raise_on_error=False)
+
+        products = {}
+        hashes = []
+        for product_id, reply in zip(product_ids, replies):
+            if isinstance(reply, redis.ResponseError):
+                if compact and str(reply).startswith('WRONGTYPE'):
+                    # not converted yet
+                    hashes.append(product_id)
+                    continue
+                raise reply
+            product = self._decode(reply, fields, compact)
+            if product is not None:
+                products[product_id] = product
+
+        if hashes:
+            products.update(self._get_many(hashes, fields, compact=False))
+        return products
+
+    def list(self, offset=0, limit=None):
+        start = offset
+        stop = None if limit is None else offset + limit
+        while stop is None or start < stop:
+            end = start + LIST_BATCH_SIZE
+            if stop is not None:
+                end = min(end, stop)
+
+            product_ids = [
+                product_id.decode('utf-8') for product_id in
+                self.client.zrange(INDEX_KEY, start, end - 1)
+            ]
+            products = self.get_many(product_ids)
+            for product_id in product_ids:
+                if product_id in products:
+                    yield products[product_id]
+
+            if len(product_ids) < end - start:
+                break
+            start = end
+
+    def rebuild_index(self):
+        """ Adds every stored product to the index.
+
+        Only needed for products stored before the index existed.
+        """
+        with self.client.pipeline(transaction=False) as pipe:
+            for key in self.client.scan_iter(self._format_key('*')):
+                pipe.zadd(INDEX_KEY, {self._format_ids(key): 0})
+            pipe.execute()
+
+    def convert(self, compact, batch_size=CONVERT_BATCH_SIZE):
+        """ Rewrites every stored product in the compact format, or as a
+        hash if not `compact`, and returns how many were rewritten.
+
+        Each batch of `batch_size` products is converted by one script,
+        so stock changes made meanwhile are not lost.
+        """
+        script = self.scripts.to_msgpack if compact else self.scripts.to_hash
+        args = INTEGER_FIELDS if compact else []
+
+        converted = 0
+        keys = []
+        for key in self.client.scan_iter(
+            self._format_key('*'), count=batch_size
+        ):
+            keys.append(key)
+            if len(keys) == batch_size:
+                converted += script(keys=keys, args=args)
+                keys = []
+        if keys:
+            converted += script(keys=keys, args=args)
+        return converted
+
+    def _exists(self, client, product_id):
+        key = self._format_key(product_id)
+        if self.compact:
+            # also true of products not converted yet
+            return client.exists(key)
+        return client.hexists(key, 'id')
 
     def exist(self, product_id):
-        return self.client.hexists(self._format_key(product_id), 'id') > 0
+        return self._exists(self.client, product_id) > 0
+
+    def exists_many(self, product_ids):
+        with self.client.pipeline(transaction=False) as pipe:
+            for product_id in product_ids:
+                self._exists(pipe, product_id)
+            exists = pipe.execute()
+
+        return {
+            product_id: bool(product_exists)
+            for product_id, product_exists in zip(product_ids, exists)
+        }
 
     def create(self, product):
-        self.client.hmset(
-            self._format_key(product['id']),
-            product)
+        with self.client.pipeline() as pipe:
+            self._write(pipe, product)
+            pipe.zadd(INDEX_KEY, {product['id']: 0})
+            pipe.execute()
+
+    def create_many(self, products, batch_size=CREATE_BATCH_SIZE):
+        """ Stores `products` in transactions of `batch_size` products.
+
+        Each transaction writes the products and adds the ids to the
+        index in a single round trip. Returns the ids of the stored
+        products.
+        """
+        product_ids = []
+        for start in range(0, len(products), batch_size):
+            batch = products[start:start + batch_size]
+            with self.client.pipeline() as pipe:
+                for product in batch:
+                    self._write(pipe, product)
+                pipe.zadd(
+                    INDEX_KEY, {product['id']: 0 for product in batch})
+                pipe.execute()
+            product_ids.extend(product['id'] for product in batch)
+        return product_ids
 
     def delete(self, product_id):
         
         if not self.exist(product_id):
             raise NotFound('Product ID {} does not exist'.format(product_id))
         else:
-            return self.client.delete(self._format_key(product_id))
+            with self.client.pipeline() as pipe:
+                pipe.delete(self._format_key(product_id))
+                pipe.zrem(INDEX_KEY, product_id)
+                deleted, _ = pipe.execute()
+            return deleted
         
     def decrement_stock(self, product_ids_quantities):
-        response_dict = {}
-        with self.client.pipeline() as pipe: 
-            pipe.multi()
-            for product_id, amount in product_ids_quantities.items():
-                pipe.hincrby(self._format_key(product_id), 'in_stock', -amount)
-                x = pipe.execute()
-                response_dict[product_id] = x[0]
-                
+        return self._increment_stock({
+            product_id: -amount
+            for product_id, amount in product_ids_quantities.items()
+        })
+
+    def release_stock(self, product_ids_quantities):
+        return self._increment_stock(product_ids_quantities)
+
+    def _increment_stock(self, product_ids_quantities):
+        product_ids = list(product_ids_quantities)
+        if self.compact:
+            in_stock = self.scripts.increment_stock(
+                keys=[
+                    self._format_key(product_id)
+                    for product_id in product_ids
+                ],
+                args=[
+                    product_ids_quantities[product_id]
+                    for product_id in product_ids
+                ])
+            return dict(zip(product_ids, in_stock))
+
+        with self.client.pipeline() as pipe:
+            for product_id in product_ids:
+                pipe.hincrby(
+                    self._format_key(product_id), 'in_stock',
+                    product_ids_quantities[product_id])
+            in_stock = pipe.execute()
 
-        return response_dict
+        return dict(zip(product_ids, in_stock))
+
+    def reserve_stock(self, product_ids_quantities):
+        """ Decrements stock for all the products, or for none of them.
+
+        Runs as a single server-side script, so no other command can change
+        the stock between checking it and decrementing it. Raises
+        `NotFound` or `OutOfStock` naming the first product that cannot be
+        reserved, otherwise returns the remaining stock per product.
+        """
+        product_ids = list(product_ids_quantities)
+        status, result = self.scripts.reserve_stock(
+            keys=[self._format_key(product_id) for product_id in product_ids],
+            args=[product_ids_quantities[product_id]
+                  for product_id in product_ids]
+        )
+
+        if status == RESERVE_NOT_FOUND:
+            raise NotFound('Product ID {} does not exist'.format(
+                product_ids[result - 1]))
+        if status == RESERVE_OUT_OF_STOCK:
+            raise OutOfStock('Product ID {} is out of stock'.format(
+                product_ids[result - 1]))
+        return dict(zip(product_ids, result))
+
+
+class WaitCountingQueue(LifoQueue):
+    """ Queue of the pooled connections that counts the callers waiting
+    for one and those that gave up.
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.waiting = 0
+        self.timeouts = 0
+
+    def get(self, block=True, timeout=None):
+        self.waiting += 1
+        try:
+            return super().get(block, timeout)
+        except Empty:
+            self.timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+
+
+class ConnectionPool(redis.BlockingConnectionPool):
+    """ Pool of at most `max_connections` connections. Callers wait up to
+    `timeout` seconds for a free one, then get a ``ConnectionError``.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(queue_class=WaitCountingQueue, **kwargs)
+
+    def stats(self):
+        idle = sum(
+            connection is not None for connection in list(self.pool.queue))
+        return {
+            'max': self.max_connections,
+            'in_use': len(self._connections) - idle,
+            'idle': idle,
+            'waiting': self.pool.waiting,
+            'timeouts': self.pool.timeouts,
+        }
 
 
 class Storage(DependencyProvider):
+    """ Gives workers a `StorageWrapper` sharing one pool of Redis
+    connections.
+
+    The pool holds a connection per worker by default, and every wait on
+    it or on Redis is bounded, so an unavailable Redis fails requests
+    within a few seconds instead of piling workers up behind it.
+    Connections idle for longer than the health check interval are pinged
+    before being used, replacing those a failover left dangling.
+    """
 
     def setup(self):
-        self.client = redis.StrictRedis.from_url(config.get(REDIS_URI_KEY))
+        use_hiredis = config.get(REDIS_HIREDIS_KEY, DEFAULT_REDIS_HIREDIS)
+        if use_hiredis and not HIREDIS_AVAILABLE:
+            logger.warning(
+                "hiredis is not installed, parsing replies in Python")
+
+        self.pool = ConnectionPool.from_url(
+            config.get(REDIS_URI_KEY),
+            max_connections=(
+                config.get(REDIS_MAX_CONNECTIONS_KEY) or
+                config.get(MAX_WORKERS_CONFIG_KEY, DEFAULT_MAX_WORKERS)),
+            timeout=config.get(
+                REDIS_POOL_TIMEOUT_KEY, DEFAULT_REDIS_POOL_TIMEOUT),
+            socket_timeout=config.get(
+                REDIS_SOCKET_TIMEOUT_KEY, DEFAULT_REDIS_SOCKET_TIMEOUT),
+            socket_connect_timeout=config.get(
+                REDIS_SOCKET_CONNECT_TIMEOUT_KEY,
+                DEFAULT_REDIS_SOCKET_CONNECT_TIMEOUT),
+            health_check_interval=config.get(
+                REDIS_HEALTH_CHECK_INTERVAL_KEY,
+                DEFAULT_REDIS_HEALTH_CHECK_INTERVAL),
+            parser_class=(
+                HiredisParser if use_hiredis and HIREDIS_AVAILABLE
+                else PythonParser),
+        )
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+        self.scripts = Scripts(self.client)
+
+        storage_format = config.get(
+            PRODUCT_STORAGE_FORMAT_KEY, DEFAULT_PRODUCT_STORAGE_FORMAT)
+        if storage_format not in (HASH_FORMAT, MSGPACK_FORMAT):
+            raise ConfigurationError(
+                "{} must be '{}' or '{}'".format(
+                    PRODUCT_STORAGE_FORMAT_KEY, HASH_FORMAT, MSGPACK_FORMAT))
+        if storage_format == MSGPACK_FORMAT and msgpack is None:
+            raise ConfigurationError(
+                "The '{}' product storage format needs msgpack "
+                "installed".format(MSGPACK_FORMAT))
+        self.compact = storage_format == MSGPACK_FORMAT
+
+    def stop(self):
+        self.pool.disconnect()
 
     def get_dependency(self, worker_ctx):
-        return StorageWrapper(self.client)
+        return StorageWrapper(
+            self.client, self.scripts, compact=self.compact)
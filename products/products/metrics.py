@@ -0,0 +1,26 @@
+""" Latency histograms, in-flight gauges and error counters of the service's
+entrypoints, and the state of its Redis connection pool.
+
+The gateway reads the `registry` snapshot through the ``get_metrics`` RPC
+and serves it with its own on ``GET /metrics``.
+"""
+from common.metrics import COUNTER, GAUGE, ServiceRegistry
+
+
+registry = ServiceRegistry()
+
+redis_pool_connections = registry.add(
+    'redis_pool_connections', GAUGE,
+    'Connections of the Redis pool, by state.', ('service', 'state'))
+redis_pool_timeouts = registry.add(
+    'redis_pool_timeouts_total', COUNTER,
+    'Waits for a pooled Redis connection that timed out.', ('service',))
+
+POOL_STATES = ('max', 'in_use', 'idle', 'waiting')
+
+
+def record_pool_stats(service_name, stats):
+    """ Sets the Redis pool metrics from `StorageWrapper.pool_stats` """
+    for state in POOL_STATES:
+        redis_pool_connections.labels(service_name, state).set(stats[state])
+    redis_pool_timeouts.labels(service_name).set(stats['timeouts'])
@@ -0,0 +1,55 @@
+""" Converts the stored products to another storage format ::
+
+    python -m products.migrate --config config.yml msgpack
+
+Products in the compact format are only read by services configured with
+``PRODUCT_STORAGE_FORMAT: msgpack``, which also read products that are
+still hashes. So to switch to it, deploy that configuration first and
+then convert; to switch back, convert to ``hash`` first and then deploy.
+Stock changes made while the command runs are kept.
+"""
+import argparse
+import sys
+
+from nameko import config
+from nameko.cli.utils.config import load_config
+
+from products.dependencies import (
+    CONVERT_BATCH_SIZE, HASH_FORMAT, MSGPACK_FORMAT, Storage)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Convert the stored products to another format.')
+    parser.add_argument(
+        'format', choices=[MSGPACK_FORMAT, HASH_FORMAT],
+        help='format to convert the products to')
+    parser.add_argument(
+        '--config', required=True,
+        help='configuration of the products service')
+    parser.add_argument(
+        '--batch-size', type=int, default=CONVERT_BATCH_SIZE,
+        help='products converted per script (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.config) as config_file:
+        config.update(load_config(config_file))
+
+    provider = Storage()
+    provider.setup()
+    try:
+        storage = provider.get_dependency(None)
+        converted = storage.convert(
+            args.format == MSGPACK_FORMAT, batch_size=args.batch_size)
+    finally:
+        provider.stop()
+
+    print('Converted {} products to {}'.format(converted, args.format))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,3 +7,9 @@ class Product(Schema):
     passenger_capacity = fields.Int(required=True)
     maximum_speed = fields.Int(required=True)
     in_stock = fields.Int(required=True)
+
+
+# Shared instances, as building a schema copies all of its fields
+product_schema = Product()
+products_schema = Product(many=True)
+strict_product_schema = Product(strict=True)
@@ -1,9 +1,12 @@
 import logging
 
-from nameko.events import event_handler
+from nameko.events import EventDispatcher, event_handler
 from nameko.rpc import rpc
 
+from common.metrics import Metrics
+from common.tracing import Tracer
 from products import dependencies, schemas
+from products.metrics import record_pool_stats, registry
 
 
 logger = logging.getLogger(__name__)
@@ -14,33 +17,108 @@ class ProductsService:
     name = 'products'
 
     storage = dependencies.Storage()
+    event_dispatcher = EventDispatcher()
+    metrics = Metrics(registry)
+    tracer = Tracer()
 
     @rpc
-    def get(self, product_id):
-        product = self.storage.get(product_id)
-        return schemas.Product().dump(product).data
+    def get_metrics(self):
+        record_pool_stats(self.name, self.storage.pool_stats())
+        return self.metrics.snapshot()
 
     @rpc
-    def list(self):
-        products = self.storage.list()
-        return schemas.Product(many=True).dump(products).data
+    def get(self, product_id, fields=None):
+        """ Gets the product, or only its `fields` if given """
+        product = self.storage.get(product_id, fields)
+        return schemas.product_schema.dump(product).data
+
+    @rpc
+    def get_many(self, product_ids, fields=None):
+        products = self.storage.get_many(product_ids, fields)
+        return {
+            product_id: schemas.product_schema.dump(product).data
+            for product_id, product in products.items()
+        }
+
+    @rpc
+    def list(self, offset=0, limit=None):
+        products = self.storage.list(offset, limit)
+        return schemas.products_schema.dump(products).data
     
     @rpc
     def create(self, product):
-        product = schemas.Product(strict=True).load(product).data
+        product = schemas.strict_product_schema.load(product).data
         self.storage.create(product)
+        self.event_dispatcher('product_updated', {'product_id': product['id']})
+
+    @rpc
+    def create_many(self, products):
+        """ Creates all the valid `products`, skipping invalid ones.
+
+        Returns one result per product, in order: ``{'id': ...,
+        'status': 'created'}`` or ``{'index': ..., 'status': 'invalid',
+        'errors': ...}``.
+        """
+        data, errors = schemas.products_schema.load(products)
+        valid = [
+            product for index, product in enumerate(data)
+            if index not in errors
+        ]
+        product_ids = self.storage.create_many(valid)
+        if product_ids:
+            self.event_dispatcher(
+                'products_updated', {'product_ids': product_ids})
+
+        results = []
+        for index, product in enumerate(data):
+            if index in errors:
+                results.append({
+                    'index': index,
+                    'status': 'invalid',
+                    'errors': errors[index] or errors.get('_schema'),
+                })
+            else:
+                results.append({'id': product['id'], 'status': 'created'})
+        return results
 
     @rpc
     def delete(self, product_id):
         product = self.storage.delete(product_id)
-        return schemas.Product().dump(product).data
+        self.event_dispatcher('product_deleted', {'product_id': product_id})
+        return schemas.product_schema.dump(product).data
     
     @rpc
     def exist(self, product_id):
         return self.storage.exist(product_id)
+
+    @rpc
+    def exists_many(self, product_ids):
+        return self.storage.exists_many(product_ids)
         
+    @rpc
+    def reserve_stock(self, product_ids_quantities):
+        in_stock = self.storage.reserve_stock(product_ids_quantities)
+        for product_id in in_stock:
+            self.event_dispatcher(
+                'product_updated', {'product_id': product_id})
+        return in_stock
+
+    @rpc
+    def release_stock(self, product_ids_quantities):
+        in_stock = self.storage.release_stock(product_ids_quantities)
+        for product_id in in_stock:
+            self.event_dispatcher(
+                'product_updated', {'product_id': product_id})
+        return in_stock
+
     @event_handler('orders', 'order_created')
     def handle_order_created(self, payload):
+        if payload.get('stock_reserved'):
+            # stock was already reserved when the order was created
+            return
         order_details = payload['order']['order_details']
         product_ids_quantities = { order_detail['product_id'] : order_detail['quantity'] for order_detail in order_details }
         self.storage.decrement_stock(product_ids_quantities)
+        for product_id in product_ids_quantities:
+            self.event_dispatcher(
+                'product_updated', {'product_id': product_id})
@@ -11,9 +11,16 @@ setup(
     install_requires=[
         "marshmallow==2.19.2",
         "nameko==v3.0.0-rc6",
-        "redis==3.2.1",
+        "nameko-examples-common==0.0.1",
+        "redis==3.5.3",
     ],
     extras_require={
+        'hiredis': [
+            'hiredis==1.1.0',
+        ],
+        'msgpack': [
+            'msgpack==1.0.4',
+        ],
         'dev': [
             'pytest==4.5.0',
             'coverage==4.5.3',
@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+
+import pytest
+from mock import Mock, patch
+from nameko import config
+from redis.connection import Connection
+
+from products.dependencies import Storage
+
+
+@pytest.fixture
+def storage(test_config):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    provider.setup()
+    return provider.get_dependency({})
+
+
+@pytest.fixture
+def count_round_trips():
+    """ Returns a context manager counting the requests sent to Redis
+    while it is active. A pipeline is sent as a single request. """
+
+    @contextmanager
+    def count():
+        send = Connection.send_packed_command
+        with patch.object(
+            Connection, 'send_packed_command', autospec=True,
+            side_effect=send
+        ) as send_packed_command:
+            yield send_packed_command
+
+    return count
@@ -0,0 +1,48 @@
+""" Compares checking products one at a time with `exists_many`.
+
+Validating an order used to call `exist` once per order line. Checking
+the whole set at once has to take a single Redis round trip however many
+products are checked.
+"""
+import time
+
+import pytest
+
+
+PRODUCT_COUNT = 1000
+
+
+@pytest.fixture
+def product_ids(create_product):
+    return [
+        create_product(id='LZ{}'.format(index))['id']
+        for index in range(PRODUCT_COUNT)
+    ]
+
+
+def test_exists_many_round_trips(storage, count_round_trips, product_ids):
+    # connect first, so the connection handshake is not counted
+    storage.exist(product_ids[0])
+
+    with count_round_trips() as single_round_trips:
+        start = time.time()
+        single = {
+            product_id: storage.exist(product_id)
+            for product_id in product_ids
+        }
+        single_elapsed = time.time() - start
+
+    with count_round_trips() as many_round_trips:
+        start = time.time()
+        many = storage.exists_many(product_ids)
+        many_elapsed = time.time() - start
+
+    print('exist: {} products, {} round trips, {:.3f}s'.format(
+        PRODUCT_COUNT, single_round_trips.call_count, single_elapsed))
+    print('exists_many: {} products, {} round trips, {:.3f}s'.format(
+        PRODUCT_COUNT, many_round_trips.call_count, many_elapsed))
+
+    assert single == many
+    assert all(many.values())
+    assert PRODUCT_COUNT == single_round_trips.call_count
+    assert 1 == many_round_trips.call_count
@@ -39,6 +39,7 @@ def create_product(redis_client, product):
         redis_client.hmset(
             'products:{}'.format(new_product['id']),
             new_product)
+        redis_client.zadd('products-index', {new_product['id']: 0})
         return new_product
     return create
 
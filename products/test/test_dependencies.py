@@ -1,16 +1,38 @@
+import logging
+
 import pytest
+import redis
 from mock import Mock
 
 from nameko import config
-from products.dependencies import Storage
+from products.dependencies import (
+    MSGPACK_FORMAT, PRODUCT_STORAGE_FORMAT_KEY, REDIS_MAX_CONNECTIONS_KEY,
+    REDIS_POOL_TIMEOUT_KEY, Storage)
 
 
 @pytest.fixture
-def storage(test_config):
+def storage_provider(test_config):
     provider = Storage()
     provider.container = Mock(config=config)
     provider.setup()
-    return provider.get_dependency({})
+    yield provider
+    provider.stop()
+
+
+@pytest.fixture
+def storage(storage_provider):
+    return storage_provider.get_dependency({})
+
+
+@pytest.fixture
+def compact_storage(test_config):
+    pytest.importorskip('msgpack')
+    with config.patch({PRODUCT_STORAGE_FORMAT_KEY: MSGPACK_FORMAT}):
+        provider = Storage()
+        provider.container = Mock(config=config)
+        provider.setup()
+    yield provider.get_dependency({})
+    provider.stop()
 
 
 def test_get_fails_on_not_found(storage):
@@ -28,17 +50,96 @@ def test_get(storage, products):
     assert 11 == product['in_stock']
 
 
+def test_get_many(storage, products):
+    loaded_products = storage.get_many(['LZ127', 'LZ130', 'unknown'])
+    assert {'LZ127', 'LZ130'} == set(loaded_products)
+    assert products[0] == loaded_products['LZ127']
+    assert products[2] == loaded_products['LZ130']
+
+
+def test_get_many_when_empty(storage):
+    assert {} == storage.get_many([])
+
+
+def test_get_fields(storage, products):
+    assert {'id': 'LZ129', 'in_stock': 11} == storage.get(
+        'LZ129', fields=['id', 'in_stock'])
+
+    with pytest.raises(storage.NotFound):
+        storage.get('unknown', fields=['title'])
+
+
+def test_get_many_fields(storage, products):
+    assert {
+        'LZ127': {'title': 'LZ 127 Graf Zeppelin'},
+        'LZ130': {'title': 'LZ 130 Graf Zeppelin II'},
+    } == storage.get_many(['LZ127', 'LZ130', 'unknown'], fields=['title'])
+
+
+def test_get_unknown_fields(storage, products):
+    with pytest.raises(ValueError) as exc:
+        storage.get('LZ127', fields=['id', 'colour'])
+    assert 'Unknown product fields: colour' == exc.value.args[0]
+
+
 def test_list(storage, products):
     listed_products = storage.list()
     assert (
         products == sorted(list(listed_products), key=lambda x: x['id']))
 
+
+def test_list_page(storage, products):
+    assert products[1:] == list(storage.list(offset=1))
+    assert products[:2] == list(storage.list(limit=2))
+    assert products[1:2] == list(storage.list(offset=1, limit=1))
+    assert [] == list(storage.list(offset=3))
+
+
+def test_list_in_batches(storage, create_product, monkeypatch):
+    monkeypatch.setattr('products.dependencies.LIST_BATCH_SIZE', 2)
+    products = [create_product(id='LZ{}'.format(id_)) for id_ in range(5)]
+
+    assert products == list(storage.list())
+    assert products[1:4] == list(storage.list(offset=1, limit=3))
+
+
+def test_list_skips_stale_index_entries(storage, products, redis_client):
+    redis_client.delete('products:LZ129')
+    assert [products[0], products[2]] == list(storage.list())
+
+
+def test_rebuild_index(storage, products, redis_client):
+    redis_client.delete('products-index')
+    assert [] == list(storage.list())
+
+    storage.rebuild_index()
+
+    assert products == list(storage.list())
+
+
+def test_product_named_index(storage, product, products):
+    storage.create(dict(product, id='index'))
+
+    assert 'index' == storage.get('index')['id']
+    assert ['LZ127', 'LZ129', 'LZ130', 'index'] == [
+        stored['id'] for stored in storage.list()]
+
+
 def test_exist(storage, products):
     is_created = storage.exist(products[0]['id'])
     assert True == is_created
     is_not_created = storage.exist('000000')
     assert False == is_not_created
 
+
+def test_exists_many(storage, products):
+    assert storage.exists_many(['LZ127', '000000', 'LZ130']) == {
+        'LZ127': True,
+        '000000': False,
+        'LZ130': True,
+    }
+
+
 def test_create(product, redis_client, storage):
 
     storage.create(product)
@@ -51,6 +152,25 @@ def test_create(product, redis_client, storage):
     assert product['passenger_capacity'] == (
         int(stored_product[b'passenger_capacity']))
     assert product['in_stock'] == int(stored_product[b'in_stock'])
+    assert [product] == list(storage.list())
+
+
+def test_create_many(product, redis_client, storage):
+    products = [
+        dict(product, id='LZ{}'.format(index)) for index in range(5)
+    ]
+
+    assert storage.create_many(products, batch_size=2) == [
+        'LZ0', 'LZ1', 'LZ2', 'LZ3', 'LZ4'
+    ]
+
+    assert products == list(storage.list())
+    assert redis_client.zcard('products-index') == 5
+
+
+def test_create_many_with_no_products(redis_client, storage):
+    assert storage.create_many([]) == []
+    assert not redis_client.exists('products-index')
 
 
 def test_decrement_stock(storage, create_product, redis_client):
@@ -69,9 +189,157 @@ def test_decrement_stock(storage, create_product, redis_client):
     assert b'7' == product_two[b'in_stock']
     assert b'12' == product_three[b'in_stock']
 
-def test_delete(storage, products):
+
+def test_decrement_stock_many(storage, products, redis_client):
+    in_stock = storage.decrement_stock({'LZ127': 3, 'LZ130': 12})
+
+    assert {'LZ127': 7, 'LZ130': 0} == in_stock
+
+
+def test_release_stock(storage, products):
+    in_stock = storage.release_stock({'LZ127': 3})
+
+    assert {'LZ127': 13} == in_stock
+
+
+def test_reserve_stock(storage, products, redis_client):
+    in_stock = storage.reserve_stock({'LZ127': 10, 'LZ129': 1})
+
+    assert {'LZ127': 0, 'LZ129': 10} == in_stock
+    assert b'0' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'10' == redis_client.hget('products:LZ129', 'in_stock')
+    assert b'12' == redis_client.hget('products:LZ130', 'in_stock')
+
+
+def test_reserve_stock_fails_when_out_of_stock(
+    storage, products, redis_client
+):
+    with pytest.raises(storage.OutOfStock) as exc:
+        storage.reserve_stock({'LZ127': 1, 'LZ129': 12})
+
+    assert 'Product ID LZ129 is out of stock' == exc.value.args[0]
+    # nothing is reserved, not even the lines that were in stock
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+
+
+def test_reserve_stock_fails_on_not_found(storage, products, redis_client):
+    with pytest.raises(storage.NotFound) as exc:
+        storage.reserve_stock({'LZ127': 1, 'LZ000': 1})
+
+    assert 'Product ID LZ000 does not exist' == exc.value.args[0]
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+
+
+def test_delete(storage, products, redis_client):
     first_product_id = products[0]['id']
     storage.delete(first_product_id)
     list_ids = {prod['id'] for prod in storage.list()}
     assert (first_product_id not in list_ids)
-    
\ No newline at end of file
+    assert not redis_client.zscore('products-index', first_product_id)
+
+
+def test_pool_holds_a_connection_per_worker(storage, products):
+    assert storage.pool_stats() == {
+        'max': 10, 'in_use': 0, 'idle': 0, 'waiting': 0, 'timeouts': 0}
+
+    storage.get('LZ127')
+
+    assert storage.pool_stats() == {
+        'max': 10, 'in_use': 0, 'idle': 1, 'waiting': 0, 'timeouts': 0}
+
+
+def test_waiting_for_a_connection_times_out(test_config, products):
+    with config.patch({
+        REDIS_MAX_CONNECTIONS_KEY: 1, REDIS_POOL_TIMEOUT_KEY: 0.01
+    }):
+        provider = Storage()
+        provider.container = Mock(config=config)
+        provider.setup()
+    storage = provider.get_dependency({})
+
+    connection = provider.pool.get_connection('HGETALL')
+    with pytest.raises(redis.ConnectionError):
+        storage.get('LZ127')
+
+    assert storage.pool_stats() == {
+        'max': 1, 'in_use': 1, 'idle': 0, 'waiting': 0, 'timeouts': 1}
+
+    provider.pool.release(connection)
+    assert storage.get('LZ127')['id'] == 'LZ127'
+    provider.stop()
+
+
+def test_stop_closes_the_connections(storage_provider, storage, products):
+    storage.get('LZ127')
+    connection, = storage_provider.pool._connections
+
+    storage_provider.stop()
+
+    assert connection._sock is None
+
+
+def test_compact_create_and_get(compact_storage, product, redis_client):
+    compact_storage.create(product)
+
+    assert redis_client.type('products:LZ127') == b'string'
+    assert product == compact_storage.get('LZ127')
+    assert {'title': 'LZ 127'} == compact_storage.get(
+        'LZ127', fields=['title'])
+    assert [product] == list(compact_storage.list())
+    assert compact_storage.exist('LZ127')
+    assert {'LZ127': True, 'LZ000': False} == compact_storage.exists_many(
+        ['LZ127', 'LZ000'])
+
+
+def test_compact_reads_products_not_converted(compact_storage, products):
+    assert products[1] == compact_storage.get('LZ129')
+    assert {'LZ127': {'id': 'LZ127'}} == compact_storage.get_many(
+        ['LZ127', 'unknown'], fields=['id'])
+
+
+def test_compact_stock(compact_storage, products, redis_client):
+    compact_storage.create(dict(products[0], id='LZ1', in_stock=5))
+
+    assert {'LZ1': 2, 'LZ127': 8} == compact_storage.reserve_stock(
+        {'LZ1': 3, 'LZ127': 2})
+    with pytest.raises(compact_storage.OutOfStock):
+        compact_storage.reserve_stock({'LZ1': 3})
+    assert {'LZ1': 4} == compact_storage.release_stock({'LZ1': 2})
+    assert {'LZ1': 0} == compact_storage.decrement_stock({'LZ1': 4})
+    assert 0 == compact_storage.get('LZ1')['in_stock']
+    assert b'8' == redis_client.hget('products:LZ127', 'in_stock')
+
+
+def test_convert(compact_storage, products, redis_client):
+    assert 3 == compact_storage.convert(compact=True, batch_size=2)
+
+    assert redis_client.type('products:LZ127') == b'string'
+    assert redis_client.type('products-index') == b'zset'
+    assert products == list(compact_storage.list())
+    assert 0 == compact_storage.convert(compact=True)
+
+    assert 3 == compact_storage.convert(compact=False)
+
+    assert redis_client.type('products:LZ127') == b'hash'
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+    assert products == list(compact_storage.list())
+
+
+def test_workers_share_the_registered_scripts(storage_provider):
+    first = storage_provider.get_dependency({})
+    second = storage_provider.get_dependency({})
+
+    assert first.scripts is second.scripts
+
+
+def test_hiredis_is_not_used_by_default(test_config, caplog):
+    provider = Storage()
+    provider.container = Mock(config=config)
+    with caplog.at_level(logging.WARNING):
+        provider.setup()
+    provider.stop()
+
+    assert provider.pool.connection_kwargs['parser_class'] is (
+        redis.connection.PythonParser)
+    assert not caplog.records
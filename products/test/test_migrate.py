@@ -0,0 +1,15 @@
+import yaml
+
+from nameko import config
+from products.dependencies import REDIS_URI_KEY
+from products.migrate import main
+
+
+def test_main(test_config, products, redis_client, tmpdir, capsys):
+    config_file = tmpdir.join('config.yml')
+    config_file.write(yaml.dump({REDIS_URI_KEY: config[REDIS_URI_KEY]}))
+
+    assert 0 == main(['--config', str(config_file), 'msgpack'])
+
+    assert 'Converted 3 products to msgpack\n' == capsys.readouterr().out
+    assert redis_client.type('products:LZ129') == b'string'
@@ -2,9 +2,13 @@ from marshmallow.exceptions import ValidationError
 from nameko.testing.services import entrypoint_hook
 from nameko.standalone.events import event_dispatcher
 from nameko.testing.services import entrypoint_waiter
+from nameko.testing.services import replace_dependencies
+from mock import call
 import pytest
 
+from products import metrics
 from products.dependencies import NotFound
+from products.exceptions import OutOfStock
 from products.service import ProductsService
 
 
@@ -15,6 +19,17 @@ def service_container(test_config, container_factory):
     return container
 
 
+@pytest.fixture
+def mock_event_dispatcher(test_config, container_factory):
+    """ Starts the service with `event_dispatcher` mocked and returns
+    the mock """
+    container = container_factory(ProductsService)
+    dispatcher = replace_dependencies(container, 'event_dispatcher')
+    container.start()
+    dispatcher.container = container
+    return dispatcher
+
+
 def test_get_product(create_product, service_container):
 
     stored_product = create_product()
@@ -25,6 +40,16 @@ def test_get_product(create_product, service_container):
     assert stored_product == loaded_product
 
 
+def test_get_product_fields(create_product, service_container):
+
+    stored_product = create_product()
+
+    with entrypoint_hook(service_container, 'get') as get:
+        loaded_product = get(stored_product['id'], ['id', 'title'])
+
+    assert {'id': 'LZ127', 'title': 'LZ 127'} == loaded_product
+
+
 def test_get_product_fails_on_not_found(service_container):
 
     with pytest.raises(NotFound):
@@ -32,6 +57,50 @@ def test_get_product_fails_on_not_found(service_container):
             get(111)
 
 
+def test_get_metrics(service_container):
+    metrics.registry.clear()
+
+    with pytest.raises(NotFound):
+        with entrypoint_hook(service_container, 'get') as get:
+            get(111)
+    with entrypoint_hook(service_container, 'get_metrics') as get_metrics:
+        snapshot = get_metrics()
+
+    families = {family['name']: family for family in snapshot}
+    assert [
+        (sample['labels'], sample['count'])
+        for sample in families['entrypoint_duration_seconds']['samples']
+    ] == [({'service': 'products', 'entrypoint': 'get'}, 1)]
+    assert families['entrypoint_errors_total']['samples'] == [{
+        'labels': {
+            'service': 'products', 'entrypoint': 'get', 'error': 'NotFound'
+        },
+        'value': 1,
+    }]
+    assert {
+        sample['labels']['state']: sample['value']
+        for sample in families['redis_pool_connections']['samples']
+    } == {'max': 10, 'in_use': 0, 'idle': 1, 'waiting': 0}
+    assert families['redis_pool_timeouts_total']['samples'] == [
+        {'labels': {'service': 'products'}, 'value': 0}]
+
+
+def test_get_many_products(products, service_container):
+
+    with entrypoint_hook(service_container, 'get_many') as get_many:
+        loaded_products = get_many(['LZ129', 'unknown'])
+
+    assert {'LZ129': products[1]} == loaded_products
+
+
+def test_get_many_products_fields(products, service_container):
+
+    with entrypoint_hook(service_container, 'get_many') as get_many:
+        loaded_products = get_many(['LZ129', 'unknown'], ['in_stock'])
+
+    assert {'LZ129': {'in_stock': 11}} == loaded_products
+
+
 def test_list_products(products, service_container):
 
     with entrypoint_hook(service_container, 'list') as list_:
@@ -40,6 +109,14 @@ def test_list_products(products, service_container):
     assert products == sorted(listed_products, key=lambda p: p['id'])
 
 
+def test_list_products_page(products, service_container):
+
+    with entrypoint_hook(service_container, 'list') as list_:
+        listed_products = list_(offset=1, limit=1)
+
+    assert [products[1]] == listed_products
+
+
 def test_list_productis_when_empty(service_container):
 
     with entrypoint_hook(service_container, 'list') as list_:
@@ -48,6 +125,14 @@ def test_list_productis_when_empty(service_container):
     assert [] == listed_products
 
 
+def test_exists_many(products, service_container):
+
+    with entrypoint_hook(service_container, 'exists_many') as exists_many:
+        exists = exists_many(['LZ127', 'LZ000'])
+
+    assert exists == {'LZ127': True, 'LZ000': False}
+
+
 def test_create_product(product, redis_client, service_container):
 
     with entrypoint_hook(service_container, 'create') as create:
@@ -170,4 +255,160 @@ def test_delete_product_fails_on_not_found(service_container):
 
     with pytest.raises(NotFound):
         with entrypoint_hook(service_container, 'delete') as delete:
-            delete(111)
\ No newline at end of file
+            delete(111)
+
+
+def test_create_product_dispatches_product_updated(
+    product, redis_client, mock_event_dispatcher
+):
+
+    container = mock_event_dispatcher.container
+    with entrypoint_hook(container, 'create') as create:
+        create(product)
+
+    assert [
+        call('product_updated', {'product_id': 'LZ127'})
+    ] == mock_event_dispatcher.call_args_list
+
+
+def test_create_many_products(product, redis_client, mock_event_dispatcher):
+
+    products = [
+        dict(product, id='LZ1'),
+        dict(product, id='LZ2', in_stock='not-an-integer'),
+        'not-a-product',
+        dict(product, id='LZ3'),
+    ]
+
+    container = mock_event_dispatcher.container
+    with entrypoint_hook(container, 'create_many') as create_many:
+        results = create_many(products)
+
+    assert results == [
+        {'id': 'LZ1', 'status': 'created'},
+        {
+            'index': 1,
+            'status': 'invalid',
+            'errors': {'in_stock': ['Not a valid integer.']}
+        },
+        {
+            'index': 2,
+            'status': 'invalid',
+            'errors': ['Invalid input type.']
+        },
+        {'id': 'LZ3', 'status': 'created'},
+    ]
+    assert redis_client.exists('products:LZ1', 'products:LZ3') == 2
+    assert not redis_client.exists('products:LZ2')
+    assert [
+        call('products_updated', {'product_ids': ['LZ1', 'LZ3']})
+    ] == mock_event_dispatcher.call_args_list
+
+
+def test_create_many_products_all_invalid(mock_event_dispatcher):
+
+    container = mock_event_dispatcher.container
+    with entrypoint_hook(container, 'create_many') as create_many:
+        results = create_many([{'id': 'LZ1'}])
+
+    assert [result['status'] for result in results] == ['invalid']
+    assert not mock_event_dispatcher.called
+
+
+def test_delete_product_dispatches_product_deleted(
+    create_product, mock_event_dispatcher
+):
+
+    stored_product = create_product()
+
+    container = mock_event_dispatcher.container
+    with entrypoint_hook(container, 'delete') as delete:
+        delete(stored_product['id'])
+
+    assert [
+        call('product_deleted', {'product_id': 'LZ127'})
+    ] == mock_event_dispatcher.call_args_list
+
+
+def test_handle_order_created_dispatches_product_updated(
+    products, mock_event_dispatcher
+):
+
+    payload = {
+        'order': {
+            'order_details': [
+                {'product_id': 'LZ129', 'quantity': 2},
+                {'product_id': 'LZ127', 'quantity': 4},
+            ]
+        }
+    }
+
+    with entrypoint_hook(
+        mock_event_dispatcher.container, 'handle_order_created'
+    ) as handle_order_created:
+        handle_order_created(payload)
+
+    assert [
+        call('product_updated', {'product_id': 'LZ129'}),
+        call('product_updated', {'product_id': 'LZ127'}),
+    ] == mock_event_dispatcher.call_args_list
+
+
+def test_reserve_stock(products, redis_client, mock_event_dispatcher):
+
+    container = mock_event_dispatcher.container
+    with entrypoint_hook(container, 'reserve_stock') as reserve_stock:
+        in_stock = reserve_stock({'LZ127': 4})
+
+    assert {'LZ127': 6} == in_stock
+    assert b'6' == redis_client.hget('products:LZ127', 'in_stock')
+    assert [
+        call('product_updated', {'product_id': 'LZ127'})
+    ] == mock_event_dispatcher.call_args_list
+
+
+def test_reserve_stock_fails_when_out_of_stock(
+    products, redis_client, mock_event_dispatcher
+):
+
+    container = mock_event_dispatcher.container
+    with pytest.raises(OutOfStock):
+        with entrypoint_hook(container, 'reserve_stock') as reserve_stock:
+            reserve_stock({'LZ127': 11})
+
+    assert b'10' == redis_client.hget('products:LZ127', 'in_stock')
+    assert not mock_event_dispatcher.called
+
+
+def test_release_stock(products, redis_client, mock_event_dispatcher):
+
+    container = mock_event_dispatcher.container
+    with entrypoint_hook(container, 'release_stock') as release_stock:
+        in_stock = release_stock({'LZ127': 4})
+
+    assert {'LZ127': 14} == in_stock
+    assert [
+        call('product_updated', {'product_id': 'LZ127'})
+    ] == mock_event_dispatcher.call_args_list
+
+
+def test_handle_order_created_skips_reserved_stock(
+    products, redis_client, mock_event_dispatcher
+):
+
+    payload = {
+        'order': {
+            'order_details': [
+                {'product_id': 'LZ129', 'quantity': 2},
+            ]
+        },
+        'stock_reserved': True,
+    }
+
+    with entrypoint_hook(
+        mock_event_dispatcher.container, 'handle_order_created'
+    ) as handle_order_created:
+        handle_order_created(payload)
+
+    assert b'11' == redis_client.hget('products:LZ129', 'in_stock')
+    assert not mock_event_dispatcher.called
@@ -0,0 +1,211 @@
+""" Benchmarks the whole stack in one process.
+
+Boots the gateway, orders and products services against local stand-ins
+for RabbitMQ, Redis and PostgreSQL (see `stack`), drives the
+``test/nex-bzt.yml`` scenario at the given concurrency (see `scenarios`)
+and writes the p50/p95/p99 latency and throughput of each endpoint to
+JSON ::
+
+    python test/bench/bench.py run --concurrency 8 --duration 60 \\
+        --output bench.json
+
+Compare a result with a stored baseline; the command fails if an endpoint
+got slower, or lost throughput, by more than the tolerance ::
+
+    python test/bench/bench.py compare baseline.json bench.json
+
+``run --baseline baseline.json`` does both at once.
+"""
+import eventlet
+eventlet.monkey_patch()  # before requests and nameko import socket
+
+import argparse  # noqa: E402
+import datetime  # noqa: E402
+import json  # noqa: E402
+import platform  # noqa: E402
+import sys  # noqa: E402
+
+import scenarios  # noqa: E402
+import stack  # noqa: E402
+
+
+DEFAULT_PORT = 8765
+DEFAULT_CONCURRENCY = 4
+DEFAULT_DURATION = 30
+DEFAULT_WARMUP = 5
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_METRICS = ['p50', 'p95', 'throughput']
+
+LATENCY_METRICS = ['p50', 'p95', 'p99']
+
+
+def run(args):
+    with stack.running_stack(
+        args.port, amqp_uri=args.amqp_uri, db_uri=args.db_uri,
+        redis_uri=args.redis_uri
+    ) as (base_url, backends):
+        recorder = scenarios.run(
+            base_url, args.concurrency, args.duration, args.warmup)
+
+    result = {
+        'meta': {
+            'started_at': datetime.datetime.utcfromtimestamp(
+                recorder.start).isoformat(),
+            'concurrency': args.concurrency,
+            'duration': recorder.finish - recorder.start,
+            'warmup': args.warmup,
+            'backends': backends,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'endpoints': scenarios.summarise(recorder),
+    }
+    print_result(result)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            return report_regressions(
+                json.load(baseline), result, args.tolerance, args.metrics)
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as baseline, open(args.result) as result:
+        return report_regressions(
+            json.load(baseline), json.load(result), args.tolerance,
+            args.metrics)
+
+
+def find_regressions(baseline, result, tolerance, metrics):
+    """ Yields ``(endpoint, metric, baseline value, result value)`` for
+    every metric that is worse in `result` than in `baseline` by more than
+    `tolerance` (a fraction of the baseline value).
+
+    Latencies regress when they grow and throughput when it drops. An
+    endpoint that started failing requests always regresses.
+    """
+    for endpoint, expected in sorted(baseline['endpoints'].items()):
+        actual = result['endpoints'].get(endpoint)
+        if actual is None:
+            yield endpoint, 'requests', expected['requests'], 0
+            continue
+
+        if actual['errors'] and not expected['errors']:
+            yield endpoint, 'errors', expected['errors'], actual['errors']
+
+        for metric in metrics:
+            if metric == 'throughput':
+                if actual['throughput'] < (
+                    expected['throughput'] * (1 - tolerance)
+                ):
+                    yield (endpoint, metric, expected['throughput'],
+                           actual['throughput'])
+            elif 'latency_ms' in expected:
+                limit = expected['latency_ms'][metric] * (1 + tolerance)
+                value = actual.get('latency_ms', {}).get(metric)
+                if value is None or value > limit:
+                    yield (endpoint, metric,
+                           expected['latency_ms'][metric], value)
+
+
+def report_regressions(baseline, result, tolerance, metrics):
+    regressions = list(
+        find_regressions(baseline, result, tolerance, metrics))
+    for endpoint, metric, expected, actual in regressions:
+        print('REGRESSION {} {}: {} -> {}'.format(
+            endpoint, metric, format_value(expected), format_value(actual)))
+    if regressions:
+        return 1
+    print('No regressions against the baseline (tolerance {:.0%})'.format(
+        tolerance))
+    return 0
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return str(value)
+
+
+def print_result(result):
+    header = '{:<16} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms')
+    print(header)
+    print('-' * len(header))
+    for endpoint in scenarios.ENDPOINTS:
+        summary = result['endpoints'][endpoint]
+        latency = summary.get('latency_ms', {})
+        print('{:<16} {:>8} {:>7} {:>9.1f} {:>9} {:>9} {:>9}'.format(
+            endpoint, summary['requests'], summary['errors'],
+            summary['throughput'],
+            *(format_value(latency.get(metric, '-'))
+              for metric in LATENCY_METRICS)
+        ))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the gateway, orders and products services.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def add_compare_arguments(command):
+        command.add_argument(
+            '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+            help='allowed change, as a fraction of the baseline value '
+                 '(default: %(default)s)')
+        command.add_argument(
+            '--metrics', nargs='+', default=DEFAULT_METRICS,
+            choices=LATENCY_METRICS + ['throughput'],
+            help='metrics compared with the baseline (default: %(default)s)')
+
+    run_command = commands.add_parser(
+        'run', help='run the benchmark and report the results')
+    run_command.set_defaults(func=run)
+    run_command.add_argument(
+        '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+        help='number of virtual users (default: %(default)s)')
+    run_command.add_argument(
+        '--duration', type=float, default=DEFAULT_DURATION,
+        help='seconds to measure for (default: %(default)s)')
+    run_command.add_argument(
+        '--warmup', type=float, default=DEFAULT_WARMUP,
+        help='seconds to run before measuring (default: %(default)s)')
+    run_command.add_argument(
+        '--port', type=int, default=DEFAULT_PORT,
+        help='port the gateway listens on (default: %(default)s)')
+    run_command.add_argument(
+        '--amqp-uri', help='RabbitMQ to use instead of an in-memory broker')
+    run_command.add_argument(
+        '--db-uri', help='scratch PostgreSQL database to use (it is '
+                         'emptied) instead of SQLite')
+    run_command.add_argument(
+        '--redis-uri', help='Redis to use instead of fakeredis')
+    run_command.add_argument(
+        '--output', help='file to write the results to, as JSON')
+    run_command.add_argument(
+        '--baseline', help='results to compare with, failing on regressions')
+    add_compare_arguments(run_command)
+
+    compare_command = commands.add_parser(
+        'compare', help='compare results with a baseline')
+    compare_command.set_defaults(func=compare)
+    compare_command.add_argument('baseline', help='baseline results')
+    compare_command.add_argument('result', help='results to check')
+    add_compare_arguments(compare_command)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
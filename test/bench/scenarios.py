@@ -0,0 +1,157 @@
+""" Drives the scenario of ``test/nex-bzt.yml`` against the gateway and
+summarises the latencies it records.
+
+Each virtual user repeats the six requests of the bzt scenario, in order:
+create a product, get it, order it, get the order, list orders and delete
+the product. As in bzt, an iteration whose order could not be created
+skips to the next iteration.
+"""
+import csv
+import itertools
+import math
+import os
+import time
+import uuid
+
+import eventlet
+import requests
+
+
+USERS_CSV = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'nex-users.csv')
+
+ENDPOINTS = [
+    'products-create',
+    'product-get',
+    'orders-create',
+    'order-get',
+    'orders-list',
+    'product-delete',
+]
+
+
+def load_products(path=USERS_CSV):
+    with open(path) as users_csv:
+        return [
+            {
+                'id': row['id'],
+                'title': row['title'],
+                'passenger_capacity': int(row['passenger_capacity']),
+                'maximum_speed': int(row['maximum_speed']),
+                'in_stock': int(row['in_stock']),
+            }
+            for row in csv.DictReader(users_csv, delimiter=';')
+        ]
+
+
+class Recorder:
+    """ Collects the latency and outcome of every request, per endpoint.
+
+    Requests completed before `start` (the warm-up) are not kept.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.finish = None
+        self.samples = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+
+    def request(self, endpoint, session, method, url, expected_status,
+                **kwargs):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            response = None
+        finished = time.perf_counter()
+
+        ok = response is not None and response.status_code == expected_status
+        if time.time() >= self.start:
+            self.samples[endpoint].append(finished - started)
+            if not ok:
+                self.errors[endpoint] += 1
+        return response if ok else None
+
+
+def run_iteration(session, base_url, product, recorder):
+    product = dict(product, id='{}-{}'.format(product['id'], uuid.uuid4()))
+    products_url = '{}/products'.format(base_url)
+    product_url = '{}/{}'.format(products_url, product['id'])
+    orders_url = '{}/orders'.format(base_url)
+
+    recorder.request(
+        'products-create', session, 'POST', products_url, 200, json=product)
+    recorder.request('product-get', session, 'GET', product_url, 200)
+
+    response = recorder.request(
+        'orders-create', session, 'POST', orders_url, 200, json={
+            'order_details': [{
+                'product_id': product['id'],
+                'price': '100000.99',
+                'quantity': 1,
+            }]
+        })
+    if response is not None:
+        order_url = '{}/{}'.format(orders_url, response.json()['id'])
+        recorder.request('order-get', session, 'GET', order_url, 200)
+        recorder.request('orders-list', session, 'GET', orders_url, 200)
+
+    recorder.request('product-delete', session, 'DELETE', product_url, 204)
+
+
+def run_user(base_url, products, recorder, deadline):
+    with requests.Session() as session:
+        for product in itertools.cycle(products):
+            if time.time() >= deadline:
+                return
+            run_iteration(session, base_url, product, recorder)
+
+
+def run(base_url, concurrency, duration, warmup, products=None):
+    """ Runs `concurrency` virtual users for `warmup` plus `duration`
+    seconds, returning the `Recorder` of the measured requests.
+    """
+    products = products or load_products()
+    start = time.time() + warmup
+    recorder = Recorder(start)
+
+    pool = eventlet.GreenPool(concurrency)
+    for user in range(concurrency):
+        # users start at different rows, like bzt's shared data source
+        offset = user % len(products)
+        pool.spawn(
+            run_user, base_url, products[offset:] + products[:offset],
+            recorder, start + duration)
+    pool.waitall()
+    recorder.finish = time.time()
+    return recorder
+
+
+def percentile(samples, percent):
+    """ Nearest-rank percentile of sorted `samples` """
+    rank = max(1, int(math.ceil(percent / 100.0 * len(samples))))
+    return samples[rank - 1]
+
+
+def summarise(recorder):
+    """ Returns the request count, error count, throughput (requests per
+    second) and latency percentiles (in milliseconds) of each endpoint.
+    """
+    duration = recorder.finish - recorder.start
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        samples = sorted(recorder.samples[endpoint])
+        summary = {
+            'requests': len(samples),
+            'errors': recorder.errors[endpoint],
+            'throughput': len(samples) / duration,
+        }
+        if samples:
+            summary['latency_ms'] = {
+                'p50': percentile(samples, 50) * 1000,
+                'p95': percentile(samples, 95) * 1000,
+                'p99': percentile(samples, 99) * 1000,
+                'mean': sum(samples) / len(samples) * 1000,
+            }
+        endpoints[endpoint] = summary
+    return endpoints
@@ -0,0 +1,165 @@
+""" Boots the gateway, orders and products services in this process.
+
+The services are configured from the repository's ``config.yml``, with
+each backing service replaced by a local stand-in unless a real one is
+given:
+
+* AMQP: kombu's in-memory transport (``memory://``), or ``--amqp-uri``
+* Redis: fakeredis, or ``--redis-uri`` (a local ``redis-server``)
+* PostgreSQL: a temporary SQLite file, or ``--db-uri`` (a scratch
+  database, which is emptied)
+"""
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import requests
+
+
+REPO_ROOT = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+SERVICE_PACKAGES = ['common', 'gateway', 'orders', 'products']
+
+MEMORY_AMQP_URI = 'memory://'
+MEMORY_POLLING_INTERVAL = 0.001
+
+
+def add_service_paths():
+    for package in SERVICE_PACKAGES:
+        path = os.path.join(REPO_ROOT, package)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def use_fakeredis():
+    """ Points every Redis client the services create at one in-process
+    fakeredis server.
+    """
+    import fakeredis
+    import redis
+
+    server = fakeredis.FakeServer()
+
+    def pool_from_url(cls, url, db=None, **kwargs):
+        # fakeredis connections never record a reply as a health check,
+        # so with checks enabled every command would be preceded by a PING
+        kwargs.pop('health_check_interval', None)
+        return cls(
+            connection_class=fakeredis.FakeConnection, server=server,
+            **kwargs)
+
+    redis.ConnectionPool.from_url = classmethod(pool_from_url)
+
+
+def fix_memory_transport():
+    """ Messages published over kombu's in-memory transport lose their
+    ``content_type`` property, which nameko needs to deserialize them, and
+    its consumers poll for messages once a second, which would dominate
+    every latency measured.
+    """
+    from kombu.transport import memory, virtual
+
+    memory.Transport.polling_interval = MEMORY_POLLING_INTERVAL
+
+    init = virtual.Message.__init__
+
+    def message_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        self.properties.setdefault('content_type', self.content_type)
+
+    virtual.Message.__init__ = message_init
+
+
+def load_config(port, amqp_uri, db_uri, redis_uri):
+    from nameko.cli.utils.config import load_config
+
+    with open(os.path.join(REPO_ROOT, 'config.yml')) as config_file:
+        config = load_config(config_file)
+
+    config.update({
+        'AMQP_URI': amqp_uri,
+        'DB_URIS': {'orders:Base': db_uri},
+        'REDIS_URI': redis_uri,
+        'WEB_SERVER_ADDRESS': '127.0.0.1:{}'.format(port),
+    })
+    return config
+
+
+def create_schema(db_uri):
+    from sqlalchemy import create_engine
+
+    from orders.models import DeclarativeBase
+
+    engine = create_engine(db_uri)
+    DeclarativeBase.metadata.drop_all(engine)
+    DeclarativeBase.metadata.create_all(engine)
+    engine.dispose()
+
+
+def wait_until_up(base_url, timeout=30):
+    import eventlet
+
+    with eventlet.Timeout(timeout):
+        while True:
+            try:
+                requests.get('{}/products?limit=1'.format(base_url))
+            except requests.ConnectionError:
+                eventlet.sleep(0.1)
+            else:
+                return
+
+
+@contextmanager
+def running_stack(port, amqp_uri=None, db_uri=None, redis_uri=None):
+    """ Runs the services until the block exits, yielding the gateway's
+    base URL and a description of the backing services used.
+    """
+    add_service_paths()
+
+    backends = {
+        'amqp': amqp_uri or 'memory',
+        'db': db_uri or 'sqlite',
+        'redis': redis_uri or 'fakeredis',
+    }
+    if amqp_uri is None:
+        amqp_uri = MEMORY_AMQP_URI
+        fix_memory_transport()
+    if redis_uri is None:
+        redis_uri = 'redis://localhost:6379/0'
+        use_fakeredis()
+
+    scratch_dir = None
+    if db_uri is None:
+        scratch_dir = tempfile.mkdtemp(prefix='bench-')
+        db_uri = 'sqlite:///{}'.format(
+            os.path.join(scratch_dir, 'orders.db'))
+
+    from nameko import config
+    from nameko.runners import ServiceRunner
+
+    from gateway.service import GatewayService
+    from orders.service import OrdersService
+    from products.service import ProductsService
+
+    services = (GatewayService, OrdersService, ProductsService)
+
+    try:
+        create_schema(db_uri)
+        with config.patch(
+            load_config(port, amqp_uri, db_uri, redis_uri), clear=True
+        ):
+            runner = ServiceRunner()
+            for service_cls in services:
+                runner.add_service(service_cls)
+            runner.start()
+            try:
+                base_url = 'http://127.0.0.1:{}'.format(port)
+                wait_until_up(base_url)
+                yield base_url, backends
+            finally:
+                runner.stop()
+    finally:
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)